@@ -0,0 +1,96 @@
+"""
+Drives concurrent `CodeAgent` and `ToolCallingAgent` runs through `OpenAIServerModel`, and reports their throughput and
+latency percentiles, to measure the overhead and concurrency behavior of the framework without real LLM calls.
+
+By default, the agents run against a local mock server replaying scripted completions, started in this process:
+    python examples/benchmarks/agent_load_test.py --runs 64 --concurrency 16 --latency 0.2
+Add streaming, or a long tail of slow responses:
+    python examples/benchmarks/agent_load_test.py --stream-outputs --latency-distribution lognormal
+Or point the agents at a server started separately with `mock_openai_server.py`:
+    python examples/benchmarks/agent_load_test.py --api-base http://127.0.0.1:8000/v1
+"""
+
+import argparse
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from mock_openai_server import MockOpenAIServer
+
+from smolagents import CodeAgent, OpenAIServerModel, ToolCallingAgent, tool
+
+
+@tool
+def lookup(query: str) -> str:
+    """
+    Looks up the answer to a query.
+
+    Args:
+        query: The query.
+    """
+    return "42"
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Load tests agents against an OpenAI-compatible server.")
+    parser.add_argument("--api-base", type=str, default=None, help="Server to use, by default a local mock server")
+    parser.add_argument("--runs", type=int, default=32, help="Number of agent runs of each agent type")
+    parser.add_argument("--concurrency", type=int, default=8, help="Number of concurrent agent runs")
+    parser.add_argument("--agent-types", nargs="+", choices=["code", "tool_calling"], default=["code", "tool_calling"])
+    parser.add_argument("--stream-outputs", action="store_true", help="Stream the outputs of the model")
+    parser.add_argument("--share-client", action="store_true", help="Share the OpenAI client between the models")
+    parser.add_argument("--latency-distribution", choices=["constant", "uniform", "lognormal"], default="constant")
+    parser.add_argument("--latency", type=float, default=0.1, help="Mean time to first token of the mock server")
+    parser.add_argument("--inter-token-latency", type=float, default=0.0)
+    return parser.parse_args()
+
+
+def run_agent(agent_type: str, api_base: str, stream_outputs: bool, share_client: bool) -> tuple[float, int]:
+    """Run an agent with a model of its own, and return its duration and its number of model calls."""
+    model = OpenAIServerModel(model_id="mock", api_base=api_base, api_key="mock", share_client=share_client)
+    agent_class = CodeAgent if agent_type == "code" else ToolCallingAgent
+    agent = agent_class(tools=[lookup], model=model, stream_outputs=stream_outputs, verbosity_level=-1, max_steps=5)
+    start_time = time.perf_counter()
+    agent.run("What is the answer?")
+    return time.perf_counter() - start_time, len(agent.memory.steps) - 1
+
+
+def percentile(durations: list[float], percent: int) -> float:
+    return statistics.quantiles(durations, n=100, method="inclusive")[percent - 1]
+
+
+def main():
+    args = parse_arguments()
+    server = None
+    if args.api_base is None:
+        server = MockOpenAIServer(
+            latency_distribution=args.latency_distribution,
+            latency=args.latency,
+            inter_token_latency=args.inter_token_latency,
+        ).start()
+    api_base = args.api_base or server.base_url
+    try:
+        print(f"{'Agent':>12} | {'Runs/s':>7} | {'Calls/s':>7} | {'p50 (s)':>7} | {'p90 (s)':>7} | {'p99 (s)':>7}")
+        for agent_type in args.agent_types:
+            start_time = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+                results = list(
+                    executor.map(
+                        lambda _: run_agent(agent_type, api_base, args.stream_outputs, args.share_client),
+                        range(args.runs),
+                    )
+                )
+            duration = time.perf_counter() - start_time
+            durations = [run_duration for run_duration, _ in results]
+            call_count = sum(run_call_count for _, run_call_count in results)
+            print(
+                f"{agent_type:>12} | {args.runs / duration:>7.2f} | {call_count / duration:>7.2f} | "
+                f"{percentile(durations, 50):>7.3f} | {percentile(durations, 90):>7.3f} | {percentile(durations, 99):>7.3f}"
+            )
+    finally:
+        if server is not None:
+            server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,303 @@
+"""
+Local stand-in for an OpenAI-compatible chat completions server, to run agents without paying for real LLM calls.
+
+The server replays scripted completions: the completion of a request is the one of its step in the script, counted by
+the assistant messages of the conversation, so that concurrent agent runs each follow the script. Completions can be
+text or tool calls, streamed or not, and are delayed by a time to first token drawn from a latency distribution, then
+by an inter-token latency between the streamed chunks.
+
+Serve the default scripts, answering in 2 steps, with a lognormal latency of 500ms on average:
+    python examples/benchmarks/mock_openai_server.py --port 8000 --latency-distribution lognormal --latency 0.5
+Replay recorded completions, one JSON object per line like `{"content": "..."}` or
+`{"tool_calls": [{"name": "final_answer", "arguments": {"answer": "42"}}]}`:
+    python examples/benchmarks/mock_openai_server.py --script completions.jsonl
+Then point a model at it:
+    OpenAIServerModel(model_id="mock", api_base="http://127.0.0.1:8000/v1", api_key="mock")
+"""
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+DEFAULT_CODE_SCRIPT = [
+    {"content": "Thought: I will look up the answer.\nCode:\n```py\nresult = 6 * 7\nprint(result)\n```<end_code>"},
+    {"content": "Thought: I have the answer.\nCode:\n```py\nfinal_answer(result)\n```<end_code>"},
+]
+DEFAULT_TOOL_CALLING_SCRIPT = [
+    {"tool_calls": [{"name": "lookup", "arguments": {"query": "answer"}}]},
+    {"tool_calls": [{"name": "final_answer", "arguments": {"answer": "42"}}]},
+]
+
+
+def sample_latency(distribution: str, mean: float, spread: float = 0.5) -> float:
+    """Draw a latency in seconds with the given mean, and a spread relative to it for random distributions."""
+    if mean <= 0:
+        return 0.0
+    if distribution == "constant":
+        return mean
+    if distribution == "uniform":
+        return random.uniform(mean * (1 - spread), mean * (1 + spread))
+    if distribution == "lognormal":
+        # Long tail of slow responses, like real providers
+        return random.lognormvariate(-(spread**2) / 2, spread) * mean
+    raise ValueError(f"Unknown latency distribution: {distribution}")
+
+
+def count_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+class MockOpenAIServer:
+    """
+    OpenAI-compatible chat completions server replaying scripted completions, in a background thread.
+
+    Args:
+        code_script (`list[dict]`, *optional*): Completions of the requests without tools, by step.
+        tool_calling_script (`list[dict]`, *optional*): Completions of the requests with tools, by step.
+        latency_distribution (`str`, default `"constant"`): Distribution of the time to first token, between
+            `"constant"`, `"uniform"` and `"lognormal"`.
+        latency (`float`, default `0.0`): Mean time to first token in seconds.
+        inter_token_latency (`float`, default `0.0`): Delay in seconds between the chunks of a streamed completion.
+        host (`str`, default `"127.0.0.1"`): Host to listen on.
+        port (`int`, default `0`): Port to listen on, or any free port if `0`.
+    """
+
+    def __init__(
+        self,
+        code_script: list[dict] | None = None,
+        tool_calling_script: list[dict] | None = None,
+        latency_distribution: str = "constant",
+        latency: float = 0.0,
+        inter_token_latency: float = 0.0,
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ):
+        self.code_script = code_script or DEFAULT_CODE_SCRIPT
+        self.tool_calling_script = tool_calling_script or DEFAULT_TOOL_CALLING_SCRIPT
+        self.latency_distribution = latency_distribution
+        self.latency = latency
+        self.inter_token_latency = inter_token_latency
+        self.request_count = 0
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(MockOpenAIRequestHandler):
+            mock_server = server
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> "MockOpenAIServer":
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self) -> "MockOpenAIServer":
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def get_completion(self, request: dict) -> dict:
+        """Return the scripted completion of the step of the request, cut at its first stop sequence."""
+        with self._lock:
+            self.request_count += 1
+        script = self.tool_calling_script if request.get("tools") else self.code_script
+        step = sum(message["role"] == "assistant" for message in request["messages"])
+        completion = dict(script[min(step, len(script) - 1)])
+        if completion.get("content") and request.get("stop"):
+            stop_sequences = [request["stop"]] if isinstance(request["stop"], str) else request["stop"]
+            completion["content"] = re.split("|".join(map(re.escape, stop_sequences)), completion["content"])[0]
+        return completion
+
+
+class MockOpenAIRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    mock_server: MockOpenAIServer
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            self._send_json({"object": "list", "data": [{"id": "mock", "object": "model", "owned_by": "mock"}]})
+        else:
+            self._send_json({"error": {"message": f"Unknown path {self.path}"}}, status=404)
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json({"error": {"message": f"Unknown path {self.path}"}}, status=404)
+            return
+        server = self.mock_server
+        completion = server.get_completion(request)
+        prompt_tokens = count_tokens(json.dumps(request["messages"]))
+        time.sleep(sample_latency(server.latency_distribution, server.latency))
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        if request.get("stream"):
+            self._stream_completion(completion_id, request, completion, prompt_tokens)
+        else:
+            self._send_completion(completion_id, request, completion, prompt_tokens)
+
+    def _send_json(self, body: dict, status: int = 200):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    @staticmethod
+    def _get_tool_calls(completion: dict) -> list[dict] | None:
+        if not completion.get("tool_calls"):
+            return None
+        return [
+            {
+                "id": f"call_{uuid.uuid4().hex[:24]}",
+                "type": "function",
+                "function": {"name": tool_call["name"], "arguments": json.dumps(tool_call["arguments"])},
+            }
+            for tool_call in completion["tool_calls"]
+        ]
+
+    @staticmethod
+    def _get_usage(completion: dict, tool_calls: list[dict] | None, prompt_tokens: int) -> dict:
+        completion_tokens = count_tokens(completion.get("content") or json.dumps(tool_calls))
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+
+    def _send_completion(self, completion_id: str, request: dict, completion: dict, prompt_tokens: int):
+        tool_calls = self._get_tool_calls(completion)
+        self._send_json(
+            {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request["model"],
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {
+                            "role": "assistant",
+                            "content": completion.get("content"),
+                            "tool_calls": tool_calls,
+                        },
+                        "finish_reason": "tool_calls" if tool_calls else "stop",
+                    }
+                ],
+                "usage": self._get_usage(completion, tool_calls, prompt_tokens),
+            }
+        )
+
+    def _stream_completion(self, completion_id: str, request: dict, completion: dict, prompt_tokens: int):
+        # Without a content length, the end of the stream is the end of the connection
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        def send_chunk(delta: dict, finish_reason: str | None = None, usage: dict | None = None):
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": request["model"],
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}] if delta is not None else [],
+                "usage": usage,
+            }
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            self.wfile.flush()
+
+        tool_calls = self._get_tool_calls(completion)
+        send_chunk({"role": "assistant", "content": ""})
+        if tool_calls:
+            for index, tool_call in enumerate(tool_calls):
+                function = tool_call["function"]
+                send_chunk(
+                    {
+                        "tool_calls": [
+                            {
+                                "index": index,
+                                "id": tool_call["id"],
+                                "type": "function",
+                                "function": {"name": function["name"], "arguments": ""},
+                            }
+                        ]
+                    }
+                )
+                # Stream the arguments in a few pieces, like providers do
+                arguments = function["arguments"]
+                for start in range(0, len(arguments), 8):
+                    time.sleep(self.mock_server.inter_token_latency)
+                    send_chunk(
+                        {"tool_calls": [{"index": index, "function": {"arguments": arguments[start : start + 8]}}]}
+                    )
+        else:
+            for piece in re.findall(r"\s*\S+|\s+", completion.get("content") or ""):
+                time.sleep(self.mock_server.inter_token_latency)
+                send_chunk({"content": piece})
+        send_chunk({}, finish_reason="tool_calls" if tool_calls else "stop")
+        if (request.get("stream_options") or {}).get("include_usage"):
+            send_chunk(None, usage=self._get_usage(completion, tool_calls, prompt_tokens))
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+
+def load_script(path: str) -> list[dict]:
+    with open(path) as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Serves scripted chat completions like an OpenAI-compatible server.")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--script", type=str, default=None, help="JSONL completions of the requests without tools")
+    parser.add_argument(
+        "--tool-calling-script", type=str, default=None, help="JSONL completions of the requests with tools"
+    )
+    parser.add_argument("--latency-distribution", choices=["constant", "uniform", "lognormal"], default="constant")
+    parser.add_argument("--latency", type=float, default=0.0, help="Mean time to first token in seconds")
+    parser.add_argument("--inter-token-latency", type=float, default=0.0, help="Delay between streamed chunks")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    server = MockOpenAIServer(
+        code_script=load_script(args.script) if args.script else None,
+        tool_calling_script=load_script(args.tool_calling_script) if args.tool_calling_script else None,
+        latency_distribution=args.latency_distribution,
+        latency=args.latency,
+        inter_token_latency=args.inter_token_latency,
+        host=args.host,
+        port=args.port,
+    )
+    print(f"Serving chat completions on {server.base_url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
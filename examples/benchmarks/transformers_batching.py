@@ -0,0 +1,74 @@
+"""
+Compares the throughput of `TransformersModel` on CPU when concurrent requests are served one after another and
+when they are batched by its continuous batching scheduler.
+
+By default, a tiny random Llama model is created in a temporary directory, so that the benchmark runs offline:
+    python examples/benchmarks/transformers_batching.py
+Pass a model of the Hub to measure a real one:
+    python examples/benchmarks/transformers_batching.py --model-id HuggingFaceTB/SmolLM2-135M-Instruct
+"""
+
+import argparse
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import transformers
+from transformers_prompt_caching import create_tiny_model
+
+from smolagents import TransformersModel
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Benchmarks batching in TransformersModel.")
+    parser.add_argument("--model-id", type=str, default=None, help="Model to benchmark, by default a tiny random one")
+    parser.add_argument("--requests", type=int, default=32, help="Number of concurrent requests")
+    parser.add_argument("--max-batch-size", type=int, default=8)
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    return parser.parse_args()
+
+
+def serve(model: TransformersModel, requests: list[list[dict]], concurrency: int) -> tuple[float, int]:
+    def generate(messages):
+        message = model.generate(messages)
+        # Token counts of the model are those of the last request: count the tokens of this one
+        return len(model.tokenizer(message.content, add_special_tokens=False)["input_ids"])
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        output_token_count = sum(executor.map(generate, requests))
+    return time.perf_counter() - start_time, output_token_count
+
+
+def main():
+    args = parse_arguments()
+    transformers.logging.set_verbosity_error()
+    model_id = args.model_id or create_tiny_model(tempfile.mkdtemp())
+    requests = [
+        [
+            {
+                "role": "user",
+                "content": [{"type": "text", "text": f"Request {i}: " + "describe the task. " * (i % 5 + 1)}],
+            }
+        ]
+        for i in range(args.requests)
+    ]
+    model_kwargs = dict(model_id=model_id, device_map="cpu", max_new_tokens=args.max_new_tokens, do_sample=False)
+
+    sequential_model = TransformersModel(**model_kwargs)
+    batched_model = TransformersModel(**model_kwargs, max_batch_size=args.max_batch_size)
+    serve(batched_model, requests[:2], concurrency=2)  # Warm up
+
+    for name, model, concurrency in [
+        ("Sequential", sequential_model, 1),
+        (f"Batched (max batch size {args.max_batch_size})", batched_model, args.requests),
+    ]:
+        duration, output_token_count = serve(model, requests, concurrency)
+        print(
+            f"{name}: {args.requests} requests in {duration:.2f}s, "
+            f"{args.requests / duration:.2f} requests/s, {output_token_count / duration:.1f} output tokens/s"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+Measures the time to first token of `TransformersModel` on CPU along the steps of a simulated agent run, with and
+without prompt caching.
+
+By default, a tiny random Llama model is created in a temporary directory, so that the benchmark runs offline:
+    python examples/benchmarks/transformers_prompt_caching.py
+Pass a model of the Hub to measure a real one:
+    python examples/benchmarks/transformers_prompt_caching.py --model-id HuggingFaceTB/SmolLM2-135M-Instruct
+"""
+
+import argparse
+import statistics
+import tempfile
+import time
+
+import transformers
+
+from smolagents import TransformersModel
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Benchmarks prompt caching in TransformersModel.")
+    parser.add_argument("--model-id", type=str, default=None, help="Model to benchmark, by default a tiny random one")
+    parser.add_argument("--steps", type=int, default=8, help="Number of simulated agent steps")
+    parser.add_argument("--system-prompt-words", type=int, default=600, help="Length of the system prompt")
+    parser.add_argument("--max-new-tokens", type=int, default=16)
+    return parser.parse_args()
+
+
+def create_tiny_model(path: str) -> str:
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers
+    from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+    vocab = {"<unk>": 0, "<s>": 1, "</s>": 2}
+    for i in range(256):
+        vocab.setdefault(chr(i), len(vocab))
+    tokenizer = Tokenizer(models.WordLevel(vocab=vocab, unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Split("", "isolated")
+    tokenizer.decoder = decoders.Fuse()
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer, bos_token="<s>", eos_token="</s>", unk_token="<unk>"
+    )
+    tokenizer.chat_template = (
+        "{% for message in messages %}<s>{{ message['role'] }}\n{{ message['content'] }}</s>\n{% endfor %}"
+        "{% if add_generation_prompt %}<s>assistant\n{% endif %}"
+    )
+    tokenizer.save_pretrained(path)
+    config = LlamaConfig(
+        vocab_size=len(vocab),
+        hidden_size=256,
+        intermediate_size=768,
+        num_hidden_layers=6,
+        num_attention_heads=8,
+        max_position_embeddings=32768,
+        bos_token_id=1,
+        eos_token_id=2,
+    )
+    LlamaForCausalLM(config).save_pretrained(path)
+    return path
+
+
+def measure_time_to_first_token(model: TransformersModel, messages: list[dict]) -> tuple[float, str]:
+    start_time = time.perf_counter()
+    stream = model.generate_stream(messages)
+    first_delta = next(stream)
+    time_to_first_token = time.perf_counter() - start_time
+    output = first_delta.content + "".join(delta.content for delta in stream)
+    return time_to_first_token, output
+
+
+def main():
+    args = parse_arguments()
+    transformers.logging.set_verbosity_error()
+    model_id = args.model_id or create_tiny_model(tempfile.mkdtemp())
+    models = {
+        prompt_caching: TransformersModel(
+            model_id=model_id,
+            device_map="cpu",
+            max_new_tokens=args.max_new_tokens,
+            do_sample=False,
+            prompt_caching=prompt_caching,
+        )
+        for prompt_caching in (False, True)
+    }
+
+    system_prompt = " ".join(f"tool_{i % 50}" for i in range(args.system_prompt_words))
+    messages = [
+        {"role": "system", "content": [{"type": "text", "text": system_prompt}]},
+        {"role": "user", "content": [{"type": "text", "text": "New task: compute the answer."}]},
+    ]
+    timings = {False: [], True: []}
+    print(f"{'Step':>4} | {'Prompt tokens':>13} | {'Reused':>6} | {'TTFT no cache (s)':>17} | {'TTFT cache (s)':>14}")
+    for step in range(args.steps):
+        for prompt_caching, model in models.items():
+            time_to_first_token, output = measure_time_to_first_token(model, messages)
+            timings[prompt_caching].append(time_to_first_token)
+        cached_model = models[True]
+        print(
+            f"{step:>4} | {cached_model.last_input_token_count:>13,} | {cached_model.last_cached_input_token_count:>6,} | "
+            f"{timings[False][-1]:>17.3f} | {timings[True][-1]:>14.3f}"
+        )
+        messages = messages + [
+            {"role": "assistant", "content": [{"type": "text", "text": output}]},
+            {"role": "user", "content": [{"type": "text", "text": f"Observation: result of step {step}."}]},
+        ]
+
+    # The first step has nothing to reuse
+    median_without_cache = statistics.median(timings[False][1:])
+    median_with_cache = statistics.median(timings[True][1:])
+    print(
+        f"Median time to first token after the first step: {median_without_cache:.3f}s without prompt caching, "
+        f"{median_with_cache:.3f}s with prompt caching ({median_without_cache / median_with_cache:.1f}x faster)"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+# Copyright 2024 The HuggingFace Inc. team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Kernel run in a child process by `SubprocessExecutor`.
+
+This file is executed as a script, not imported: it only depends on the standard library so that the kernel starts
+without importing smolagents. Requests and responses are pickled dicts framed by their length, read from stdin and
+written to the original stdout, which is then redirected to stderr so that stray writes cannot corrupt the protocol.
+"""
+
+import contextlib
+import io
+import mmap
+import os
+import pickle
+import signal
+import struct
+import sys
+import traceback
+from multiprocessing import shared_memory
+
+
+HEADER = struct.Struct("!Q")
+
+
+def read_message(stream):
+    header = stream.read(HEADER.size)
+    if len(header) < HEADER.size:
+        return None
+    return pickle.loads(stream.read(HEADER.unpack(header)[0]))
+
+
+def write_message(stream, message):
+    payload = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+    stream.write(HEADER.pack(len(payload)) + payload)
+    stream.flush()
+
+
+def attach_shared_memory(name):
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    from multiprocessing import resource_tracker
+
+    shm = shared_memory.SharedMemory(name=name)
+    # The segment is owned by the parent process, which unlinks it: do not let the tracker of this process unlink it too
+    resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+
+class Kernel:
+    def __init__(self):
+        self.namespace = {"__name__": "__main__", "__builtins__": __builtins__}
+        self.namespace["_smolagents_send_result"] = self.send_result
+        self.namespace["final_answer"] = lambda answer: self.send_result(answer, is_final_answer=True)
+        # Shared memory segments backing the variables, by name
+        self.shared_memories = {}
+        self.released_shared_memories = []
+        self.result = None
+        self.is_final_answer = False
+
+    def send_result(self, value, is_final_answer=False):
+        self.result = value
+        self.is_final_answer = self.is_final_answer or is_final_answer
+        return value
+
+    def execute(self, code):
+        self.result, self.is_final_answer = None, False
+        outputs = io.StringIO()
+        error = None
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        try:
+            with contextlib.redirect_stdout(outputs), contextlib.redirect_stderr(outputs):
+                exec(compile(code, "<code>", "exec"), self.namespace)
+        except BaseException as e:
+            # Skip the frame of this method in the traceback
+            error = "".join(traceback.format_exception(type(e), e, e.__traceback__.tb_next))
+        finally:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+        return {
+            "result": self.result,
+            "logs": outputs.getvalue(),
+            "is_final_answer": self.is_final_answer,
+            "error": error,
+        }
+
+    def set_variables(self, data, buffers):
+        try:
+            views = [self.map_buffer(*descriptor) for descriptor in buffers]
+            self.namespace.update(pickle.loads(data, buffers=views))
+        except BaseException as e:
+            return {"result": None, "logs": "", "is_final_answer": False, "error": f"Could not load variables: {e!r}"}
+        finally:
+            self.release_shared_memories(keep={location for kind, location, _, _ in buffers if kind == "shm"})
+        return {"result": None, "logs": "", "is_final_answer": False, "error": None}
+
+    def map_buffer(self, kind, location, offset, size):
+        if kind == "shm":
+            if location not in self.shared_memories:
+                self.shared_memories[location] = attach_shared_memory(location)
+            return self.shared_memories[location].buf[offset : offset + size]
+        with open(location, "rb") as f:
+            # Copy-on-write mapping: writes of the executed code are not propagated to the file
+            mapped_file = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        return memoryview(mapped_file)[offset : offset + size]
+
+    def release_shared_memories(self, keep):
+        """Unmap the segments of previous variables, once no object of the namespace uses them."""
+        for name in list(self.shared_memories):
+            if name not in keep:
+                self.released_shared_memories.append(self.shared_memories.pop(name))
+        for shm in list(self.released_shared_memories):
+            try:
+                shm.close()
+            except BufferError:
+                continue  # Still used: retried with the next variables
+            self.released_shared_memories.remove(shm)
+
+
+def main():
+    # The directory of this file must not shadow packages imported by the executed code
+    sys.path.pop(0)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    requests = sys.stdin.buffer
+    responses = os.fdopen(os.dup(sys.stdout.fileno()), "wb")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    kernel = Kernel()
+    while (request := read_message(requests)) is not None:
+        if request["type"] == "execute":
+            response = kernel.execute(request["code"])
+        elif request["type"] == "set_variables":
+            response = kernel.set_variables(request["data"], request["buffers"])
+        else:
+            response = {"result": None, "logs": "", "is_final_answer": False, "error": f"Unknown request: {request}"}
+        try:
+            write_message(responses, response)
+        except Exception as e:
+            response["result"] = None
+            response["error"] = f"Could not send the result back: {e!r}"
+            write_message(responses, response)
+
+
+if __name__ == "__main__":
+    main()
@@ -14,6 +14,7 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import ast
 import importlib
 import inspect
 import json
@@ -24,6 +25,7 @@ import textwrap
 import time
 from abc import ABC, abstractmethod
 from collections.abc import Callable, Generator
+from concurrent.futures import Future, ThreadPoolExecutor
 from logging import getLogger
 from pathlib import Path
 from typing import TYPE_CHECKING, Any, TypedDict
@@ -56,14 +58,22 @@ from .memory import (
     TaskStep,
     ToolCall,
 )
-from .models import ChatMessage, ChatMessageStreamDelta, MessageRole, Model, parse_json_if_needed
+from .models import (
+    ChatMessage,
+    ChatMessageStreamAccumulator,
+    ChatMessageStreamDelta,
+    ChatMessageToolCall,
+    MessageRole,
+    Model,
+    parse_json_if_needed,
+)
 from .monitoring import (
     YELLOW_HEX,
     AgentLogger,
     LogLevel,
     Monitor,
 )
-from .remote_executors import DockerExecutor, E2BExecutor
+from .remote_executors import DockerExecutor, E2BExecutor, SubprocessExecutor
 from .tools import Tool
 from .utils import (
     AgentError,
@@ -73,6 +83,7 @@ from .utils import (
     AgentParsingError,
     AgentToolCallError,
     AgentToolExecutionError,
+    IncrementalCodeParser,
     is_valid_name,
     make_init_file,
     parse_code_blobs,
@@ -1006,6 +1017,9 @@ class ToolCallingAgent(MultiStepAgent):
         model (`Callable[[list[dict[str, str]]], ChatMessage]`): Model that will generate the agent's actions.
         prompt_templates ([`~agents.PromptTemplates`], *optional*): Prompt templates.
         planning_interval (`int`, *optional*): Interval at which the agent will run a planning step.
+        stream_outputs (`bool`, *optional*, default `False`): Whether to stream outputs during execution. The tool call
+            of a step then starts executing as soon as its arguments are complete, while the rest of the output is
+            streamed.
         **kwargs: Additional keyword arguments.
     """
 
@@ -1015,6 +1029,7 @@ class ToolCallingAgent(MultiStepAgent):
         model: Callable[[list[dict[str, str]]], ChatMessage],
         prompt_templates: PromptTemplates | None = None,
         planning_interval: int | None = None,
+        stream_outputs: bool = False,
         **kwargs,
     ):
         prompt_templates = prompt_templates or yaml.safe_load(
@@ -1027,6 +1042,13 @@ class ToolCallingAgent(MultiStepAgent):
             planning_interval=planning_interval,
             **kwargs,
         )
+        self.stream_outputs = stream_outputs
+        if self.stream_outputs and not hasattr(self.model, "generate_stream"):
+            raise ValueError(
+                "`stream_outputs` is set to True, but the model class implements no `generate_stream` method."
+            )
+        # Executes the tool calls completed during the streams, one per step
+        self._early_execution_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="early-tool-call")
 
     def initialize_system_prompt(self) -> str:
         system_prompt = populate_template(
@@ -1047,12 +1069,30 @@ class ToolCallingAgent(MultiStepAgent):
         # Add new step in logs
         memory_step.model_input_messages = input_messages
 
+        early_execution = None
         try:
-            chat_message: ChatMessage = self.model(
-                input_messages,
-                stop_sequences=["Observation:", "Calling tools:"],
-                tools_to_call_from=list(self.tools.values()),
-            )
+            if self.stream_outputs:
+                output_stream = self.model.generate_stream(
+                    input_messages,
+                    stop_sequences=["Observation:", "Calling tools:"],
+                    tools_to_call_from=list(self.tools.values()),
+                )
+                accumulator = ChatMessageStreamAccumulator()
+                with Live("", console=self.logger.console, vertical_overflow="visible") as live:
+                    for event in output_stream:
+                        accumulator.add(event)
+                        live.update(Markdown(self._format_streamed_output(accumulator)))
+                        if early_execution is None and (completed_tool_calls := accumulator.completed_tool_calls):
+                            # Only the first tool call is executed
+                            early_execution = self._execute_tool_call_early(completed_tool_calls[0]) or False
+                        yield event
+                chat_message = accumulator.to_message()
+            else:
+                chat_message: ChatMessage = self.model(
+                    input_messages,
+                    stop_sequences=["Observation:", "Calling tools:"],
+                    tools_to_call_from=list(self.tools.values()),
+                )
             memory_step.model_output_message = chat_message
             model_output = chat_message.content
             self.logger.log_markdown(
@@ -1064,12 +1104,18 @@ class ToolCallingAgent(MultiStepAgent):
             memory_step.model_output_message.content = model_output
             memory_step.model_output = model_output
         except Exception as e:
+            self._discard_early_execution(early_execution)
             raise AgentGenerationError(f"Error while generating output:\n{e}", self.logger) from e
+        except BaseException:
+            # The step is closed during the stream, for instance when the run is interrupted
+            self._discard_early_execution(early_execution)
+            raise
 
         if chat_message.tool_calls is None or len(chat_message.tool_calls) == 0:
             try:
                 chat_message = self.model.parse_tool_calls(chat_message)
             except Exception as e:
+                self._discard_early_execution(early_execution)
                 raise AgentParsingError(f"Error while parsing tool call from model output: {e}", self.logger)
         else:
             for tool_call in chat_message.tool_calls:
@@ -1077,6 +1123,12 @@ class ToolCallingAgent(MultiStepAgent):
         tool_call = chat_message.tool_calls[0]  # type: ignore
         tool_name, tool_call_id = tool_call.function.name, tool_call.id
         tool_arguments = tool_call.function.arguments
+        early_observation = None
+        if early_execution:
+            if early_execution[:2] == (tool_name, self._normalize_tool_arguments(tool_arguments)):
+                early_observation = early_execution[2]
+            else:
+                self._discard_early_execution(early_execution)
         memory_step.model_output = str(f"Called Tool: '{tool_name}' with arguments: {tool_arguments}")
         memory_step.tool_calls = [ToolCall(name=tool_name, arguments=tool_arguments, id=tool_call_id)]
 
@@ -1113,7 +1165,10 @@ class ToolCallingAgent(MultiStepAgent):
         else:
             if tool_arguments is None:
                 tool_arguments = {}
-            observation = self.execute_tool_call(tool_name, tool_arguments)
+            if early_observation is not None:
+                observation = early_observation.result()
+            else:
+                observation = self.execute_tool_call(tool_name, tool_arguments)
             observation_type = type(observation)
             if observation_type in [AgentImage, AgentAudio]:
                 if observation_type == AgentImage:
@@ -1133,6 +1188,54 @@ class ToolCallingAgent(MultiStepAgent):
             memory_step.observations = updated_information
             yield None
 
+    def _execute_tool_call_early(self, tool_call: ChatMessageToolCall) -> tuple[str, Any, Future] | None:
+        """
+        Start executing a complete tool call in the background, while the rest of the output is streamed.
+
+        Returns:
+            `tuple[str, Any, Future] | None`: Name and arguments of the executed tool, and the future of its output, or
+            `None` if the call waits for the end of the stream: the final answer, and managed agents which log to the
+            console, are not executed early.
+        """
+        tool_name = tool_call.function.name
+        if tool_name == "final_answer" or tool_name not in self.tools:
+            return None
+        tool_arguments = self._normalize_tool_arguments(tool_call.function.arguments)
+        return (
+            tool_name,
+            tool_arguments,
+            self._early_execution_pool.submit(self.execute_tool_call, tool_name, tool_arguments),
+        )
+
+    @staticmethod
+    def _normalize_tool_arguments(arguments: Any) -> Any:
+        """Return the arguments of a tool call as they are executed, parsed from JSON and empty if missing."""
+        arguments = parse_json_if_needed(arguments)
+        return {} if arguments is None else arguments
+
+    def _discard_early_execution(self, early_execution: tuple[str, Any, Future] | None):
+        """
+        Wait for a tool call executed during the stream whose output is not used, because the final output calls
+        another tool or the step failed, so that it never outlives its step.
+        """
+        if not early_execution:
+            return
+        tool_name, tool_arguments, future = early_execution
+        error = future.exception()
+        self.logger.log(
+            f"Discarded the output of tool '{tool_name}' executed during the stream with arguments: {tool_arguments}"
+            + (f", which failed: {error}" if error is not None else ""),
+            level=LogLevel.INFO,
+        )
+
+    @staticmethod
+    def _format_streamed_output(accumulator: ChatMessageStreamAccumulator) -> str:
+        """Format the content and the tool calls of a message being streamed, for live display."""
+        output = accumulator.content or ""
+        for tool_call in accumulator.tool_calls:
+            output += f"\n\nCalling tool: `{tool_call.function.name}` with arguments: `{tool_call.function.arguments}`"
+        return output
+
     def _substitute_state_variables(self, arguments: dict[str, str] | str) -> dict[str, Any] | str:
         """Replace string values in arguments with their corresponding state values if they exist."""
         if isinstance(arguments, dict):
@@ -1207,6 +1310,90 @@ class ToolCallingAgent(MultiStepAgent):
             raise AgentToolExecutionError(error_msg, self.logger) from e
 
 
+class _IncrementalCodeExecution:
+    """
+    Executes the complete statements of a code action in the background while the action is being generated.
+
+    Statements are executed in order in a single worker thread, until one of them fails or returns the final answer.
+    The variables of the executor are saved beforehand, so that they can be restored if the final code action does not
+    start with the executed statements: in-place modifications of objects and side effects of tools are not undone.
+    """
+
+    def __init__(self, python_executor: LocalPythonExecutor):
+        self.python_executor = python_executor
+        self.saved_state = dict(python_executor.state)
+        self.submitted_code = ""
+        self.output = None
+        self.logs: list[str] = []
+        self.is_final_answer = False
+        self.error: Exception | None = None
+        self._pool = ThreadPoolExecutor(max_workers=1)
+
+    def submit(self, code: str):
+        """Execute the next complete statements in the background."""
+        self.submitted_code += code
+        self._pool.submit(self._execute, code)
+
+    def _execute(self, code: str):
+        if self.error is not None or self.is_final_answer:
+            return
+        try:
+            self.output, logs, self.is_final_answer = self.python_executor(code)
+            self.logs.append(logs)
+        except Exception as e:
+            self.error = e
+
+    def finish(self, code_action: str) -> tuple[Any, str, bool] | None:
+        """
+        Execute the rest of the final code action, after the statements executed in the background.
+
+        Returns:
+            `tuple[Any, str, bool] | None`: Output, execution logs and whether the output is the final answer, or `None`
+            if the code action does not start with the executed statements, in which case the variables of the
+            executor are restored.
+        """
+        self._pool.shutdown(wait=True)
+        executed_code = self.submitted_code.strip()
+        if code_action != executed_code and not code_action.startswith(executed_code + "\n"):
+            self.rollback()
+            return None
+        remaining_code = code_action[len(executed_code) :]
+        try:
+            has_remaining_statements = bool(ast.parse(remaining_code).body)
+        except SyntaxError:
+            # The whole code action is invalid: it must fail without executing anything
+            self.rollback()
+            return None
+        if has_remaining_statements:
+            self._execute(remaining_code)
+        if self.error is not None:
+            # Keep the print outputs of the previous statements
+            self.python_executor.state["_print_outputs"].value = "".join(self.logs) + str(
+                self.python_executor.state["_print_outputs"]
+            )
+            raise self.error
+        return self.output, "".join(self.logs), self.is_final_answer
+
+    def rollback(self):
+        """Cancel the pending statements and wait for the running one, then restore the variables of the executor."""
+        self._pool.shutdown(wait=True, cancel_futures=True)
+        self.python_executor.state.clear()
+        self.python_executor.state.update(self.saved_state)
+
+
+class _CodeActionCandidate:
+    """A candidate output of the model for a step, with its code action and the result of its execution."""
+
+    def __init__(self, chat_message: ChatMessage):
+        self.chat_message = chat_message
+        self.code_action: str | None = None
+        self.parsing_error: Exception | None = None
+        self.execution_result: tuple[Any, str, bool] | None = None
+        self.execution_error: Exception | None = None
+        self.state: dict[str, Any] | None = None
+        self.passed = False
+
+
 class CodeAgent(MultiStepAgent):
     """
     In this agent, the tool calls will be formulated by the LLM in code format, then parsed and executed.
@@ -1218,10 +1405,23 @@ class CodeAgent(MultiStepAgent):
         grammar (`dict[str, str]`, *optional*): Grammar used to parse the LLM output.
         additional_authorized_imports (`list[str]`, *optional*): Additional authorized imports for the agent.
         planning_interval (`int`, *optional*): Interval at which the agent will run a planning step.
-        executor_type (`str`, default `"local"`): Which executor type to use between `"local"`, `"e2b"`, or `"docker"`.
+        executor_type (`str`, default `"local"`): Which executor type to use between `"local"`, `"e2b"`, `"docker"`, or `"subprocess"`.
         executor_kwargs (`dict`, *optional*): Additional arguments to pass to initialize the executor.
         max_print_outputs_length (`int`, *optional*): Maximum length of the print outputs.
         stream_outputs (`bool`, *optional*, default `False`): Whether to stream outputs during execution.
+        incremental_execution (`bool`, *optional*, default `False`): Whether to execute each complete top-level
+            statement of a streamed code action as soon as it is generated, so that slow tool calls overlap with the
+            generation of the next statements. Requires `stream_outputs` and the local executor. If the final code
+            action does not start with the executed statements, the variables of the executor are restored and the whole
+            action is executed again.
+        num_candidates (`int`, *optional*, default `1`): Number of candidate outputs generated at each step, in parallel
+            unless the model is not `thread_safe`, like local models. Candidates are executed one after another, each on its own copy of the variables of the executor,
+            until one runs without error and passes `candidate_scorer`: only this one is kept in memory. If none does,
+            the first candidate running without error is kept, or else the first candidate. Requires
+            `stream_outputs=False` and the local executor: in-place modifications of objects and side effects of tools
+            are not isolated.
+        candidate_scorer (`Callable[[str, Any, str], bool]`, *optional*): Function called with the code action, output
+            and execution logs of a candidate running without error, returning whether the candidate passes.
         **kwargs: Additional keyword arguments.
     """
 
@@ -1237,6 +1437,9 @@ class CodeAgent(MultiStepAgent):
         executor_kwargs: dict[str, Any] | None = None,
         max_print_outputs_length: int | None = None,
         stream_outputs: bool = False,
+        incremental_execution: bool = False,
+        num_candidates: int = 1,
+        candidate_scorer: Callable[[str, Any, str], bool] | None = None,
         **kwargs,
     ):
         self.additional_authorized_imports = additional_authorized_imports if additional_authorized_imports else []
@@ -1266,14 +1469,27 @@ class CodeAgent(MultiStepAgent):
         self.executor_type = executor_type or "local"
         self.executor_kwargs = executor_kwargs or {}
         self.python_executor = self.create_python_executor()
+        self.incremental_execution = incremental_execution
+        if self.incremental_execution and not (
+            self.stream_outputs and isinstance(self.python_executor, LocalPythonExecutor)
+        ):
+            raise ValueError("`incremental_execution` requires `stream_outputs=True` and the local executor.")
+        self.num_candidates = num_candidates
+        self.candidate_scorer = candidate_scorer
+        if self.num_candidates > 1 and (
+            self.stream_outputs or not isinstance(self.python_executor, LocalPythonExecutor)
+        ):
+            raise ValueError("`num_candidates` greater than 1 requires `stream_outputs=False` and the local executor.")
 
     def create_python_executor(self) -> PythonExecutor:
         match self.executor_type:
-            case "e2b" | "docker":
+            case "e2b" | "docker" | "subprocess":
                 if self.managed_agents:
                     raise Exception("Managed agents are not yet supported with remote code execution.")
                 if self.executor_type == "e2b":
                     return E2BExecutor(self.additional_authorized_imports, self.logger, **self.executor_kwargs)
+                elif self.executor_type == "subprocess":
+                    return SubprocessExecutor(self.additional_authorized_imports, self.logger, **self.executor_kwargs)
                 else:
                     return DockerExecutor(self.additional_authorized_imports, self.logger, **self.executor_kwargs)
             case "local":
@@ -1299,6 +1515,76 @@ class CodeAgent(MultiStepAgent):
         )
         return system_prompt
 
+    def _generate_candidates(self, input_messages: list[Message], **additional_args) -> list[_CodeActionCandidate]:
+        """
+        Generate `num_candidates` outputs, in parallel if the model is thread-safe. The token counts of the model are
+        set to their totals.
+        """
+
+        def generate(_) -> tuple[ChatMessage, tuple]:
+            chat_message = self.model.generate(
+                input_messages,
+                stop_sequences=["<end_code>", "Observation:", "Calling tools:"],
+                **additional_args,
+            )
+            # The token counts of the model may already be those of another candidate
+            return chat_message, self.model.get_message_token_counts(chat_message)
+
+        candidates, token_counts, errors = [], [], []
+        max_workers = self.num_candidates if getattr(self.model, "thread_safe", True) else 1
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = [pool.submit(generate, i) for i in range(self.num_candidates)]
+            for future in futures:
+                try:
+                    chat_message, candidate_token_counts = future.result()
+                except Exception as e:
+                    errors.append(e)
+                    continue
+                candidates.append(_CodeActionCandidate(chat_message))
+                token_counts.append(candidate_token_counts)
+        if not candidates:
+            raise errors[0]
+        if all(isinstance(count, int) for counts in token_counts for count in counts):
+            self.model.last_input_token_count = sum(counts[0] for counts in token_counts)
+            self.model.last_output_token_count = sum(counts[1] for counts in token_counts)
+        return candidates
+
+    def _select_candidate(self, candidates: list[_CodeActionCandidate]) -> _CodeActionCandidate:
+        """
+        Execute the candidates one after another, each from the variables of the executor before the step, until one
+        runs without error and passes the scoring callback. The variables of the executor are then those after the
+        selected candidate.
+        """
+        initial_state = dict(self.python_executor.state)
+        for i, candidate in enumerate(candidates):
+            try:
+                candidate.code_action = fix_final_answer_code(parse_code_blobs(candidate.chat_message.content))
+            except Exception as e:
+                candidate.parsing_error = e
+                continue
+            self.python_executor.state.clear()
+            self.python_executor.state.update(initial_state)
+            try:
+                candidate.execution_result = self.python_executor(candidate.code_action)
+            except Exception as e:
+                candidate.execution_error = e
+            else:
+                output, execution_logs, _ = candidate.execution_result
+                candidate.passed = self.candidate_scorer is None or bool(
+                    self.candidate_scorer(candidate.code_action, output, execution_logs)
+                )
+            candidate.state = dict(self.python_executor.state)
+            if candidate.passed:
+                break
+            self.logger.log(f"Candidate {i + 1}/{len(candidates)} was rejected.", level=LogLevel.DEBUG)
+        selected = next(
+            (candidate for candidate in candidates if candidate.passed),
+            next((candidate for candidate in candidates if candidate.execution_result is not None), candidates[0]),
+        )
+        self.python_executor.state.clear()
+        self.python_executor.state.update(selected.state if selected.state is not None else initial_state)
+        return selected
+
     def _step_stream(self, memory_step: ActionStep) -> Generator[Any]:
         """
         Perform one step in the ReAct framework: the agent thinks, acts, and observes the result.
@@ -1309,6 +1595,8 @@ class CodeAgent(MultiStepAgent):
         input_messages = memory_messages.copy()
         ### Generate model output ###
         memory_step.model_input_messages = input_messages
+        incremental_execution = None
+        candidate = None
         try:
             additional_args = {"grammar": self.grammar} if self.grammar is not None else {}
             if self.stream_outputs:
@@ -1318,17 +1606,38 @@ class CodeAgent(MultiStepAgent):
                     **additional_args,
                 )
                 output_text = ""
-                with Live("", console=self.logger.console, vertical_overflow="visible") as live:
-                    for event in output_stream:
-                        if event.content is not None:
-                            output_text += event.content
-                            live.update(Markdown(output_text))
-                        yield event
+                if self.incremental_execution:
+                    code_parser = IncrementalCodeParser()
+                    incremental_execution = _IncrementalCodeExecution(self.python_executor)
+                stream_completed = False
+                try:
+                    with Live("", console=self.logger.console, vertical_overflow="visible") as live:
+                        for event in output_stream:
+                            if event.content is not None:
+                                output_text += event.content
+                                live.update(Markdown(output_text))
+                                if incremental_execution is not None and (code := code_parser.feed(event.content)):
+                                    incremental_execution.submit(code)
+                            yield event
+                    stream_completed = True
+                finally:
+                    # Also covers the step being closed mid-stream, e.g. when the caller stops iterating
+                    if incremental_execution is not None and not stream_completed:
+                        incremental_execution.rollback()
 
                 model_output = output_text
                 chat_message = ChatMessage(role="assistant", content=model_output)
                 memory_step.model_output_message = chat_message
                 model_output = chat_message.content
+            elif self.num_candidates > 1:
+                candidate = self._select_candidate(self._generate_candidates(input_messages, **additional_args))
+                memory_step.model_output_message = candidate.chat_message
+                model_output = candidate.chat_message.content
+                self.logger.log_markdown(
+                    content=model_output,
+                    title="Output message of the selected candidate:",
+                    level=LogLevel.DEBUG,
+                )
             else:
                 chat_message: ChatMessage = self.model.generate(
                     input_messages,
@@ -1351,12 +1660,22 @@ class CodeAgent(MultiStepAgent):
 
             memory_step.model_output = model_output
         except Exception as e:
+            if incremental_execution is not None:
+                incremental_execution.rollback()
             raise AgentGenerationError(f"Error in generating model output:\n{e}", self.logger) from e
 
         ### Parse output ###
         try:
-            code_action = fix_final_answer_code(parse_code_blobs(model_output))
+            if candidate is not None and candidate.parsing_error is not None:
+                raise candidate.parsing_error
+            code_action = (
+                candidate.code_action
+                if candidate is not None
+                else fix_final_answer_code(parse_code_blobs(model_output))
+            )
         except Exception as e:
+            if incremental_execution is not None:
+                incremental_execution.rollback()
             error_msg = f"Error in code parsing:\n{e}\nMake sure to provide correct code blobs."
             raise AgentParsingError(error_msg, self.logger)
 
@@ -1372,7 +1691,18 @@ class CodeAgent(MultiStepAgent):
         self.logger.log_code(title="Executing parsed code:", content=code_action, level=LogLevel.INFO)
         is_final_answer = False
         try:
-            output, execution_logs, is_final_answer = self.python_executor(code_action)
+            execution_result = incremental_execution.finish(code_action) if incremental_execution is not None else None
+            if candidate is not None:
+                # The selected candidate has already been executed
+                if candidate.execution_error is not None:
+                    raise candidate.execution_error
+                execution_result = candidate.execution_result
+            if incremental_execution is not None and execution_result is None:
+                self.logger.log(
+                    "The code action does not start with the statements executed while it was generated: executing it again.",
+                    level=LogLevel.INFO,
+                )
+            output, execution_logs, is_final_answer = execution_result or self.python_executor(code_action)
             execution_outputs_console = []
             if len(execution_logs) > 0:
                 execution_outputs_console += [
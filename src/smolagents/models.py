@@ -11,30 +11,48 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import asyncio
+import email.utils
+import hashlib
+import inspect
 import json
 import logging
 import os
+import random
 import re
+import sqlite3
+import time
 import uuid
 import warnings
-from collections.abc import Generator
+from collections import deque
+from collections.abc import AsyncGenerator, Callable, Generator
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from copy import deepcopy
-from dataclasses import asdict, dataclass
+from dataclasses import asdict, dataclass, is_dataclass, replace
 from enum import Enum
-from threading import Thread
+from functools import lru_cache, partial
+from pathlib import Path
+from threading import Event, Lock, Thread
 from typing import TYPE_CHECKING, Any
 
 from .tools import Tool
-from .utils import _is_package_available, encode_image_base64, make_image_url, parse_json_blob
+from .utils import (
+    ImageEncodingPolicy,
+    _is_package_available,
+    encode_image,
+    make_image_url,
+    parse_json_blob,
+)
 
 
 if TYPE_CHECKING:
+    import torch
     from huggingface_hub import (
         ChatCompletionOutputFunctionDefinition,
         ChatCompletionOutputMessage,
         ChatCompletionOutputToolCall,
     )
-    from transformers import StoppingCriteriaList
+    from transformers import PreTrainedTokenizerBase, StoppingCriteriaList, TextIteratorStreamer
 
 
 logger = logging.getLogger(__name__)
@@ -138,10 +156,27 @@ def parse_json_if_needed(arguments: str | dict) -> str | dict:
             return arguments
 
 
+@dataclass
+class ChatMessageToolCallStreamDelta:
+    """Fragment of a streamed tool call: the fragments of a tool call share its index, and its arguments are split."""
+
+    index: int
+    id: str | None = None
+    type: str | None = None
+    name: str | None = None
+    arguments: str | None = None
+
+    @property
+    def function(self) -> ChatMessageToolCallDefinition:
+        """The name and arguments of the fragment, as on a [`ChatMessageToolCall`]."""
+        return ChatMessageToolCallDefinition(name=self.name or "", arguments=self.arguments or "")
+
+
 @dataclass
 class ChatMessageStreamDelta:
     content: str | None = None
-    tool_calls: list[ChatMessageToolCall] | None = None
+    # Models can also stream whole tool calls, which have no index
+    tool_calls: list[ChatMessageToolCall | ChatMessageToolCallStreamDelta] | None = None
 
 
 class MessageRole(str, Enum):
@@ -162,7 +197,99 @@ tool_role_conversions = {
 }
 
 
+class ChatMessageStreamAccumulator:
+    """
+    Assembles the deltas of a streamed message: contents are concatenated, and tool call fragments are merged by index
+    into [`ChatMessageToolCall`] objects, whose arguments are left as JSON strings. Whole [`ChatMessageToolCall`] objects
+    are added as they are.
+
+    A tool call is complete once its arguments are a whole JSON object, or once the next tool call starts: complete tool
+    calls can be executed before the end of the stream.
+
+    Args:
+        role (`str`, default `MessageRole.ASSISTANT`): Role of the assembled message.
+    """
+
+    def __init__(self, role: str = MessageRole.ASSISTANT):
+        self.role = role
+        self._content_chunks: list[str] = []
+        self._tool_calls: dict[int, dict[str, Any]] = {}
+        self._completed_tool_call_count = 0
+
+    def add(self, stream_delta: ChatMessageStreamDelta):
+        """Add the next delta of the stream."""
+        if stream_delta.content:
+            self._content_chunks.append(stream_delta.content)
+        for tool_call_delta in stream_delta.tool_calls or []:
+            if isinstance(tool_call_delta, ChatMessageToolCall):
+                self._tool_calls[max(self._tool_calls, default=-1) + 1] = {"tool_call": tool_call_delta}
+                continue
+            tool_call = self._tool_calls.setdefault(
+                tool_call_delta.index, {"id": "", "type": "function", "name": "", "arguments": []}
+            )
+            if tool_call_delta.id:
+                tool_call["id"] = tool_call_delta.id
+            if tool_call_delta.type:
+                tool_call["type"] = tool_call_delta.type
+            if tool_call_delta.name:
+                tool_call["name"] += tool_call_delta.name
+            if tool_call_delta.arguments:
+                tool_call["arguments"].append(tool_call_delta.arguments)
+
+    @property
+    def content(self) -> str | None:
+        return "".join(self._content_chunks) if self._content_chunks else None
+
+    @property
+    def tool_calls(self) -> list[ChatMessageToolCall]:
+        """The tool calls received so far, including an incomplete last one."""
+        return [
+            tool_call["tool_call"]
+            if "tool_call" in tool_call
+            else ChatMessageToolCall(
+                id=tool_call["id"],
+                type=tool_call["type"],
+                function=ChatMessageToolCallDefinition(
+                    name=tool_call["name"], arguments="".join(tool_call["arguments"])
+                ),
+            )
+            for _, tool_call in sorted(self._tool_calls.items())
+        ]
+
+    @property
+    def completed_tool_calls(self) -> list[ChatMessageToolCall]:
+        """The tool calls whose arguments are complete."""
+        tool_calls = self.tool_calls
+        # All the tool calls but the last one are complete: only the last one needs to be checked
+        count = max(self._completed_tool_call_count, len(tool_calls) - 1)
+        if count < len(tool_calls):
+            arguments = tool_calls[-1].function.arguments
+            try:
+                is_complete = isinstance(arguments, dict) or isinstance(json.loads(arguments), dict)
+            except json.JSONDecodeError:
+                is_complete = False
+            if is_complete:
+                count = len(tool_calls)
+        self._completed_tool_call_count = count
+        return tool_calls[:count]
+
+    def to_message(self) -> ChatMessage:
+        """Return the message assembled from the deltas received so far."""
+        return ChatMessage(role=self.role, content=self.content, tool_calls=self.tool_calls or None)
+
+
 def get_tool_json_schema(tool: Tool) -> dict:
+    """
+    Return the JSON schema of a tool, in the format of function calling APIs.
+
+    The schema is computed once and cached on the tool, then recomputed only if its `name`, `description` or `inputs`
+    change: the returned dict is shared between calls and must not be modified.
+    """
+    cached = vars(tool).get("_json_schema_cache")
+    if cached is not None:
+        name, description, inputs, json_schema = cached
+        if tool.name == name and tool.description == description and tool.inputs == inputs:
+            return json_schema
     properties = deepcopy(tool.inputs)
     required = []
     for key, value in properties.items():
@@ -170,7 +297,7 @@ def get_tool_json_schema(tool: Tool) -> dict:
             value["type"] = "string"
         if not ("nullable" in value and value["nullable"]):
             required.append(key)
-    return {
+    json_schema = {
         "type": "function",
         "function": {
             "name": tool.name,
@@ -182,6 +309,9 @@ def get_tool_json_schema(tool: Tool) -> dict:
             },
         },
     }
+    # Keep a copy of the inputs to detect in-place modifications
+    tool._json_schema_cache = (tool.name, tool.description, deepcopy(tool.inputs), json_schema)
+    return json_schema
 
 
 def remove_stop_sequences(content: str, stop_sequences: list[str]) -> str:
@@ -191,65 +321,314 @@ def remove_stop_sequences(content: str, stop_sequences: list[str]) -> str:
     return content
 
 
+class StopSequenceMatcher:
+    """
+    Finds the first occurrence of any of the stop sequences in a text received in chunks, like generated tokens.
+
+    The stop sequences are compiled into an Aho-Corasick automaton, so each character is processed once in constant
+    time, whatever the number of stop sequences and the length of the text.
+
+    Args:
+        stop_sequences (`list[str]`): Stop sequences to look for. Empty sequences are ignored.
+    """
+
+    def __init__(self, stop_sequences: list[str]):
+        # For each state: transitions, fallback state, length of the longest stop sequence ending on it, and length of
+        # the prefix of stop sequence it stands for
+        self._transitions: list[dict[str, int]] = [{}]
+        self._fallbacks = [0]
+        self._match_lengths = [0]
+        self._depths = [0]
+        for stop_sequence in stop_sequences:
+            state = 0
+            for character in stop_sequence:
+                if character not in self._transitions[state]:
+                    self._transitions.append({})
+                    self._fallbacks.append(0)
+                    self._match_lengths.append(0)
+                    self._depths.append(self._depths[state] + 1)
+                    self._transitions[state][character] = len(self._transitions) - 1
+                state = self._transitions[state][character]
+            self._match_lengths[state] = max(self._match_lengths[state], len(stop_sequence))
+        # Breadth-first traversal, so that the fallbacks of the shorter prefixes are known
+        queue = deque(self._transitions[0].values())
+        while queue:
+            state = queue.popleft()
+            for character, next_state in self._transitions[state].items():
+                queue.append(next_state)
+                fallback = self._fallbacks[state]
+                while fallback and character not in self._transitions[fallback]:
+                    fallback = self._fallbacks[fallback]
+                self._fallbacks[next_state] = self._transitions[fallback].get(character, 0)
+                self._match_lengths[next_state] = max(
+                    self._match_lengths[next_state], self._match_lengths[self._fallbacks[next_state]]
+                )
+        self.reset()
+
+    def reset(self):
+        """Forget the text received so far."""
+        self._state = 0
+        self.length = 0
+        self.match_start: int | None = None
+
+    @property
+    def partial_match_length(self) -> int:
+        """Length of the end of the text received so far that may be the start of a stop sequence."""
+        return self._depths[self._state] if self.match_start is None else 0
+
+    def feed(self, text: str) -> int | None:
+        """
+        Process the next chunk of text.
+
+        Returns:
+            `int | None`: Position, in the whole text received, of the start of the first stop sequence found so far,
+            or `None` if there is none yet.
+        """
+        if self.match_start is not None:
+            self.length += len(text)
+            return self.match_start
+        transitions, fallbacks, match_lengths = self._transitions, self._fallbacks, self._match_lengths
+        state = self._state
+        for i, character in enumerate(text):
+            while state and character not in transitions[state]:
+                state = fallbacks[state]
+            state = transitions[state].get(character, 0)
+            if match_lengths[state]:
+                self.match_start = self.length + i + 1 - match_lengths[state]
+                break
+        self._state = state
+        self.length += len(text)
+        return self.match_start
+
+
+class _ClientSideStopSequences:
+    """
+    Enforces stop sequences on a stream of deltas, for models that do not support the `stop` parameter.
+
+    The end of the content that may be the start of a stop sequence is held back until it is known not to be one, so
+    that no part of a stop sequence is ever emitted.
+    """
+
+    def __init__(self, stop_sequences: list[str]):
+        self.matcher = StopSequenceMatcher(stop_sequences)
+        self.pending_content = ""
+        self.emitted_length = 0
+        # Content generated by the model, up to the end of the stop sequence
+        self.received_content_chunks: list[str] = []
+
+    @property
+    def stopped(self) -> bool:
+        return self.matcher.match_start is not None
+
+    def process(self, stream_delta: ChatMessageStreamDelta) -> ChatMessageStreamDelta | None:
+        """Return the part of the delta to emit, if any."""
+        if not stream_delta.content:
+            return stream_delta
+        self.received_content_chunks.append(stream_delta.content)
+        match_start = self.matcher.feed(stream_delta.content)
+        content = self.pending_content + stream_delta.content
+        if match_start is not None:
+            content = content[: match_start - self.emitted_length]
+            self.pending_content = ""
+        else:
+            held_back_length = self.matcher.partial_match_length
+            content, self.pending_content = (
+                content[: len(content) - held_back_length],
+                content[len(content) - held_back_length :],
+            )
+        self.emitted_length += len(content)
+        if not content and not stream_delta.tool_calls:
+            return None
+        return ChatMessageStreamDelta(content=content or None, tool_calls=stream_delta.tool_calls)
+
+    def flush(self) -> ChatMessageStreamDelta | None:
+        """Return the content held back at the end of a stream without stop sequence."""
+        content, self.pending_content = self.pending_content, ""
+        return ChatMessageStreamDelta(content=content) if content else None
+
+
+class CleanMessageListCache:
+    """
+    Keeps the last message lists cleaned by [`get_clean_message_list`] along with their clean version, so that
+    cleaning a message list that extends one of them only requires processing the new messages.
+
+    Messages are compared by value, except images which are compared by identity.
+
+    Args:
+        max_entries (`int`, default `4`): Number of message lists to keep, for instance for models shared by agents.
+    """
+
+    def __init__(self, max_entries: int = 4):
+        self.max_entries = max_entries
+        # Entries of (settings, snapshots of the messages, clean messages), the most recent last
+        self._entries: list[tuple[tuple, list[dict], list[dict]]] = []
+        self._lock = Lock()
+
+    def get_prefix(self, message_list: list[dict], settings: tuple) -> tuple[int, list[dict], list[dict]]:
+        """
+        Return the number of leading messages of `message_list` already cleaned with the given settings, with their
+        snapshots and their clean version.
+        """
+        with self._lock:
+            entries = list(self._entries)
+        best_prefix = (0, [], [])
+        for entry_settings, snapshots, clean_messages in entries:
+            if (
+                len(best_prefix[1]) < len(snapshots) <= len(message_list)
+                and entry_settings == settings
+                and all(
+                    _message_matches_snapshot(message, snapshot) for message, snapshot in zip(message_list, snapshots)
+                )
+            ):
+                best_prefix = (len(snapshots), snapshots, clean_messages)
+        return best_prefix
+
+    def add(self, settings: tuple, snapshots: list[dict], clean_messages: list[dict]):
+        with self._lock:
+            # Drop the entries extended by the new one
+            self._entries = [
+                entry
+                for entry in self._entries
+                if not (len(entry[1]) <= len(snapshots) and entry[1][-1] is snapshots[len(entry[1]) - 1])
+            ]
+            self._entries.append((settings, snapshots, clean_messages))
+            del self._entries[: -self.max_entries]
+
+
+def _snapshot_message(message: dict) -> dict:
+    content = message["content"]
+    return {
+        "role": message["role"],
+        "content": [dict(element) for element in content] if isinstance(content, list) else content,
+    }
+
+
+def _message_matches_snapshot(message: dict, snapshot: dict) -> bool:
+    content, snapshot_content = message["content"], snapshot["content"]
+    if message["role"] != snapshot["role"]:
+        return False
+    if not isinstance(content, list) or not isinstance(snapshot_content, list):
+        return content == snapshot_content
+    if len(content) != len(snapshot_content):
+        return False
+    for element, snapshot_element in zip(content, snapshot_content):
+        if element.keys() != snapshot_element.keys():
+            return False
+        for key, value in snapshot_element.items():
+            # Images are compared by identity, as comparing their pixels would cost as much as encoding them
+            if element[key] is not value and (key == "image" or element[key] != value):
+                return False
+    return True
+
+
+def _clean_content_element(
+    element: dict,
+    convert_images_to_image_urls: bool,
+    flatten_messages_as_text: bool,
+    image_encoding_policy: ImageEncodingPolicy | None,
+) -> dict[str, Any]:
+    assert isinstance(element, dict), "Error: this element should be a dict:" + str(element)
+    if element["type"] != "image":
+        return dict(element)
+    assert not flatten_messages_as_text, f"Cannot use images with {flatten_messages_as_text=}"
+    encoded_image, mime_type = encode_image(element["image"], policy=image_encoding_policy)
+    if convert_images_to_image_urls:
+        return {
+            **{key: value for key, value in element.items() if key != "image"},
+            "type": "image_url",
+            "image_url": {"url": make_image_url(encoded_image, mime_type=mime_type)},
+        }
+    return {**element, "image": encoded_image, "mime_type": mime_type}
+
+
 def get_clean_message_list(
     message_list: list[dict[str, str | list[dict]]],
     role_conversions: dict[MessageRole, MessageRole] | dict[str, str] = {},
     convert_images_to_image_urls: bool = False,
     flatten_messages_as_text: bool = False,
+    cache: CleanMessageListCache | None = None,
+    image_encoding_policy: ImageEncodingPolicy | None = None,
+    merge_text_elements: bool = True,
 ) -> list[dict[str, str | list[dict]]]:
     """
     Subsequent messages with the same role will be concatenated to a single message.
     output_message_list is a list of messages that will be used to generate the final message that is chat template compatible with transformers LLM chat template.
 
+    The input messages are not modified nor copied: the output is made of new dicts, which share the unchanged values.
+
     Args:
         message_list (`list[dict[str, str]]`): List of chat messages.
         role_conversions (`dict[MessageRole, MessageRole]`, *optional* ): Mapping to convert roles.
         convert_images_to_image_urls (`bool`, default `False`): Whether to convert images to image URLs.
         flatten_messages_as_text (`bool`, default `False`): Whether to flatten messages as text.
+        cache ([`CleanMessageListCache`], *optional*): Cache of previous calls: if the message list starts with the
+            messages of a previous call with the same settings, only the following messages are processed.
+        image_encoding_policy ([`ImageEncodingPolicy`], *optional*): How to encode images, by default losslessly to
+            PNG at their original size.
+        merge_text_elements (`bool`, default `True`): Whether to concatenate the consecutive text elements of merged
+            messages. Keeping them separate keeps the content blocks of previous calls unchanged, as required by prompt
+            caching.
     """
-    output_message_list: list[dict[str, str | list[dict]]] = []
-    message_list = deepcopy(message_list)  # Avoid modifying the original list
-    for message in message_list:
+    settings = (
+        role_conversions,
+        convert_images_to_image_urls,
+        flatten_messages_as_text,
+        image_encoding_policy,
+        merge_text_elements,
+    )
+    start, snapshots, output_message_list = 0, [], []
+    if cache is not None:
+        start, snapshots, output_message_list = cache.get_prefix(message_list, settings)
+    # The messages of the cache are never modified: merging a message creates a new one
+    output_message_list = list(output_message_list)
+    for message in message_list[start:]:
         role = message["role"]
         if role not in MessageRole.roles():
             raise ValueError(f"Incorrect role {role}, only {MessageRole.roles()} are supported for now.")
 
         if role in role_conversions:
-            message["role"] = role_conversions[role]  # type: ignore
+            role = role_conversions[role]  # type: ignore
+        content = message["content"]
         # encode images if needed
-        if isinstance(message["content"], list):
-            for element in message["content"]:
-                assert isinstance(element, dict), "Error: this element should be a dict:" + str(element)
-                if element["type"] == "image":
-                    assert not flatten_messages_as_text, f"Cannot use images with {flatten_messages_as_text=}"
-                    if convert_images_to_image_urls:
-                        element.update(
-                            {
-                                "type": "image_url",
-                                "image_url": {"url": make_image_url(encode_image_base64(element.pop("image")))},
-                            }
-                        )
-                    else:
-                        element["image"] = encode_image_base64(element["image"])
+        if isinstance(content, list):
+            content = [
+                _clean_content_element(
+                    element, convert_images_to_image_urls, flatten_messages_as_text, image_encoding_policy
+                )
+                for element in content
+            ]
 
-        if len(output_message_list) > 0 and message["role"] == output_message_list[-1]["role"]:
-            assert isinstance(message["content"], list), "Error: wrong content:" + str(message["content"])
+        if len(output_message_list) > 0 and role == output_message_list[-1]["role"]:
+            assert isinstance(content, list), "Error: wrong content:" + str(content)
             if flatten_messages_as_text:
-                output_message_list[-1]["content"] += "\n" + message["content"][0]["text"]
+                merged_content = output_message_list[-1]["content"] + "\n" + content[0]["text"]
             else:
-                for el in message["content"]:
-                    if el["type"] == "text" and output_message_list[-1]["content"][-1]["type"] == "text":
+                merged_content = list(output_message_list[-1]["content"])
+                for el in content:
+                    if merge_text_elements and el["type"] == "text" and merged_content[-1]["type"] == "text":
                         # Merge consecutive text messages rather than creating new ones
-                        output_message_list[-1]["content"][-1]["text"] += "\n" + el["text"]
+                        merged_content[-1] = {
+                            **merged_content[-1],
+                            "text": merged_content[-1]["text"] + "\n" + el["text"],
+                        }
                     else:
-                        output_message_list[-1]["content"].append(el)
+                        merged_content.append(el)
+            output_message_list[-1] = {"role": role, "content": merged_content}
         else:
             if flatten_messages_as_text:
-                content = message["content"][0]["text"]
-            else:
-                content = message["content"]
-            output_message_list.append({"role": message["role"], "content": content})
-    return output_message_list
+                content = content[0]["text"]
+            output_message_list.append({"role": role, "content": content})
+    if cache is not None and len(message_list) > start:
+        snapshots = snapshots + [_snapshot_message(message) for message in message_list[start:]]
+        cache.add(settings, snapshots, output_message_list)
+    # Return new message dicts and content lists, so that callers modifying them do not alter the cache
+    return [
+        {
+            "role": message["role"],
+            "content": list(message["content"]) if isinstance(message["content"], list) else message["content"],
+        }
+        for message in output_message_list
+    ]
 
 
 def get_tool_call_from_text(text: str, tool_name_key: str, tool_arguments_key: str) -> ChatMessageToolCall:
@@ -288,22 +667,161 @@ def supports_stop_parameter(model_id: str) -> bool:
     return not re.match(pattern, model_name)
 
 
+def _supports_cache_control(model_id: str) -> bool:
+    """Check if the model takes Anthropic-style `cache_control` breakpoints through LiteLLM: Claude models do."""
+    return model_id.startswith("anthropic/") or "claude" in model_id.lower()
+
+
+class TokenCounter:
+    """
+    Counts locally the tokens of the prompt of a request, before sending it.
+
+    The tokens of a prompt are those of the text of its messages and of the JSON schemas of its tools, plus a fixed
+    number of tokens per message for the chat template, and per image. Subclasses implement `count_text_tokens` with
+    the tokenizer of the model.
+
+    Args:
+        tokens_per_message (`int`, default `4`): Tokens added by the chat template around each message.
+        tokens_per_image (`int`, default `765`): Tokens of an image.
+    """
+
+    def __init__(self, tokens_per_message: int = 4, tokens_per_image: int = 765):
+        self.tokens_per_message = tokens_per_message
+        self.tokens_per_image = tokens_per_image
+
+    def count_text_tokens(self, text: str) -> int:
+        raise NotImplementedError("This method must be implemented in child classes")
+
+    def count_message_tokens(self, message: dict[str, str | list[dict]]) -> int:
+        content = message["content"]
+        if isinstance(content, str):
+            return self.tokens_per_message + self.count_text_tokens(content)
+        token_count = self.tokens_per_message
+        for element in content or []:
+            if element["type"] == "text":
+                token_count += self.count_text_tokens(element["text"])
+            else:
+                token_count += self.tokens_per_image
+        return token_count
+
+    def count_tools_tokens(self, tools: list[dict]) -> int:
+        return self.count_text_tokens(json.dumps(tools)) if tools else 0
+
+    def count_tokens(self, messages: list[dict[str, str | list[dict]]], tools: list[dict] | None = None) -> int:
+        """Count the tokens of a prompt, made of messages and JSON schemas of tools."""
+        return sum(self.count_message_tokens(message) for message in messages) + self.count_tools_tokens(tools)
+
+
+class CharacterTokenCounter(TokenCounter):
+    """
+    Estimates the tokens of a prompt from its number of characters, without a tokenizer.
+
+    Args:
+        characters_per_token (`float`, default `4.0`): Average number of characters per token.
+    """
+
+    def __init__(self, characters_per_token: float = 4.0, **kwargs):
+        super().__init__(**kwargs)
+        self.characters_per_token = characters_per_token
+
+    def count_text_tokens(self, text: str) -> int:
+        return int(len(text) / self.characters_per_token + 0.5)
+
+
+@lru_cache(maxsize=None)
+def _get_tiktoken_encoding(encoding_name: str | None, model_id: str | None):
+    import tiktoken
+
+    return tiktoken.encoding_for_model(model_id) if model_id is not None else tiktoken.get_encoding(encoding_name)
+
+
+class TiktokenTokenCounter(TokenCounter):
+    """
+    Counts the tokens of a prompt with a [tiktoken](https://github.com/openai/tiktoken) encoding, for OpenAI models.
+    Encodings are loaded once per process, and their vocabularies cached on disk by tiktoken.
+
+    Args:
+        encoding_name (`str`, default `"o200k_base"`): Name of the encoding.
+        model_id (`str`, *optional*): OpenAI model whose encoding to use, instead of `encoding_name`.
+    """
+
+    def __init__(self, encoding_name: str = "o200k_base", model_id: str | None = None, **kwargs):
+        if not _is_package_available("tiktoken"):
+            raise ModuleNotFoundError("Please install 'tiktoken' to use TiktokenTokenCounter: `pip install tiktoken`")
+        super().__init__(**kwargs)
+        self.encoding = _get_tiktoken_encoding(None if model_id else encoding_name, model_id)
+
+    def count_text_tokens(self, text: str) -> int:
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+
+@lru_cache(maxsize=None)
+def _get_transformers_tokenizer(model_id: str):
+    from transformers import AutoTokenizer
+
+    return AutoTokenizer.from_pretrained(model_id)
+
+
+class TransformersTokenCounter(TokenCounter):
+    """
+    Counts the tokens of a prompt with a tokenizer of the transformers library, for open models.
+    Tokenizers are loaded once per process, and their vocabularies cached on disk by the Hugging Face Hub.
+
+    Args:
+        tokenizer (`str` or `PreTrainedTokenizerBase`): Tokenizer, or id of the model of the Hub whose tokenizer to use.
+    """
+
+    def __init__(self, tokenizer: "str | PreTrainedTokenizerBase", **kwargs):
+        if not _is_package_available("transformers"):
+            raise ModuleNotFoundError(
+                "Please install 'transformers' extra to use TransformersTokenCounter: "
+                "`pip install 'smolagents[transformers]'`"
+            )
+        super().__init__(**kwargs)
+        self.tokenizer = _get_transformers_tokenizer(tokenizer) if isinstance(tokenizer, str) else tokenizer
+
+    def count_text_tokens(self, text: str) -> int:
+        return len(self.tokenizer(text, add_special_tokens=False)["input_ids"])
+
+
 class Model:
+    # Whether concurrent calls to the model are safe, for instance to generate candidates in parallel
+    thread_safe: bool = True
+
     def __init__(
         self,
         flatten_messages_as_text: bool = False,
         tool_name_key: str = "name",
         tool_arguments_key: str = "arguments",
         model_id: str | None = None,
+        image_encoding_policy: ImageEncodingPolicy | dict | None = None,
+        prompt_caching: bool = False,
+        token_counter: TokenCounter | None = None,
+        max_input_tokens: int | None = None,
+        trim_messages: bool = False,
         **kwargs,
     ):
         self.flatten_messages_as_text = flatten_messages_as_text
         self.tool_name_key = tool_name_key
         self.tool_arguments_key = tool_arguments_key
+        if isinstance(image_encoding_policy, dict):
+            image_encoding_policy = ImageEncodingPolicy(**image_encoding_policy)
+        self.image_encoding_policy = image_encoding_policy
+        self.prompt_caching = prompt_caching
+        if max_input_tokens is not None and token_counter is None:
+            token_counter = CharacterTokenCounter()
+        self.token_counter = token_counter
+        self.max_input_tokens = max_input_tokens
+        self.trim_messages = trim_messages
         self.kwargs = kwargs
         self.last_input_token_count: int | None = None
+        # Input tokens of the last request counted by the token counter before sending it, if there is one
+        self.last_estimated_input_token_count: int | None = None
         self.last_output_token_count: int | None = None
+        # Part of the input tokens read from the prompt cache of the provider, when it reports it
+        self.last_cached_input_token_count: int | None = None
         self.model_id: str | None = model_id
+        self._clean_message_list_cache = CleanMessageListCache()
 
     def _prepare_completion_kwargs(
         self,
@@ -330,7 +848,14 @@ class Model:
             role_conversions=custom_role_conversions or tool_role_conversions,
             convert_images_to_image_urls=convert_images_to_image_urls,
             flatten_messages_as_text=flatten_messages_as_text,
+            cache=self._clean_message_list_cache,
+            image_encoding_policy=self.image_encoding_policy,
+            merge_text_elements=not self.prompt_caching,
         )
+        if self.token_counter is not None:
+            messages = self._fit_messages_to_input_budget(messages, tools_to_call_from)
+        if self.prompt_caching:
+            messages = self._mark_cacheable_prefix(messages)
         # Use self.kwargs as the base configuration
         completion_kwargs = {
             **self.kwargs,
@@ -359,6 +884,62 @@ class Model:
 
         return completion_kwargs
 
+    def _fit_messages_to_input_budget(
+        self, messages: list[dict[str, str | list[dict]]], tools_to_call_from: list[Tool] | None = None
+    ) -> list[dict[str, str | list[dict]]]:
+        """
+        Count the input tokens of a request with the token counter, and check that they fit in `max_input_tokens`.
+
+        If they do not, the request fails before being sent, unless `trim_messages` is set: then the oldest messages
+        after the system prompt and the task are dropped until the prompt fits, keeping the history starting with an
+        assistant message.
+        """
+        tools = [get_tool_json_schema(tool) for tool in tools_to_call_from or []]
+        message_token_counts = [self.token_counter.count_message_tokens(message) for message in messages]
+        token_count = sum(message_token_counts) + self.token_counter.count_tools_tokens(tools)
+        if self.max_input_tokens is not None and token_count > self.max_input_tokens and self.trim_messages:
+            # Keep the system prompt and the task, then the most recent messages
+            start = next((i for i, message in enumerate(messages) if message["role"] != MessageRole.SYSTEM), 0) + 1
+            end = start
+            while token_count > self.max_input_tokens and end < len(messages) - 1:
+                token_count -= message_token_counts[end]
+                end += 1
+                while end < len(messages) - 1 and messages[end]["role"] != MessageRole.ASSISTANT:
+                    token_count -= message_token_counts[end]
+                    end += 1
+            if end > start:
+                logger.warning(
+                    f"Dropped the {end - start} oldest messages to fit the prompt in {self.max_input_tokens} tokens."
+                )
+                messages = messages[:start] + messages[end:]
+        self.last_estimated_input_token_count = token_count
+        if self.max_input_tokens is not None and token_count > self.max_input_tokens:
+            raise ValueError(
+                f"The prompt has an estimated {token_count} tokens, more than the budget of {self.max_input_tokens} "
+                "input tokens of the model: reduce the memory of the agent, or pass `trim_messages=True` to the model "
+                "to drop the oldest messages."
+            )
+        return messages
+
+    def _mark_cacheable_prefix(self, messages: list[dict[str, str | list[dict]]]) -> list[dict[str, str | list[dict]]]:
+        """
+        Mark the prefix of the messages that the provider should cache, when prompt caching is enabled.
+
+        Agents only append messages to their history, so the messages of a step start with the messages of the
+        previous step: the prompt is cached up to its end. By default, nothing is marked, which suits providers with
+        automatic prefix caching like OpenAI. The returned messages must not modify the content elements of the given
+        ones, which are shared with the message list cache.
+        """
+        return messages
+
+    def get_message_token_counts(self, message: ChatMessage) -> tuple[int | None, int | None]:
+        """
+        Return the input and output token counts of the call that returned `message`. They are read from its raw
+        response when the model reports usage there, so that they stay right when other calls to the model run
+        concurrently. Otherwise, they are the token counts of the last call to the model.
+        """
+        return self.last_input_token_count, self.last_output_token_count
+
     def get_token_counts(self) -> dict[str, int]:
         if self.last_input_token_count is None or self.last_output_token_count is None:
             raise ValueError("Token counts are not available")
@@ -394,6 +975,27 @@ class Model:
         """
         raise NotImplementedError("This method must be implemented in child classes")
 
+    async def agenerate(
+        self,
+        messages: list[dict[str, str | list[dict]]],
+        stop_sequences: list[str] | None = None,
+        grammar: str | None = None,
+        tools_to_call_from: list[Tool] | None = None,
+        **kwargs,
+    ) -> ChatMessage:
+        """Async version of `generate`.
+
+        Models backed by an async client override this method: by default, `generate` runs in a worker thread.
+        """
+        return await asyncio.to_thread(
+            self.generate,
+            messages,
+            stop_sequences=stop_sequences,
+            grammar=grammar,
+            tools_to_call_from=tools_to_call_from,
+            **kwargs,
+        )
+
     def __call__(self, *args, **kwargs):
         return self.generate(*args, **kwargs)
 
@@ -420,6 +1022,13 @@ class Model:
             "last_output_token_count": self.last_output_token_count,
             "model_id": self.model_id,
         }
+        if self.image_encoding_policy is not None:
+            model_dictionary["image_encoding_policy"] = asdict(self.image_encoding_policy)
+        if self.prompt_caching:
+            model_dictionary["prompt_caching"] = True
+        if self.max_input_tokens is not None:
+            model_dictionary["max_input_tokens"] = self.max_input_tokens
+            model_dictionary["trim_messages"] = self.trim_messages
         for attribute in [
             "custom_role_conversion",
             "temperature",
@@ -461,12 +1070,18 @@ class Model:
 class VLLMModel(Model):
     """Model to use [vLLM](https://docs.vllm.ai/) for fast LLM inference and serving.
 
+    The model runs on the asynchronous engine of vLLM, in an event loop of its own: concurrent calls, for instance
+    from agents sharing the model, are batched together by the engine, and `generate_stream` streams the generated
+    text as it is produced. The token ids of the prompt and output of each call are kept in the `raw` field of its
+    message, see [`~VLLMModel.get_message_token_counts`]. Grammars of type `"json"` or `"regex"` are enforced by the
+    guided decoding of vLLM.
+
     Parameters:
         model_id (`str`):
             The Hugging Face model ID to be used for inference.
             This can be a path or model identifier from the Hugging Face model hub.
         model_kwargs (`dict[str, Any]`, *optional*):
-            Additional keyword arguments to pass to the vLLM model (like revision, max_model_len, etc.).
+            Additional keyword arguments to pass to the vLLM engine (like revision, max_model_len, etc.).
     """
 
     def __init__(
@@ -478,13 +1093,20 @@ class VLLMModel(Model):
         if not _is_package_available("vllm"):
             raise ModuleNotFoundError("Please install 'vllm' extra to use VLLMModel: `pip install 'smolagents[vllm]'`")
 
-        from vllm import LLM  # type: ignore
+        from vllm import AsyncEngineArgs, AsyncLLMEngine  # type: ignore
         from vllm.transformers_utils.tokenizer import get_tokenizer  # type: ignore
 
         self.model_kwargs = model_kwargs or {}
         super().__init__(**kwargs)
         self.model_id = model_id
-        self.model = LLM(model=model_id, **self.model_kwargs)
+        self._loop = asyncio.new_event_loop()
+        Thread(target=self._loop.run_forever, daemon=True).start()
+
+        async def create_engine():
+            # The engine is created in its event loop, where it runs its background tasks
+            return AsyncLLMEngine.from_engine_args(AsyncEngineArgs(model=model_id, **self.model_kwargs))
+
+        self.model = asyncio.run_coroutine_threadsafe(create_engine(), self._loop).result()
         assert self.model is not None
         self.tokenizer = get_tokenizer(model_id)
         self._is_vlm = False  # VLLMModel does not support vision models yet.
@@ -500,20 +1122,30 @@ class VLLMModel(Model):
 
         destroy_model_parallel()
         if self.model is not None:
-            # taken from https://github.com/vllm-project/vllm/issues/1908#issuecomment-2076870351
-            del self.model.llm_engine.model_executor.driver_worker
+            # The V1 engine of vLLM has `shutdown`, the V0 one `shutdown_background_loop`
+            shutdown = getattr(self.model, "shutdown", None) or getattr(self.model, "shutdown_background_loop", None)
+            if shutdown is not None:
+
+                async def shutdown_engine():
+                    shutdown()
+
+                # The engine runs its background tasks in its event loop: it is shut down there
+                asyncio.run_coroutine_threadsafe(shutdown_engine(), self._loop).result()
+            self.model = None
+        self._loop.call_soon_threadsafe(self._loop.stop)
         gc.collect()
         destroy_distributed_environment()
         torch.cuda.empty_cache()
 
-    def generate(
+    def _prepare_vllm_request(
         self,
         messages: list[dict[str, str | list[dict]]],
         stop_sequences: list[str] | None = None,
         grammar: str | None = None,
         tools_to_call_from: list[Tool] | None = None,
         **kwargs,
-    ) -> ChatMessage:
+    ) -> tuple[str, Any, dict[str, Any]]:
+        """Return the prompt, the sampling parameters and the completion kwargs of a request."""
         from vllm import SamplingParams  # type: ignore
 
         completion_kwargs = self._prepare_completion_kwargs(
@@ -528,6 +1160,7 @@ class VLLMModel(Model):
         prepared_stop_sequences = completion_kwargs.pop("stop", [])
         tools = completion_kwargs.pop("tools", None)
         completion_kwargs.pop("tool_choice", None)
+        grammar = completion_kwargs.pop("grammar", None)
 
         if tools_to_call_from is not None:
             prompt = self.tokenizer.apply_chat_template(
@@ -547,20 +1180,142 @@ class VLLMModel(Model):
             temperature=kwargs.get("temperature", 0.0),
             max_tokens=kwargs.get("max_tokens", 2048),
             stop=prepared_stop_sequences,
+            # Only passed with a grammar, for the versions of vLLM without guided decoding
+            **({"guided_decoding": self._get_guided_decoding_params(grammar)} if grammar is not None else {}),
         )
+        return prompt, sampling_params, completion_kwargs
+
+    @staticmethod
+    def _get_guided_decoding_params(grammar: dict[str, Any]):
+        from vllm.sampling_params import GuidedDecodingParams  # type: ignore
 
-        out = self.model.generate(
-            prompt,
-            sampling_params=sampling_params,
+        if not isinstance(grammar, dict) or grammar.get("type") not in ("json", "regex"):
+            raise ValueError(f"VLLMModel only supports grammars of type 'json' or 'regex', got: {grammar}")
+        return GuidedDecodingParams(**{grammar["type"]: grammar["value"]})
+
+    async def _generate_on_engine_loop(
+        self, prompt: str, sampling_params, token_ids: dict[str, list[int]] | None = None
+    ) -> AsyncGenerator[ChatMessageStreamDelta]:
+        """
+        Stream the text generated by the engine: must run in the event loop of the engine. The token ids of the prompt
+        and output of the request are stored in `token_ids` once it is finished.
+        """
+        text = ""
+        request_outputs = self.model.generate(prompt, sampling_params, request_id=str(uuid.uuid4()))
+        try:
+            # Outputs are cumulative: each one holds the whole text and tokens generated so far
+            async for request_output in request_outputs:
+                output = request_output.outputs[0]
+                if len(output.text) > len(text):
+                    yield ChatMessageStreamDelta(content=output.text[len(text) :])
+                    text = output.text
+                if request_output.finished:
+                    if token_ids is not None:
+                        token_ids["prompt_token_ids"] = list(request_output.prompt_token_ids)
+                        token_ids["output_token_ids"] = list(output.token_ids)
+                    self.last_input_token_count = len(request_output.prompt_token_ids)
+                    self.last_output_token_count = len(output.token_ids)
+        finally:
+            # Closing the outputs of an unfinished request aborts it in the engine
+            await request_outputs.aclose()
+
+    async def _generate_message_on_engine_loop(self, prompt: str, sampling_params, completion_kwargs) -> ChatMessage:
+        token_ids: dict[str, list[int]] = {}
+        output_text = "".join(
+            [
+                delta.content  # type: ignore
+                async for delta in self._generate_on_engine_loop(prompt, sampling_params, token_ids)
+            ]
         )
-        output_text = out[0].outputs[0].text
-        self.last_input_token_count = len(out[0].prompt_token_ids)
-        self.last_output_token_count = len(out[0].outputs[0].token_ids)
         return ChatMessage(
             role=MessageRole.ASSISTANT,
             content=output_text,
-            raw={"out": output_text, "completion_kwargs": completion_kwargs},
+            raw={"out": output_text, "completion_kwargs": completion_kwargs, **token_ids},
+        )
+
+    def get_message_token_counts(self, message: ChatMessage) -> tuple[int | None, int | None]:
+        """
+        Return the input and output token counts of the call that returned `message`, from the token ids of its
+        request, which stay right when other calls are served concurrently by the engine.
+        """
+        if not isinstance(message.raw, dict) or "prompt_token_ids" not in message.raw:
+            return super().get_message_token_counts(message)
+        return len(message.raw["prompt_token_ids"]), len(message.raw["output_token_ids"])
+
+    def generate(
+        self,
+        messages: list[dict[str, str | list[dict]]],
+        stop_sequences: list[str] | None = None,
+        grammar: str | None = None,
+        tools_to_call_from: list[Tool] | None = None,
+        **kwargs,
+    ) -> ChatMessage:
+        prompt, sampling_params, completion_kwargs = self._prepare_vllm_request(
+            messages, stop_sequences=stop_sequences, grammar=grammar, tools_to_call_from=tools_to_call_from, **kwargs
+        )
+        return asyncio.run_coroutine_threadsafe(
+            self._generate_message_on_engine_loop(prompt, sampling_params, completion_kwargs), self._loop
+        ).result()
+
+    def generate_stream(
+        self,
+        messages: list[dict[str, str | list[dict]]],
+        stop_sequences: list[str] | None = None,
+        grammar: str | None = None,
+        tools_to_call_from: list[Tool] | None = None,
+        **kwargs,
+    ) -> Generator[ChatMessageStreamDelta]:
+        prompt, sampling_params, _ = self._prepare_vllm_request(
+            messages, stop_sequences=stop_sequences, grammar=grammar, tools_to_call_from=tools_to_call_from, **kwargs
+        )
+        stream = self._generate_on_engine_loop(prompt, sampling_params)
+        try:
+            while True:
+                try:
+                    yield asyncio.run_coroutine_threadsafe(stream.__anext__(), self._loop).result()
+                except StopAsyncIteration:
+                    break
+        finally:
+            # Closing the stream early aborts the request in the engine
+            asyncio.run_coroutine_threadsafe(stream.aclose(), self._loop).result()
+
+    async def agenerate(
+        self,
+        messages: list[dict[str, str | list[dict]]],
+        stop_sequences: list[str] | None = None,
+        grammar: str | None = None,
+        tools_to_call_from: list[Tool] | None = None,
+        **kwargs,
+    ) -> ChatMessage:
+        prompt, sampling_params, completion_kwargs = self._prepare_vllm_request(
+            messages, stop_sequences=stop_sequences, grammar=grammar, tools_to_call_from=tools_to_call_from, **kwargs
+        )
+        return await asyncio.wrap_future(
+            asyncio.run_coroutine_threadsafe(
+                self._generate_message_on_engine_loop(prompt, sampling_params, completion_kwargs), self._loop
+            )
+        )
+
+    async def agenerate_stream(
+        self,
+        messages: list[dict[str, str | list[dict]]],
+        stop_sequences: list[str] | None = None,
+        grammar: str | None = None,
+        tools_to_call_from: list[Tool] | None = None,
+        **kwargs,
+    ) -> AsyncGenerator[ChatMessageStreamDelta]:
+        prompt, sampling_params, _ = self._prepare_vllm_request(
+            messages, stop_sequences=stop_sequences, grammar=grammar, tools_to_call_from=tools_to_call_from, **kwargs
         )
+        stream = self._generate_on_engine_loop(prompt, sampling_params)
+        try:
+            while True:
+                try:
+                    yield await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(stream.__anext__(), self._loop))
+                except StopAsyncIteration:
+                    break
+        finally:
+            await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(stream.aclose(), self._loop))
 
 
 class MLXModel(Model):
@@ -601,6 +1356,9 @@ class MLXModel(Model):
     ```
     """
 
+    # Generations share the weights and caches of the model in memory
+    thread_safe = False
+
     def __init__(
         self,
         model_id: str,
@@ -654,10 +1412,11 @@ class MLXModel(Model):
         self.last_input_token_count = len(prompt_ids)
         self.last_output_token_count = 0
         text = ""
+        stop_sequence_matcher = StopSequenceMatcher(stops)
         for response in self.stream_generate(self.model, self.tokenizer, prompt=prompt_ids, **completion_kwargs):
             self.last_output_token_count += 1
             text += response.text
-            if any((stop_index := text.rfind(stop)) != -1 for stop in stops):
+            if (stop_index := stop_sequence_matcher.feed(response.text)) is not None:
                 text = text[:stop_index]
                 break
 
@@ -666,6 +1425,16 @@ class MLXModel(Model):
         )
 
 
+@dataclass
+class TransformersPromptCache:
+    """Tokens of the last prompt of a [`TransformersModel`] with prompt caching, along with its key-value cache."""
+
+    prompt_ids: "torch.Tensor"
+    # Tokens of the prompt and of the generated output
+    sequence_ids: "torch.Tensor"
+    past_key_values: Any
+
+
 class TransformersModel(Model):
     """A class that uses Hugging Face's Transformers library for language model interaction.
 
@@ -684,6 +1453,15 @@ class TransformersModel(Model):
             The torch_dtype to initialize your model with.
         trust_remote_code (bool, default `False`):
             Some models on the Hub require running remote code: for this model, you would have to set this flag to True.
+        prompt_caching (bool, default `False`):
+            Whether to keep the key-value cache and the token ids of the last prompt, so that the next prompt only
+            requires prefilling its tokens after the longest common prefix. Agents only append messages to their
+            history, so this saves recomputing the whole history at each step. Only supported for text models.
+            Concurrent calls are safe, but only one of them reuses the cache: the others prefill their whole prompt.
+        max_batch_size (int, *optional*):
+            If set, concurrent calls to `generate` and `generate_stream`, for instance from agents sharing this model,
+            are served together by a [`TransformersBatchScheduler`] with up to this number of sequences per batch.
+            Only supported for text models, without prompt caching.
         kwargs (dict, *optional*):
             Any additional keyword arguments that you want to use in model.generate(), for instance `max_new_tokens` or `device`.
         **kwargs:
@@ -706,12 +1484,17 @@ class TransformersModel(Model):
     ```
     """
 
+    # Generations share the weights and caches of the model in memory
+    thread_safe = False
+
     def __init__(
         self,
         model_id: str | None = None,
         device_map: str | None = None,
         torch_dtype: str | None = None,
         trust_remote_code: bool = False,
+        prompt_caching: bool = False,
+        max_batch_size: int | None = None,
         **kwargs,
     ):
         try:
@@ -774,26 +1557,49 @@ class TransformersModel(Model):
                 raise e
         except Exception as e:
             raise ValueError(f"Failed to load tokenizer and model for {model_id=}: {e}") from e
-        super().__init__(flatten_messages_as_text=not self._is_vlm, model_id=model_id, **kwargs)
+        if prompt_caching and self._is_vlm:
+            logger.warning("Prompt caching is not supported for vision language models: it is disabled.")
+            prompt_caching = False
+        super().__init__(
+            flatten_messages_as_text=not self._is_vlm, model_id=model_id, prompt_caching=prompt_caching, **kwargs
+        )
+        self._prompt_cache: TransformersPromptCache | None = None
+        self._prompt_cache_lock = Lock()
+        self._token_texts: dict[int, str] = {}
+        self.batch_scheduler: TransformersBatchScheduler | None = None
+        if max_batch_size is not None:
+            if self._is_vlm or self.prompt_caching:
+                raise ValueError("Batching is only supported for text models, without prompt caching.")
+            self.batch_scheduler = TransformersBatchScheduler(self, max_batch_size=max_batch_size)
+            # Concurrent calls are served together by the scheduler
+            self.thread_safe = True
 
     def make_stopping_criteria(self, stop_sequences: list[str], tokenizer) -> "StoppingCriteriaList":
+        import torch
         from transformers import StoppingCriteria, StoppingCriteriaList
 
+        # Text of each token, shared by the criteria of all generations as decoding is the costly part
+        token_texts = self._token_texts
+
         class StopOnStrings(StoppingCriteria):
             def __init__(self, stop_strings: list[str], tokenizer):
                 self.stop_strings = stop_strings
                 self.tokenizer = tokenizer
-                self.stream = ""
+                self.matchers: list[StopSequenceMatcher] = []
 
             def reset(self):
-                self.stream = ""
+                self.matchers = []
 
             def __call__(self, input_ids, scores, **kwargs):
-                generated = self.tokenizer.decode(input_ids[0][-1], skip_special_tokens=True)
-                self.stream += generated
-                if any([self.stream.endswith(stop_string) for stop_string in self.stop_strings]):
-                    return True
-                return False
+                if not self.matchers:
+                    # One matcher per sequence of the batch, as the criterion is called with the new token of each
+                    self.matchers = [StopSequenceMatcher(self.stop_strings) for _ in range(input_ids.shape[0])]
+                is_done = []
+                for token_id, matcher in zip(input_ids[:, -1].tolist(), self.matchers):
+                    if token_id not in token_texts:
+                        token_texts[token_id] = self.tokenizer.decode(token_id, skip_special_tokens=True)
+                    is_done.append(matcher.feed(token_texts[token_id]) is not None)
+                return torch.tensor(is_done, dtype=torch.bool, device=input_ids.device)
 
         return StoppingCriteriaList([StopOnStrings(stop_sequences, tokenizer)])
 
@@ -822,17 +1628,23 @@ class TransformersModel(Model):
             or self.kwargs.get("max_tokens")
             or 1024
         )
-        prompt_tensor = (self.processor if hasattr(self, "processor") else self.tokenizer).apply_chat_template(
-            messages,  # type: ignore
-            tools=[get_tool_json_schema(tool) for tool in tools_to_call_from] if tools_to_call_from else None,
-            return_tensors="pt",
-            add_generation_prompt=True if tools_to_call_from else False,
-            tokenize=True,
-            return_dict=True,
-        )
-        prompt_tensor = prompt_tensor.to(self.model.device)  # type: ignore
-        if hasattr(prompt_tensor, "input_ids"):
-            prompt_tensor = prompt_tensor["input_ids"]
+        tools = [get_tool_json_schema(tool) for tool in tools_to_call_from] if tools_to_call_from else None
+        if self.prompt_caching:
+            prompt_tensor, prompt_cache = self._prepare_cached_prompt(messages, tools)
+            completion_kwargs["past_key_values"] = prompt_cache.past_key_values
+            completion_kwargs["prompt_cache"] = prompt_cache
+        else:
+            prompt_tensor = (self.processor if hasattr(self, "processor") else self.tokenizer).apply_chat_template(
+                messages,  # type: ignore
+                tools=tools,
+                return_tensors="pt",
+                add_generation_prompt=True if tools_to_call_from else False,
+                tokenize=True,
+                return_dict=True,
+            )
+            prompt_tensor = prompt_tensor.to(self.model.device)  # type: ignore
+            if hasattr(prompt_tensor, "input_ids"):
+                prompt_tensor = prompt_tensor["input_ids"]
 
         model_tokenizer = self.processor.tokenizer if hasattr(self, "processor") else self.tokenizer
         stopping_criteria = (
@@ -846,6 +1658,57 @@ class TransformersModel(Model):
             **completion_kwargs,
         )
 
+    def _prepare_cached_prompt(
+        self, messages: list[dict], tools: list[dict] | None
+    ) -> tuple["torch.Tensor", TransformersPromptCache]:
+        """
+        Tokenize the prompt and select the key-value cache to generate from, reusing the one of the previous prompt
+        for their common prefix of tokens.
+
+        The cache is taken from the model until the generation ends, so that concurrent calls never share it.
+        """
+        import torch
+        from transformers import DynamicCache
+
+        prompt_ids = self.tokenizer.apply_chat_template(
+            messages,  # type: ignore
+            tools=tools,
+            add_generation_prompt=bool(tools),
+            tokenize=True,
+            return_tensors="pt",
+        )
+        if hasattr(prompt_ids, "input_ids"):
+            prompt_ids = prompt_ids["input_ids"]
+        # Tokenizing the whole prompt keeps the tokens identical to the ones without caching, as tokens can span the
+        # boundary between the previous prompt and the new text
+        prompt_ids = prompt_ids[0].to(dtype=torch.long, device="cpu")
+        with self._prompt_cache_lock:
+            previous, self._prompt_cache = self._prompt_cache, None
+
+        reused_token_count = 0
+        if previous is not None:
+            # The cache holds the keys and values of the previous prompt and of the tokens generated after it
+            cached_ids = previous.sequence_ids[: previous.past_key_values.get_seq_length()]
+            common_length = min(len(cached_ids), len(prompt_ids) - 1)  # At least one token must be prefilled
+            mismatches = (cached_ids[:common_length] != prompt_ids[:common_length]).nonzero()
+            reused_token_count = int(mismatches[0, 0]) if len(mismatches) > 0 else common_length
+        if reused_token_count > 0:
+            past_key_values = previous.past_key_values
+            past_key_values.crop(reused_token_count)
+        else:
+            past_key_values = DynamicCache()
+        self.last_cached_input_token_count = reused_token_count
+        prompt_cache = TransformersPromptCache(prompt_ids, prompt_ids, past_key_values)
+        return prompt_ids.unsqueeze(0).to(self.model.device), prompt_cache
+
+    def _generate(self, prompt_cache: TransformersPromptCache | None = None, **generation_kwargs) -> "torch.Tensor":
+        output_ids = self.model.generate(**generation_kwargs)
+        if prompt_cache is not None:
+            prompt_cache.sequence_ids = output_ids[0].cpu()
+            with self._prompt_cache_lock:
+                self._prompt_cache = prompt_cache
+        return output_ids
+
     def generate(
         self,
         messages: list[dict[str, str | list[dict]]],
@@ -862,10 +1725,11 @@ class TransformersModel(Model):
             **kwargs,
         )
         count_prompt_tokens = generation_kwargs["inputs"].shape[1]  # type: ignore
-        out = self.model.generate(
-            **generation_kwargs,
-        )
-        generated_tokens = out[0, count_prompt_tokens:]
+        if self.batch_scheduler is not None:
+            generated_tokens = self.batch_scheduler.submit(generation_kwargs, stop_sequences).result()
+        else:
+            out = self._generate(**generation_kwargs)
+            generated_tokens = out[0, count_prompt_tokens:]
         if hasattr(self, "processor"):
             output_text = self.processor.decode(generated_tokens, skip_special_tokens=True)
         else:
@@ -881,7 +1745,11 @@ class TransformersModel(Model):
             content=output_text,
             raw={
                 "out": output_text,
-                "completion_kwargs": {key: value for key, value in generation_kwargs.items() if key != "inputs"},
+                "completion_kwargs": {
+                    key: value
+                    for key, value in generation_kwargs.items()
+                    if key not in ("inputs", "past_key_values", "prompt_cache")
+                },
             },
         )
 
@@ -901,8 +1769,18 @@ class TransformersModel(Model):
             **kwargs,
         )
         count_prompt_tokens = generation_kwargs["inputs"].shape[1]  # type: ignore
-
-        thread = Thread(target=self.model.generate, kwargs={"streamer": self.streamer, **generation_kwargs})
+        if self.batch_scheduler is not None:
+            request = self.batch_scheduler.submit(generation_kwargs, stop_sequences, stream=True)
+            for new_text in request.streamer:
+                yield ChatMessageStreamDelta(content=new_text, tool_calls=None)
+            self.last_input_token_count = count_prompt_tokens
+            self.last_output_token_count = len(request.result())
+            return
+        outputs = []
+
+        thread = Thread(
+            target=lambda: outputs.append(self._generate(streamer=self.streamer, **generation_kwargs)),
+        )
         thread.start()
 
         self.last_output_token_count = 0
@@ -910,15 +1788,440 @@ class TransformersModel(Model):
         # Generate with streaming
         for new_text in self.streamer:
             yield ChatMessageStreamDelta(content=new_text, tool_calls=None)
-            self.last_output_token_count += 1
 
         self.last_input_token_count = count_prompt_tokens
         thread.join()
+        # Chunks of text can span several tokens: count the generated tokens
+        if outputs:
+            self.last_output_token_count = outputs[0].shape[1] - count_prompt_tokens
+
+
+class TransformersBatchRequest:
+    """Generation request served by a [`TransformersBatchScheduler`]."""
+
+    def __init__(self, prompt_ids: list[int], max_new_tokens: int, stop_sequences: list[str] | None, sampling: dict):
+        self.prompt_ids = prompt_ids
+        self.max_new_tokens = max_new_tokens
+        self.stop_sequence_matcher = StopSequenceMatcher(stop_sequences) if stop_sequences else None
+        self.sampling = sampling
+        self.output_ids: list[int] = []
+        self.streamer: "TextIteratorStreamer | None" = None
+        self.error: BaseException | None = None
+        self._done = Event()
+
+    @property
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    def result(self, timeout: float | None = None) -> list[int]:
+        """Wait for the generation to finish and return the generated token ids."""
+        if not self._done.wait(timeout):
+            raise TimeoutError("Generation did not finish in time.")
+        if self.error is not None:
+            raise self.error
+        return self.output_ids
+
+    def finish(self, error: BaseException | None = None):
+        self.error = error
+        if self.streamer is not None:
+            self.streamer.end()
+        self._done.set()
+
+
+class TransformersBatchScheduler:
+    """
+    Continuous batching of the generations of a [`TransformersModel`].
 
+    Requests submitted concurrently are decoded together, one token per sequence at each forward pass of the model.
+    New requests join the batch as soon as they are submitted: their prompts are prefilled together, then their
+    key-value caches are left-padded to the length of the caches of the batch and concatenated to them. Finished
+    requests leave the batch at once, and the padding that no remaining sequence needs is dropped.
 
-class ApiModel(Model):
+    Only greedy decoding and sampling with `temperature`, `top_k` and `top_p` are supported.
+
+    Args:
+        model ([`TransformersModel`]): Model to generate with.
+        max_batch_size (`int`, default `8`): Maximum number of sequences decoded together.
     """
-    Base class for API-based language models.
+
+    sampling_parameters = ("do_sample", "temperature", "top_k", "top_p")
+
+    def __init__(self, model: "TransformersModel", max_batch_size: int = 8):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self._pending: deque[TransformersBatchRequest] = deque()
+        self._lock = Lock()
+        self._thread: Thread | None = None
+        # Requests of the batch, with their attention masks, key-value caches and next tokens
+        self._requests: list[TransformersBatchRequest] = []
+        self._attention_mask = None
+        self._past_key_values = None
+        self._next_tokens = None
+
+    def submit(
+        self, generation_kwargs: dict[str, Any], stop_sequences: list[str] | None = None, stream: bool = False
+    ) -> TransformersBatchRequest:
+        """
+        Add a generation to the batch.
+
+        Args:
+            generation_kwargs (`dict[str, Any]`): Arguments of `model.generate` prepared by the model, with the prompt
+                as `inputs`.
+            stop_sequences (`list[str]`, *optional*): Sequences that stop the generation when generated.
+            stream (`bool`, default `False`): Whether to stream the generated text with the `streamer` of the request.
+        """
+        from transformers import TextIteratorStreamer
+
+        unsupported_parameters = set(generation_kwargs) - {
+            "inputs",
+            "use_cache",
+            "stopping_criteria",
+            "max_new_tokens",
+            *self.sampling_parameters,
+        }
+        if unsupported_parameters:
+            raise ValueError(f"Generation parameters not supported with batching: {sorted(unsupported_parameters)}")
+        generation_config = self.model.model.generation_config
+        request = TransformersBatchRequest(
+            prompt_ids=generation_kwargs["inputs"][0].tolist(),
+            max_new_tokens=generation_kwargs["max_new_tokens"],
+            stop_sequences=stop_sequences,
+            sampling={
+                name: generation_kwargs.get(name, getattr(generation_config, name, None))
+                for name in self.sampling_parameters
+            },
+        )
+        if stream:
+            request.streamer = TextIteratorStreamer(self.model.tokenizer, skip_special_tokens=True)
+        with self._lock:
+            self._pending.append(request)
+            if self._thread is None:
+                self._thread = Thread(target=self._run, daemon=True)
+                self._thread.start()
+        return request
+
+    def _run(self):
+        import torch
+
+        while True:
+            with self._lock:
+                if not self._pending and not self._requests:
+                    # Stop when idle: the next request starts a new thread
+                    self._thread = None
+                    return
+                new_requests = []
+                while self._pending and len(self._requests) + len(new_requests) < self.max_batch_size:
+                    new_requests.append(self._pending.popleft())
+            try:
+                with torch.inference_mode():
+                    if new_requests:
+                        self._add_requests(new_requests)
+                    else:
+                        self._decode()
+            except Exception as e:
+                for request in self._requests + new_requests:
+                    if not request.done:
+                        request.finish(error=e)
+                self._reset_batch()
+
+    def _reset_batch(self):
+        self._requests, self._attention_mask, self._past_key_values, self._next_tokens = [], None, None, None
+
+    def _add_requests(self, requests: list[TransformersBatchRequest]):
+        """Prefill the prompts of new requests, and add them to the batch."""
+        import torch
+
+        device = self.model.model.device
+        prompt_length = max(len(request.prompt_ids) for request in requests)
+        input_ids = torch.zeros((len(requests), prompt_length), dtype=torch.long)
+        attention_mask = torch.zeros((len(requests), prompt_length), dtype=torch.long)
+        for i, request in enumerate(requests):
+            input_ids[i, prompt_length - len(request.prompt_ids) :] = torch.tensor(request.prompt_ids)
+            attention_mask[i, prompt_length - len(request.prompt_ids) :] = 1
+        input_ids, attention_mask = input_ids.to(device), attention_mask.to(device)
+        past_key_values = self._new_cache()
+        logits = self.model.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=(attention_mask.cumsum(-1) - 1).clamp(min=0),
+            past_key_values=past_key_values,
+            use_cache=True,
+        ).logits[:, -1]
+        next_tokens = self._sample(logits, requests)
+        if self._requests:
+            # Left-pad the shortest of the two batches, so that they can be concatenated
+            length = max(attention_mask.shape[1], self._attention_mask.shape[1])
+            past_key_values = self._new_cache(
+                [
+                    (torch.cat([old_keys, new_keys]), torch.cat([old_values, new_values]))
+                    for (old_keys, old_values), (new_keys, new_values) in zip(
+                        self._pad_cache(self._past_key_values, length), self._pad_cache(past_key_values, length)
+                    )
+                ]
+            )
+            attention_mask = torch.cat(
+                [
+                    self._pad_attention_mask(self._attention_mask, length),
+                    self._pad_attention_mask(attention_mask, length),
+                ]
+            )
+            next_tokens = torch.cat([self._next_tokens, next_tokens])
+        self._requests = self._requests + requests
+        self._attention_mask, self._past_key_values, self._next_tokens = attention_mask, past_key_values, next_tokens
+        self._process_new_tokens(next_tokens[-len(requests) :], requests)
+        self._remove_finished_requests()
+
+    def _decode(self):
+        """Generate the next token of all the sequences of the batch."""
+        import torch
+
+        positions = self._attention_mask.sum(-1, keepdim=True)
+        self._attention_mask = torch.cat([self._attention_mask, torch.ones_like(positions)], dim=-1)
+        logits = self.model.model(
+            input_ids=self._next_tokens.unsqueeze(-1),
+            attention_mask=self._attention_mask,
+            position_ids=positions,
+            past_key_values=self._past_key_values,
+            use_cache=True,
+        ).logits[:, -1]
+        self._next_tokens = self._sample(logits, self._requests)
+        self._process_new_tokens(self._next_tokens, self._requests)
+        self._remove_finished_requests()
+
+    def _sample(self, logits: "torch.Tensor", requests: list[TransformersBatchRequest]) -> "torch.Tensor":
+        import torch
+
+        next_tokens = logits.argmax(-1)
+        for i, request in enumerate(requests):
+            sampling = request.sampling
+            if not sampling["do_sample"]:
+                continue
+            scores = logits[i].float() / (sampling["temperature"] or 1.0)
+            if sampling["top_k"]:
+                top_k = min(sampling["top_k"], scores.shape[-1])
+                scores[scores < torch.topk(scores, top_k).values[-1]] = -float("inf")
+            if sampling["top_p"] is not None and sampling["top_p"] < 1.0:
+                sorted_scores, sorted_indices = torch.sort(scores, descending=True)
+                probabilities = sorted_scores.softmax(-1)
+                # Keep the most likely tokens until their cumulative probability reaches top_p
+                removed = probabilities.cumsum(-1) - probabilities >= sampling["top_p"]
+                scores[sorted_indices[removed]] = -float("inf")
+            next_tokens[i] = torch.multinomial(scores.softmax(-1), 1)[0]
+        return next_tokens
+
+    def _process_new_tokens(self, next_tokens: "torch.Tensor", requests: list[TransformersBatchRequest]):
+        import torch
+
+        eos_token_ids = self.model.model.generation_config.eos_token_id
+        if eos_token_ids is None:
+            eos_token_ids = self.model.tokenizer.eos_token_id
+        eos_token_ids = set(eos_token_ids if isinstance(eos_token_ids, list) else [eos_token_ids])
+        token_texts = self.model._token_texts
+        for token_id, request in zip(next_tokens.tolist(), requests):
+            request.output_ids.append(token_id)
+            if request.streamer is not None:
+                request.streamer.put(torch.tensor([token_id]))
+            is_done = token_id in eos_token_ids or len(request.output_ids) >= request.max_new_tokens
+            if request.stop_sequence_matcher is not None and not is_done:
+                if token_id not in token_texts:
+                    token_texts[token_id] = self.model.tokenizer.decode(token_id, skip_special_tokens=True)
+                is_done = request.stop_sequence_matcher.feed(token_texts[token_id]) is not None
+            if is_done:
+                request.finish()
+
+    def _remove_finished_requests(self):
+        kept_indices = [i for i, request in enumerate(self._requests) if not request.done]
+        if len(kept_indices) == len(self._requests):
+            return
+        if not kept_indices:
+            self._reset_batch()
+            return
+        self._requests = [self._requests[i] for i in kept_indices]
+        attention_mask = self._attention_mask[kept_indices]
+        # Drop the padding columns that none of the remaining sequences attends to
+        first_column = int(attention_mask.any(0).nonzero()[0, 0])
+        self._attention_mask = attention_mask[:, first_column:]
+        self._past_key_values = self._new_cache(
+            [
+                (keys[kept_indices, :, first_column:], values[kept_indices, :, first_column:])
+                for keys, values in self._get_cache_layers(self._past_key_values)
+            ]
+        )
+        self._next_tokens = self._next_tokens[kept_indices]
+
+    @staticmethod
+    def _new_cache(layers: list[tuple["torch.Tensor", "torch.Tensor"]] | None = None):
+        from transformers import DynamicCache
+
+        past_key_values = DynamicCache()
+        for layer_index, (keys, values) in enumerate(layers or []):
+            past_key_values.update(keys, values, layer_index)
+        return past_key_values
+
+    @staticmethod
+    def _get_cache_layers(past_key_values) -> list[tuple["torch.Tensor", "torch.Tensor"]]:
+        if hasattr(past_key_values, "layers"):
+            return [(layer.keys, layer.values) for layer in past_key_values.layers]
+        return list(zip(past_key_values.key_cache, past_key_values.value_cache))  # transformers < 4.54
+
+    def _pad_cache(self, past_key_values, length: int) -> list[tuple["torch.Tensor", "torch.Tensor"]]:
+        import torch.nn.functional as F
+
+        return [
+            (F.pad(keys, (0, 0, length - keys.shape[-2], 0)), F.pad(values, (0, 0, length - values.shape[-2], 0)))
+            for keys, values in self._get_cache_layers(past_key_values)
+        ]
+
+    @staticmethod
+    def _pad_attention_mask(attention_mask: "torch.Tensor", length: int) -> "torch.Tensor":
+        import torch.nn.functional as F
+
+        return F.pad(attention_mask, (length - attention_mask.shape[-1], 0))
+
+
+@dataclass(frozen=True)
+class ConnectionPoolConfig:
+    """
+    Size and keep-alive of the pool of HTTP connections of an API client.
+
+    Args:
+        max_connections (`int`, default `100`): Maximum number of connections open at once.
+        max_keepalive_connections (`int`, default `20`): Maximum number of idle connections kept open for reuse.
+        keepalive_expiry (`float`, default `5.0`): Time in seconds after which an idle connection is closed.
+    """
+
+    max_connections: int = 100
+    max_keepalive_connections: int = 20
+    keepalive_expiry: float = 5.0
+
+
+class ClientRegistry:
+    """
+    Process-wide registry of API clients: models created with the same client class and arguments, like endpoint and
+    credentials, share one client and therefore its pool of connections, instead of opening new ones each time.
+
+    The numbers of clients created and reused are counted, see [`~ClientRegistry.get_metrics`].
+    """
+
+    def __init__(self):
+        self._clients: dict[str, Any] = {}
+        # Async clients, by event loop
+        self._event_loop_clients: dict[asyncio.AbstractEventLoop, dict[str, Any]] = {}
+        self._lock = Lock()
+        self.created = 0
+        self.reused = 0
+
+    def get_client(
+        self, key: Any, create_client: Callable[[], Any], event_loop: asyncio.AbstractEventLoop | None = None
+    ) -> Any:
+        """
+        Return the client registered under `key`, or register the one returned by `create_client`.
+
+        Args:
+            key (`Any`): Arguments identifying the client. They are serialized, so they do not need to be hashable.
+            create_client (`Callable[[], Any]`): Function creating the client.
+            event_loop (`asyncio.AbstractEventLoop`, *optional*): Event loop an async client is bound to. Async clients
+                are only shared within their event loop, as their connections cannot be used from another one, and
+                are forgotten once it is closed.
+        """
+        key = hashlib.sha256(
+            json.dumps(key, sort_keys=True, default=_client_key_default).encode()
+        ).hexdigest()  # The arguments include credentials: only their hash is kept
+        with self._lock:
+            if event_loop is None:
+                clients = self._clients
+            else:
+                for closed_event_loop in [loop for loop in self._event_loop_clients if loop.is_closed()]:
+                    del self._event_loop_clients[closed_event_loop]
+                clients = self._event_loop_clients.setdefault(event_loop, {})
+            if (client := clients.get(key)) is not None:
+                self.reused += 1
+                return client
+            client = clients[key] = create_client()
+            self.created += 1
+            return client
+
+    def get_metrics(self) -> dict[str, int]:
+        """Return the number of registered clients, and how many times clients were created and reused."""
+        with self._lock:
+            client_count = len(self._clients) + sum(len(clients) for clients in self._event_loop_clients.values())
+            return {"clients": client_count, "created": self.created, "reused": self.reused}
+
+    def clear(self):
+        """Forget the registered clients, which stay usable by the models holding them, and reset the metrics."""
+        with self._lock:
+            self._clients.clear()
+            self._event_loop_clients.clear()
+            self.created = self.reused = 0
+
+
+client_registry = ClientRegistry()
+
+
+def _get_running_event_loop() -> asyncio.AbstractEventLoop | None:
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+
+class _EnteredAsyncClient:
+    """
+    Async client opened by an async context manager, like the clients of aiobotocore: it is entered on first use and
+    kept open until `close`, so that all the requests reuse its connections.
+    """
+
+    def __init__(self, client_context: Any):
+        self._client_context = client_context
+        self._client = None
+        self._lock = asyncio.Lock()
+
+    async def get(self) -> Any:
+        async with self._lock:
+            if self._client is None:
+                self._client = await self._client_context.__aenter__()
+        return self._client
+
+    async def close(self):
+        async with self._lock:
+            if self._client is not None:
+                self._client = None
+                await self._client_context.__aexit__(None, None, None)
+
+
+def _create_aiobotocore_client(session: Any = None, **client_kwargs) -> _EnteredAsyncClient:
+    if session is None:
+        from aiobotocore.session import get_session  # type: ignore
+
+        session = get_session()
+    return _EnteredAsyncClient(session.create_client(**client_kwargs))
+
+
+def _client_key_default(obj: Any) -> Any:
+    """
+    Serialize the client arguments that JSON does not support. Other objects, like a botocore `Config`, are identified
+    by their repr, which includes their address by default: equal objects may not share a client, but different ones
+    never do.
+    """
+    try:
+        return _canonical_json_default(obj)
+    except TypeError:
+        return repr(obj)
+
+
+def _get_httpx_limits(connection_pool: ConnectionPoolConfig):
+    import httpx
+
+    return httpx.Limits(
+        max_connections=connection_pool.max_connections,
+        max_keepalive_connections=connection_pool.max_keepalive_connections,
+        keepalive_expiry=connection_pool.keepalive_expiry,
+    )
+
+
+class ApiModel(Model):
+    """
+    Base class for API-based language models.
 
     This class serves as a foundation for implementing models that interact with
     external APIs. It handles the common functionality for managing model IDs,
@@ -931,20 +2234,269 @@ class ApiModel(Model):
             Mapping to convert  between internal role names and API-specific role names. Defaults to None.
         client (`Any`, **optional**):
             Pre-configured API client instance. If not provided, a default client will be created. Defaults to None.
+        async_client (`Any`, **optional**):
+            Pre-configured async API client instance, used by `agenerate` and `agenerate_stream`. If not provided, a
+            default async client will be created on first use in each event loop. Defaults to None.
+        share_client (`bool`, default `False`):
+            Whether to take the clients from the process-wide `client_registry`, so that the models using the same
+            endpoint and credentials share their clients and connections. Useful when creating a model per request.
+        connection_pool (`ConnectionPoolConfig | dict`, **optional**):
+            Size and keep-alive of the connection pool of the clients created by the model. Defaults to the settings
+            of the client library.
         **kwargs: Additional keyword arguments to pass to the parent class.
     """
 
     def __init__(
-        self, model_id: str, custom_role_conversions: dict[str, str] | None = None, client: Any | None = None, **kwargs
+        self,
+        model_id: str,
+        custom_role_conversions: dict[str, str] | None = None,
+        client: Any | None = None,
+        async_client: Any | None = None,
+        share_client: bool = False,
+        connection_pool: ConnectionPoolConfig | dict | None = None,
+        **kwargs,
     ):
         super().__init__(model_id=model_id, **kwargs)
         self.custom_role_conversions = custom_role_conversions or {}
+        self.share_client = share_client
+        if isinstance(connection_pool, dict):
+            connection_pool = ConnectionPoolConfig(**connection_pool)
+        self.connection_pool = connection_pool
         self.client = client or self.create_client()
+        self._async_client = async_client
+        # Async clients created by the model, by event loop, or `None` outside of one
+        self._async_clients: dict[asyncio.AbstractEventLoop | None, Any] = {}
+
+    @property
+    def async_client(self):
+        """
+        Async API client used by `agenerate` and `agenerate_stream`. Unless one was passed, it is created on first use
+        in each event loop, as async clients cannot be used anymore once the event loop they ran in is closed, for
+        instance by `asyncio.run`.
+        """
+        if self._async_client is not None:
+            return self._async_client
+        event_loop = _get_running_event_loop()
+        if (client := self._async_clients.get(event_loop)) is None:
+            for closed_event_loop in [loop for loop in self._async_clients if loop is not None and loop.is_closed()]:
+                del self._async_clients[closed_event_loop]
+            client = self._async_clients[event_loop] = self.create_async_client()
+        return client
 
     def create_client(self):
         """Create the API client for the specific service."""
         raise NotImplementedError("Subclasses must implement this method to create a client")
 
+    def create_async_client(self):
+        """Create the async API client for the specific service."""
+        raise NotImplementedError("Subclasses must implement this method to create an async client")
+
+    def _get_client(
+        self,
+        client_class: Callable[..., Any],
+        get_connection_pool_kwargs: Callable[[ConnectionPoolConfig], dict[str, Any]] | None = None,
+        *,
+        is_async: bool = False,
+        **client_kwargs,
+    ) -> Any:
+        """
+        Create a client, or take it from `client_registry` if clients are shared.
+
+        Args:
+            client_class (`Callable[..., Any]`): Class of the client.
+            get_connection_pool_kwargs (`Callable[[ConnectionPoolConfig], dict[str, Any]]`, *optional*): Function
+                returning the client arguments configuring its connection pool, if the client supports it.
+            is_async (`bool`, default `False`): Whether the client is async, and therefore only shared within the
+                running event loop.
+            **client_kwargs: Arguments of the client.
+        """
+        if self.connection_pool is not None and get_connection_pool_kwargs is None:
+            raise ValueError(f"{type(self).__name__} does not support configuring the connection pool.")
+
+        def create_client():
+            if self.connection_pool is None:
+                return client_class(**client_kwargs)
+            return client_class(**(client_kwargs | get_connection_pool_kwargs(self.connection_pool)))
+
+        if not self.share_client:
+            return create_client()
+        return client_registry.get_client(
+            (repr(client_class), client_kwargs, self.connection_pool),
+            create_client,
+            event_loop=_get_running_event_loop() if is_async else None,
+        )
+
+    def _process_response(self, response) -> ChatMessage:
+        """Convert a chat completion in the OpenAI format to a `ChatMessage`, recording its token counts."""
+        self._set_token_counts_from_usage(response.usage)
+        return ChatMessage.from_dict(
+            response.choices[0].message.model_dump(include={"role", "content", "tool_calls"}),
+            raw=response,
+        )
+
+    def _process_stream_event(self, event) -> ChatMessageStreamDelta | None:
+        """Convert a chat completion chunk in the OpenAI format to a delta, recording the token counts it carries."""
+        stream_delta = None
+        if event.choices:
+            if event.choices[0].delta is None:
+                if not getattr(event.choices[0], "finish_reason", None):
+                    raise ValueError(f"No content or tool calls in event: {event}")
+            else:
+                delta = event.choices[0].delta
+                stream_delta = ChatMessageStreamDelta(
+                    content=delta.content,
+                    tool_calls=[
+                        ChatMessageToolCallStreamDelta(
+                            index=tool_call.index,
+                            id=tool_call.id,
+                            type=tool_call.type,
+                            name=tool_call.function.name if tool_call.function else None,
+                            arguments=tool_call.function.arguments if tool_call.function else None,
+                        )
+                        for tool_call in delta.tool_calls
+                    ]
+                    if getattr(delta, "tool_calls", None)
+                    else None,
+                )
+        if getattr(event, "usage", None):
+            self._set_token_counts_from_usage(event.usage)
+        return stream_delta
+
+    def _uses_client_side_stop_sequences(self, stop_sequences: list[str] | None) -> bool:
+        """Whether stop sequences must be enforced on the output, as the model does not support the `stop` parameter."""
+        return bool(stop_sequences) and not supports_stop_parameter(self.model_id or "")
+
+    def _estimate_input_token_count(self, completion_kwargs: dict[str, Any] | None) -> int | None:
+        """Estimate the input tokens of a request, with the token counter or else from its number of characters."""
+        if self.token_counter is not None:
+            return self.last_estimated_input_token_count
+        if completion_kwargs is None:
+            return None
+        return CharacterTokenCounter().count_tokens(completion_kwargs["messages"], completion_kwargs.get("tools"))
+
+    def _set_token_counts_after_stop(self, stop: _ClientSideStopSequences, completion_kwargs: dict[str, Any] | None):
+        self.last_input_token_count = self._estimate_input_token_count(completion_kwargs)
+        token_counter = self.token_counter or CharacterTokenCounter()
+        self.last_output_token_count = token_counter.count_text_tokens("".join(stop.received_content_chunks))
+        self.last_cached_input_token_count = None
+
+    def _process_stream(
+        self, events, stop_sequences: list[str] | None = None, completion_kwargs: dict[str, Any] | None = None
+    ) -> Generator[ChatMessageStreamDelta]:
+        """
+        Convert a stream of events, chat completion chunks in the OpenAI format by default, to deltas.
+
+        If the model does not support the `stop` parameter, the stream is closed as soon as a stop sequence appears, and
+        the output is cut before it. The provider reports usage only at the end of a stream: the input token count is
+        then estimated from the `completion_kwargs` of the request, and the output token count from the content
+        received, both by the token counter or else from their number of characters.
+        """
+        stop = (
+            _ClientSideStopSequences(stop_sequences) if self._uses_client_side_stop_sequences(stop_sequences) else None
+        )
+        try:
+            for event in events:
+                if (stream_delta := self._process_stream_event(event)) is None:
+                    continue
+                if stop is None:
+                    yield stream_delta
+                    continue
+                if (stream_delta := stop.process(stream_delta)) is not None:
+                    yield stream_delta
+                if stop.stopped:
+                    self._set_token_counts_after_stop(stop, completion_kwargs)
+                    return
+            if stop is not None and (stream_delta := stop.flush()) is not None:
+                yield stream_delta
+        finally:
+            # Closing the stream ends the request, so that no more tokens are generated
+            if callable(close := getattr(events, "close", None)):
+                close()
+
+    async def _aprocess_stream(
+        self, events, stop_sequences: list[str] | None = None, completion_kwargs: dict[str, Any] | None = None
+    ) -> AsyncGenerator[ChatMessageStreamDelta]:
+        """Async version of `_process_stream`."""
+        stop = (
+            _ClientSideStopSequences(stop_sequences) if self._uses_client_side_stop_sequences(stop_sequences) else None
+        )
+        try:
+            async for event in events:
+                if (stream_delta := self._process_stream_event(event)) is None:
+                    continue
+                if stop is None:
+                    yield stream_delta
+                    continue
+                if (stream_delta := stop.process(stream_delta)) is not None:
+                    yield stream_delta
+                if stop.stopped:
+                    self._set_token_counts_after_stop(stop, completion_kwargs)
+                    return
+            if stop is not None and (stream_delta := stop.flush()) is not None:
+                yield stream_delta
+        finally:
+            close = getattr(events, "aclose", None) or getattr(events, "close", None)
+            if callable(close) and inspect.isawaitable(result := close()):
+                await result
+
+    def _generate_from_stream(
+        self,
+        messages: list[dict[str, str | list[dict]]],
+        stop_sequences: list[str] | None = None,
+        grammar: str | None = None,
+        tools_to_call_from: list[Tool] | None = None,
+        **kwargs,
+    ) -> ChatMessage:
+        """Generate a message through `generate_stream`, so that stop sequences can end the generation client-side."""
+        accumulator = ChatMessageStreamAccumulator()
+        for stream_delta in self.generate_stream(
+            messages, stop_sequences=stop_sequences, grammar=grammar, tools_to_call_from=tools_to_call_from, **kwargs
+        ):
+            accumulator.add(stream_delta)
+        return accumulator.to_message()
+
+    async def _agenerate_from_stream(
+        self,
+        messages: list[dict[str, str | list[dict]]],
+        stop_sequences: list[str] | None = None,
+        grammar: str | None = None,
+        tools_to_call_from: list[Tool] | None = None,
+        **kwargs,
+    ) -> ChatMessage:
+        """Async version of `_generate_from_stream`."""
+        accumulator = ChatMessageStreamAccumulator()
+        async for stream_delta in self.agenerate_stream(
+            messages, stop_sequences=stop_sequences, grammar=grammar, tools_to_call_from=tools_to_call_from, **kwargs
+        ):
+            accumulator.add(stream_delta)
+        return accumulator.to_message()
+
+    def _get_token_counts_from_usage(self, usage) -> tuple[int, int, int]:
+        """
+        Return the input, output and cached input token counts of a usage in the OpenAI format, where cached tokens are
+        part of the prompt tokens.
+        """
+        cached_tokens = getattr(getattr(usage, "prompt_tokens_details", None), "cached_tokens", None)
+        return usage.prompt_tokens, usage.completion_tokens, cached_tokens if isinstance(cached_tokens, int) else 0
+
+    def _set_token_counts_from_usage(self, usage):
+        """Record the token counts of a usage."""
+        (
+            self.last_input_token_count,
+            self.last_output_token_count,
+            self.last_cached_input_token_count,
+        ) = self._get_token_counts_from_usage(usage)
+
+    def _get_response_usage(self, response) -> Any | None:
+        """Return the usage of a raw response, or `None` if it has none."""
+        return getattr(response, "usage", None)
+
+    def get_message_token_counts(self, message: ChatMessage) -> tuple[int | None, int | None]:
+        if (usage := self._get_response_usage(message.raw)) is None:
+            return super().get_message_token_counts(message)
+        input_token_count, output_token_count, _ = self._get_token_counts_from_usage(usage)
+        return input_token_count, output_token_count
+
 
 class LiteLLMModel(ApiModel):
     """Model to use [LiteLLM Python SDK](https://docs.litellm.ai/docs/#litellm-python-sdk) to access hundreds of LLMs.
@@ -1007,15 +2559,40 @@ class LiteLLMModel(ApiModel):
 
         return litellm
 
-    def generate(
+    def create_async_client(self):
+        """Return the LiteLLM client, which exposes `acompletion` next to `completion`."""
+        return self.client
+
+    def _mark_cacheable_prefix(self, messages: list[dict[str, str | list[dict]]]) -> list[dict[str, str | list[dict]]]:
+        """
+        Add Anthropic-style `cache_control` breakpoints at the end of the system prompt, which also covers the tool
+        definitions, and at the end of the prompt. Only Anthropic models take them, also through other providers like
+        Bedrock or Vertex AI: other providers cache prompts automatically, or reject unknown fields. Messages flattened
+        as text are left as they are, since the breakpoints need content blocks.
+        """
+        if not _supports_cache_control(self.model_id):
+            return messages
+        system_indices = [i for i, message in enumerate(messages) if message["role"] == MessageRole.SYSTEM]
+        for i in set(system_indices[-1:] + [len(messages) - 1]):
+            content = messages[i]["content"]
+            if isinstance(content, str):
+                if self.flatten_messages_as_text:
+                    continue
+                content = [{"type": "text", "text": content}]
+            if content:
+                cache_control = {"cache_control": {"type": "ephemeral"}}
+                messages[i] = {**messages[i], "content": content[:-1] + [{**content[-1], **cache_control}]}
+        return messages
+
+    def _prepare_api_completion_kwargs(
         self,
         messages: list[dict[str, str | list[dict]]],
         stop_sequences: list[str] | None = None,
         grammar: str | None = None,
         tools_to_call_from: list[Tool] | None = None,
         **kwargs,
-    ) -> ChatMessage:
-        completion_kwargs = self._prepare_completion_kwargs(
+    ) -> dict[str, Any]:
+        return self._prepare_completion_kwargs(
             messages=messages,
             stop_sequences=stop_sequences,
             grammar=grammar,
@@ -1023,19 +2600,32 @@ class LiteLLMModel(ApiModel):
             model=self.model_id,
             api_base=self.api_base,
             api_key=self.api_key,
-            convert_images_to_image_urls=True,
             custom_role_conversions=self.custom_role_conversions,
+            convert_images_to_image_urls=True,
             **kwargs,
         )
 
-        response = self.client.completion(**completion_kwargs)
-
-        self.last_input_token_count = response.usage.prompt_tokens
-        self.last_output_token_count = response.usage.completion_tokens
-        return ChatMessage.from_dict(
-            response.choices[0].message.model_dump(include={"role", "content", "tool_calls"}),
-            raw=response,
+    def generate(
+        self,
+        messages: list[dict[str, str | list[dict]]],
+        stop_sequences: list[str] | None = None,
+        grammar: str | None = None,
+        tools_to_call_from: list[Tool] | None = None,
+        **kwargs,
+    ) -> ChatMessage:
+        if self._uses_client_side_stop_sequences(stop_sequences):
+            return self._generate_from_stream(
+                messages,
+                stop_sequences=stop_sequences,
+                grammar=grammar,
+                tools_to_call_from=tools_to_call_from,
+                **kwargs,
+            )
+        completion_kwargs = self._prepare_api_completion_kwargs(
+            messages, stop_sequences=stop_sequences, grammar=grammar, tools_to_call_from=tools_to_call_from, **kwargs
         )
+        response = self.client.completion(**completion_kwargs)
+        return self._process_response(response)
 
     def generate_stream(
         self,
@@ -1045,32 +2635,54 @@ class LiteLLMModel(ApiModel):
         tools_to_call_from: list[Tool] | None = None,
         **kwargs,
     ) -> Generator[ChatMessageStreamDelta]:
-        if tools_to_call_from:
-            raise NotImplementedError("Streaming is not yet supported for tool calling")
-        completion_kwargs = self._prepare_completion_kwargs(
-            messages=messages,
-            stop_sequences=stop_sequences,
-            grammar=grammar,
-            tools_to_call_from=tools_to_call_from,
-            model=self.model_id,
-            api_base=self.api_base,
-            api_key=self.api_key,
-            custom_role_conversions=self.custom_role_conversions,
-            convert_images_to_image_urls=True,
-            **kwargs,
+        completion_kwargs = self._prepare_api_completion_kwargs(
+            messages, stop_sequences=stop_sequences, grammar=grammar, tools_to_call_from=tools_to_call_from, **kwargs
         )
-        for event in self.client.completion(**completion_kwargs, stream=True, stream_options={"include_usage": True}):
-            if event.choices:
-                if event.choices[0].delta is None:
-                    if not getattr(event.choices[0], "finish_reason", None):
-                        raise ValueError(f"No content or tool calls in event: {event}")
-                else:
-                    yield ChatMessageStreamDelta(
-                        content=event.choices[0].delta.content,
-                    )
-            if getattr(event, "usage", None):
-                self.last_input_token_count = event.usage.prompt_tokens
-                self.last_output_token_count = event.usage.completion_tokens
+        yield from self._process_stream(
+            self.client.completion(**completion_kwargs, stream=True, stream_options={"include_usage": True}),
+            stop_sequences,
+            completion_kwargs,
+        )
+
+    async def agenerate(
+        self,
+        messages: list[dict[str, str | list[dict]]],
+        stop_sequences: list[str] | None = None,
+        grammar: str | None = None,
+        tools_to_call_from: list[Tool] | None = None,
+        **kwargs,
+    ) -> ChatMessage:
+        if self._uses_client_side_stop_sequences(stop_sequences):
+            return await self._agenerate_from_stream(
+                messages,
+                stop_sequences=stop_sequences,
+                grammar=grammar,
+                tools_to_call_from=tools_to_call_from,
+                **kwargs,
+            )
+        completion_kwargs = self._prepare_api_completion_kwargs(
+            messages, stop_sequences=stop_sequences, grammar=grammar, tools_to_call_from=tools_to_call_from, **kwargs
+        )
+        response = await self.async_client.acompletion(**completion_kwargs)
+        return self._process_response(response)
+
+    async def agenerate_stream(
+        self,
+        messages: list[dict[str, str | list[dict]]],
+        stop_sequences: list[str] | None = None,
+        grammar: str | None = None,
+        tools_to_call_from: list[Tool] | None = None,
+        **kwargs,
+    ) -> AsyncGenerator[ChatMessageStreamDelta]:
+        """Async version of `generate_stream`."""
+        completion_kwargs = self._prepare_api_completion_kwargs(
+            messages, stop_sequences=stop_sequences, grammar=grammar, tools_to_call_from=tools_to_call_from, **kwargs
+        )
+        events = await self.async_client.acompletion(
+            **completion_kwargs, stream=True, stream_options={"include_usage": True}
+        )
+        async for stream_delta in self._aprocess_stream(events, stop_sequences, completion_kwargs):
+            yield stream_delta
 
 
 class LiteLLMRouterModel(LiteLLMModel):
@@ -1261,30 +2873,58 @@ class InferenceClientModel(ApiModel):
         """Create the Hugging Face client."""
         from huggingface_hub import InferenceClient
 
-        return InferenceClient(**self.client_kwargs)
+        # The connections are pooled by huggingface_hub, which does not allow configuring the pool of a client
+        return self._get_client(InferenceClient, **self.client_kwargs)
 
-    def generate(
+    def create_async_client(self):
+        """Create the async Hugging Face client."""
+        from huggingface_hub import AsyncInferenceClient
+
+        return self._get_client(AsyncInferenceClient, is_async=True, **self.client_kwargs)
+
+    def _process_response(self, response) -> ChatMessage:
+        self._set_token_counts_from_usage(response.usage)
+        return ChatMessage.from_dict(asdict(response.choices[0].message), raw=response)
+
+    def _prepare_api_completion_kwargs(
         self,
         messages: list[dict[str, str | list[dict]]],
         stop_sequences: list[str] | None = None,
         grammar: str | None = None,
         tools_to_call_from: list[Tool] | None = None,
         **kwargs,
-    ) -> ChatMessage:
-        completion_kwargs = self._prepare_completion_kwargs(
+    ) -> dict[str, Any]:
+        return self._prepare_completion_kwargs(
             messages=messages,
             stop_sequences=stop_sequences,
             grammar=grammar,
             tools_to_call_from=tools_to_call_from,
-            convert_images_to_image_urls=True,
             custom_role_conversions=self.custom_role_conversions,
+            convert_images_to_image_urls=True,
             **kwargs,
         )
-        response = self.client.chat_completion(**completion_kwargs)
 
-        self.last_input_token_count = response.usage.prompt_tokens
-        self.last_output_token_count = response.usage.completion_tokens
-        return ChatMessage.from_dict(asdict(response.choices[0].message), raw=response)
+    def generate(
+        self,
+        messages: list[dict[str, str | list[dict]]],
+        stop_sequences: list[str] | None = None,
+        grammar: str | None = None,
+        tools_to_call_from: list[Tool] | None = None,
+        **kwargs,
+    ) -> ChatMessage:
+        if self._uses_client_side_stop_sequences(stop_sequences):
+            return self._generate_from_stream(
+                messages,
+                stop_sequences=stop_sequences,
+                grammar=grammar,
+                tools_to_call_from=tools_to_call_from,
+                **kwargs,
+            )
+        completion_kwargs = self._prepare_api_completion_kwargs(
+            messages, stop_sequences=stop_sequences, grammar=grammar, tools_to_call_from=tools_to_call_from, **kwargs
+        )
+        response = self.client.chat_completion(**completion_kwargs)
+        return self._process_response(response)
 
     def generate_stream(
         self,
@@ -1294,32 +2934,54 @@ class InferenceClientModel(ApiModel):
         tools_to_call_from: list[Tool] | None = None,
         **kwargs,
     ) -> Generator[ChatMessageStreamDelta]:
-        if tools_to_call_from:
-            raise NotImplementedError("Streaming is not yet supported for tool calling")
-        completion_kwargs = self._prepare_completion_kwargs(
-            messages=messages,
-            stop_sequences=stop_sequences,
-            grammar=grammar,
-            tools_to_call_from=tools_to_call_from,
-            model=self.model_id,
-            custom_role_conversions=self.custom_role_conversions,
-            convert_images_to_image_urls=True,
-            **kwargs,
+        completion_kwargs = self._prepare_api_completion_kwargs(
+            messages, stop_sequences=stop_sequences, grammar=grammar, tools_to_call_from=tools_to_call_from, **kwargs
+        )
+        yield from self._process_stream(
+            self.client.chat_completion(**completion_kwargs, stream=True, stream_options={"include_usage": True}),
+            stop_sequences,
+            completion_kwargs,
         )
-        for event in self.client.chat.completions.create(
+
+    async def agenerate(
+        self,
+        messages: list[dict[str, str | list[dict]]],
+        stop_sequences: list[str] | None = None,
+        grammar: str | None = None,
+        tools_to_call_from: list[Tool] | None = None,
+        **kwargs,
+    ) -> ChatMessage:
+        if self._uses_client_side_stop_sequences(stop_sequences):
+            return await self._agenerate_from_stream(
+                messages,
+                stop_sequences=stop_sequences,
+                grammar=grammar,
+                tools_to_call_from=tools_to_call_from,
+                **kwargs,
+            )
+        completion_kwargs = self._prepare_api_completion_kwargs(
+            messages, stop_sequences=stop_sequences, grammar=grammar, tools_to_call_from=tools_to_call_from, **kwargs
+        )
+        response = await self.async_client.chat_completion(**completion_kwargs)
+        return self._process_response(response)
+
+    async def agenerate_stream(
+        self,
+        messages: list[dict[str, str | list[dict]]],
+        stop_sequences: list[str] | None = None,
+        grammar: str | None = None,
+        tools_to_call_from: list[Tool] | None = None,
+        **kwargs,
+    ) -> AsyncGenerator[ChatMessageStreamDelta]:
+        """Async version of `generate_stream`."""
+        completion_kwargs = self._prepare_api_completion_kwargs(
+            messages, stop_sequences=stop_sequences, grammar=grammar, tools_to_call_from=tools_to_call_from, **kwargs
+        )
+        events = await self.async_client.chat_completion(
             **completion_kwargs, stream=True, stream_options={"include_usage": True}
-        ):
-            if event.choices:
-                if event.choices[0].delta is None:
-                    if not getattr(event.choices[0], "finish_reason", None):
-                        raise ValueError(f"No content or tool calls in event: {event}")
-                else:
-                    yield ChatMessageStreamDelta(
-                        content=event.choices[0].delta.content,
-                    )
-            if getattr(event, "usage", None):
-                self.last_input_token_count = event.usage.prompt_tokens
-                self.last_output_token_count = event.usage.completion_tokens
+        )
+        async for stream_delta in self._aprocess_stream(events, stop_sequences, completion_kwargs):
+            yield stream_delta
 
 
 class HfApiModel(InferenceClientModel):
@@ -1390,19 +3052,36 @@ class OpenAIServerModel(ApiModel):
                 "Please install 'openai' extra to use OpenAIServerModel: `pip install 'smolagents[openai]'`"
             ) from e
 
-        return openai.OpenAI(**self.client_kwargs)
+        return self._get_client(
+            openai.OpenAI,
+            lambda pool: {"http_client": openai.DefaultHttpxClient(limits=_get_httpx_limits(pool))},
+            **self.client_kwargs,
+        )
 
-    def generate_stream(
-        self,
-        messages: list[dict[str, str | list[dict]]],
-        stop_sequences: list[str] | None = None,
-        grammar: str | None = None,
-        tools_to_call_from: list[Tool] | None = None,
-        **kwargs,
-    ) -> Generator[ChatMessageStreamDelta]:
-        if tools_to_call_from:
-            raise NotImplementedError("Streaming is not yet supported for tool calling")
-        completion_kwargs = self._prepare_completion_kwargs(
+    def create_async_client(self):
+        try:
+            import openai
+        except ModuleNotFoundError as e:
+            raise ModuleNotFoundError(
+                "Please install 'openai' extra to use OpenAIServerModel: `pip install 'smolagents[openai]'`"
+            ) from e
+
+        return self._get_client(
+            openai.AsyncOpenAI,
+            lambda pool: {"http_client": openai.DefaultAsyncHttpxClient(limits=_get_httpx_limits(pool))},
+            is_async=True,
+            **self.client_kwargs,
+        )
+
+    def _prepare_api_completion_kwargs(
+        self,
+        messages: list[dict[str, str | list[dict]]],
+        stop_sequences: list[str] | None = None,
+        grammar: str | None = None,
+        tools_to_call_from: list[Tool] | None = None,
+        **kwargs,
+    ) -> dict[str, Any]:
+        return self._prepare_completion_kwargs(
             messages=messages,
             stop_sequences=stop_sequences,
             grammar=grammar,
@@ -1412,20 +3091,6 @@ class OpenAIServerModel(ApiModel):
             convert_images_to_image_urls=True,
             **kwargs,
         )
-        for event in self.client.chat.completions.create(
-            **completion_kwargs, stream=True, stream_options={"include_usage": True}
-        ):
-            if event.choices:
-                if event.choices[0].delta is None:
-                    if not getattr(event.choices[0], "finish_reason", None):
-                        raise ValueError(f"No content or tool calls in event: {event}")
-                else:
-                    yield ChatMessageStreamDelta(
-                        content=event.choices[0].delta.content,
-                    )
-            if getattr(event, "usage", None):
-                self.last_input_token_count = event.usage.prompt_tokens
-                self.last_output_token_count = event.usage.completion_tokens
 
     def generate(
         self,
@@ -1435,25 +3100,79 @@ class OpenAIServerModel(ApiModel):
         tools_to_call_from: list[Tool] | None = None,
         **kwargs,
     ) -> ChatMessage:
-        completion_kwargs = self._prepare_completion_kwargs(
-            messages=messages,
-            stop_sequences=stop_sequences,
-            grammar=grammar,
-            tools_to_call_from=tools_to_call_from,
-            model=self.model_id,
-            custom_role_conversions=self.custom_role_conversions,
-            convert_images_to_image_urls=True,
-            **kwargs,
+        if self._uses_client_side_stop_sequences(stop_sequences):
+            return self._generate_from_stream(
+                messages,
+                stop_sequences=stop_sequences,
+                grammar=grammar,
+                tools_to_call_from=tools_to_call_from,
+                **kwargs,
+            )
+        completion_kwargs = self._prepare_api_completion_kwargs(
+            messages, stop_sequences=stop_sequences, grammar=grammar, tools_to_call_from=tools_to_call_from, **kwargs
         )
         response = self.client.chat.completions.create(**completion_kwargs)
-        self.last_input_token_count = response.usage.prompt_tokens
-        self.last_output_token_count = response.usage.completion_tokens
+        return self._process_response(response)
 
-        return ChatMessage.from_dict(
-            response.choices[0].message.model_dump(include={"role", "content", "tool_calls"}),
-            raw=response,
+    def generate_stream(
+        self,
+        messages: list[dict[str, str | list[dict]]],
+        stop_sequences: list[str] | None = None,
+        grammar: str | None = None,
+        tools_to_call_from: list[Tool] | None = None,
+        **kwargs,
+    ) -> Generator[ChatMessageStreamDelta]:
+        completion_kwargs = self._prepare_api_completion_kwargs(
+            messages, stop_sequences=stop_sequences, grammar=grammar, tools_to_call_from=tools_to_call_from, **kwargs
+        )
+        yield from self._process_stream(
+            self.client.chat.completions.create(
+                **completion_kwargs, stream=True, stream_options={"include_usage": True}
+            ),
+            stop_sequences,
+            completion_kwargs,
         )
 
+    async def agenerate(
+        self,
+        messages: list[dict[str, str | list[dict]]],
+        stop_sequences: list[str] | None = None,
+        grammar: str | None = None,
+        tools_to_call_from: list[Tool] | None = None,
+        **kwargs,
+    ) -> ChatMessage:
+        if self._uses_client_side_stop_sequences(stop_sequences):
+            return await self._agenerate_from_stream(
+                messages,
+                stop_sequences=stop_sequences,
+                grammar=grammar,
+                tools_to_call_from=tools_to_call_from,
+                **kwargs,
+            )
+        completion_kwargs = self._prepare_api_completion_kwargs(
+            messages, stop_sequences=stop_sequences, grammar=grammar, tools_to_call_from=tools_to_call_from, **kwargs
+        )
+        response = await self.async_client.chat.completions.create(**completion_kwargs)
+        return self._process_response(response)
+
+    async def agenerate_stream(
+        self,
+        messages: list[dict[str, str | list[dict]]],
+        stop_sequences: list[str] | None = None,
+        grammar: str | None = None,
+        tools_to_call_from: list[Tool] | None = None,
+        **kwargs,
+    ) -> AsyncGenerator[ChatMessageStreamDelta]:
+        """Async version of `generate_stream`."""
+        completion_kwargs = self._prepare_api_completion_kwargs(
+            messages, stop_sequences=stop_sequences, grammar=grammar, tools_to_call_from=tools_to_call_from, **kwargs
+        )
+        events = await self.async_client.chat.completions.create(
+            **completion_kwargs, stream=True, stream_options={"include_usage": True}
+        )
+        async for stream_delta in self._aprocess_stream(events, stop_sequences, completion_kwargs):
+            yield stream_delta
+
 
 class AzureOpenAIServerModel(OpenAIServerModel):
     """This model connects to an Azure OpenAI deployment.
@@ -1509,7 +3228,26 @@ class AzureOpenAIServerModel(OpenAIServerModel):
                 "Please install 'openai' extra to use AzureOpenAIServerModel: `pip install 'smolagents[openai]'`"
             ) from e
 
-        return openai.AzureOpenAI(**self.client_kwargs)
+        return self._get_client(
+            openai.AzureOpenAI,
+            lambda pool: {"http_client": openai.DefaultHttpxClient(limits=_get_httpx_limits(pool))},
+            **self.client_kwargs,
+        )
+
+    def create_async_client(self):
+        try:
+            import openai
+        except ModuleNotFoundError as e:
+            raise ModuleNotFoundError(
+                "Please install 'openai' extra to use AzureOpenAIServerModel: `pip install 'smolagents[openai]'`"
+            ) from e
+
+        return self._get_client(
+            openai.AsyncAzureOpenAI,
+            lambda pool: {"http_client": openai.DefaultAsyncHttpxClient(limits=_get_httpx_limits(pool))},
+            is_async=True,
+            **self.client_kwargs,
+        )
 
 
 class AmazonBedrockServerModel(ApiModel):
@@ -1528,6 +3266,9 @@ class AmazonBedrockServerModel(ApiModel):
         client_kwargs (dict[str, Any], *optional*):
             Keyword arguments used to configure the boto3 client if it needs to be created internally.
             Examples include `region_name`, `config`, or `endpoint_url`.
+        async_client (`aiobotocore.session.AioSession`, *optional*):
+            A custom aiobotocore session creating the async clients of `agenerate` and `agenerate_stream`. A client is
+            opened on first use in each event loop, then reused by the requests until `cleanup` is called.
         custom_role_conversions (`dict[str, str]`, *optional*):
             Custom role conversion mapping to convert message roles in others.
             Useful for specific models that do not support specific message roles like "system".
@@ -1578,10 +3319,12 @@ class AmazonBedrockServerModel(ApiModel):
         model_id: str,
         client=None,
         client_kwargs: dict[str, Any] | None = None,
+        async_client=None,
         custom_role_conversions: dict[str, str] | None = None,
         **kwargs,
     ):
         self.client_kwargs = client_kwargs or {}
+        self.async_session = async_client
 
         # Bedrock only supports `assistant` and `user` roles.
         # Many Bedrock models do not allow conversations to start with the `assistant` role, so the default is set to `user/user`.
@@ -1620,7 +3363,7 @@ class AmazonBedrockServerModel(ApiModel):
         """
         completion_kwargs = super()._prepare_completion_kwargs(
             messages=messages,
-            stop_sequences=None,  # Bedrock support stop_sequence using Inference Config
+            stop_sequences=None,  # Bedrock takes stop sequences in the inference configuration
             grammar=None,  # Bedrock doesn't support grammar
             tools_to_call_from=tools_to_call_from,
             custom_role_conversions=custom_role_conversions,
@@ -1632,12 +3375,23 @@ class AmazonBedrockServerModel(ApiModel):
         # so adding `toolConfig` could cause conflicts. We remove it to avoid issues.
         completion_kwargs.pop("toolConfig", None)
 
-        # The Bedrock API does not support the `type` key in requests.
-        # This block of code modifies the object to meet Bedrock's requirements.
+        if stop_sequences:
+            # The inference configuration of the model is copied, as it is shared by all calls
+            completion_kwargs["inferenceConfig"] = {
+                **completion_kwargs.get("inferenceConfig", {}),
+                "stopSequences": stop_sequences,
+            }
+
+        # The Bedrock API does not support the `type` key in requests, and only takes content as a list of blocks.
+        # The content elements are shared with the message list cache: they are replaced rather than modified.
         for message in completion_kwargs.get("messages", []):
-            for content in message.get("content", []):
-                if "type" in content:
-                    del content["type"]
+            content = message.get("content", [])
+            if isinstance(content, str):
+                message["content"] = [{"text": content}]
+                continue
+            message["content"] = [
+                {key: value for key, value in element.items() if key != "type"} for element in content
+            ]
 
         return {
             "modelId": self.model_id,
@@ -1652,40 +3406,1144 @@ class AmazonBedrockServerModel(ApiModel):
                 "Please install 'bedrock' extra to use AmazonBedrockServerModel: `pip install 'smolagents[bedrock]'`"
             ) from e
 
-        return boto3.client("bedrock-runtime", **self.client_kwargs)
+        return self._get_client(
+            boto3.client, self._get_connection_pool_kwargs, service_name="bedrock-runtime", **self.client_kwargs
+        )
 
-    def generate(
+    def _get_connection_pool_kwargs(self, connection_pool: ConnectionPoolConfig) -> dict[str, Any]:
+        from botocore.config import Config  # type: ignore
+
+        # botocore keeps idle connections open as long as the server allows it
+        config = Config(max_pool_connections=connection_pool.max_connections, tcp_keepalive=True)
+        if "config" in self.client_kwargs:
+            config = self.client_kwargs["config"].merge(config)
+        return {"config": config}
+
+    def create_async_client(self):
+        # Only a custom session is part of the client arguments, so that the clients of default sessions are shared
+        session_kwargs = {}
+        if self.async_session is not None:
+            session_kwargs["session"] = self.async_session
+        else:
+            try:
+                import aiobotocore  # type: ignore  # noqa: F401
+            except ModuleNotFoundError as e:
+                raise ModuleNotFoundError(
+                    "Please install 'aiobotocore' to use AmazonBedrockServerModel asynchronously: "
+                    "`pip install aiobotocore`"
+                ) from e
+
+        return self._get_client(
+            _create_aiobotocore_client,
+            self._get_connection_pool_kwargs,
+            is_async=True,
+            service_name="bedrock-runtime",
+            **session_kwargs,
+            **self.client_kwargs,
+        )
+
+    def cleanup(self):
+        """
+        Close the async clients opened by the model in the event loops still open. Clients shared through the
+        `client_registry` stay open, as other models may use them.
+        """
+        if not self.share_client:
+            running_event_loop = _get_running_event_loop()
+            for event_loop, client in self._async_clients.items():
+                if event_loop is None or event_loop.is_closed():
+                    continue
+                if event_loop is running_event_loop:
+                    event_loop.create_task(client.close())
+                elif event_loop.is_running():
+                    asyncio.run_coroutine_threadsafe(client.close(), event_loop).result()
+                else:
+                    event_loop.run_until_complete(client.close())
+        self._async_clients.clear()
+
+    def _prepare_api_completion_kwargs(
         self,
         messages: list[dict[str, str | list[dict]]],
         stop_sequences: list[str] | None = None,
         grammar: str | None = None,
         tools_to_call_from: list[Tool] | None = None,
         **kwargs,
-    ) -> ChatMessage:
-        completion_kwargs: dict = self._prepare_completion_kwargs(
+    ) -> dict[str, Any]:
+        return self._prepare_completion_kwargs(
             messages=messages,
+            stop_sequences=stop_sequences,
             tools_to_call_from=tools_to_call_from,
             custom_role_conversions=self.custom_role_conversions,
             convert_images_to_image_urls=True,
             **kwargs,
         )
 
-        # self.client is created in ApiModel class
-        response = self.client.converse(**completion_kwargs)
+    def _mark_cacheable_prefix(self, messages: list[dict[str, str | list[dict]]]) -> list[dict[str, str | list[dict]]]:
+        """Add a cache point at the end of the prompt, where the Converse API caches the prefix before it."""
+        if messages:
+            messages[-1] = {
+                **messages[-1],
+                "content": list(messages[-1]["content"]) + [{"cachePoint": {"type": "default"}}],
+            }
+        return messages
+
+    def _get_token_counts_from_usage(self, usage: dict) -> tuple[int, int, int]:
+        """
+        Return the input, output and cached input token counts of a usage of the Converse API, where input tokens do
+        not include cached tokens.
+        """
+        cached_input_token_count = usage.get("cacheReadInputTokens", 0)
+        input_token_count = usage["inputTokens"] + cached_input_token_count + usage.get("cacheWriteInputTokens", 0)
+        return input_token_count, usage["outputTokens"], cached_input_token_count
+
+    def _get_response_usage(self, response) -> dict | None:
+        return response.get("usage") if isinstance(response, dict) else None
 
-        # Get usage
-        self.last_input_token_count = response["usage"]["inputTokens"]
-        self.last_output_token_count = response["usage"]["outputTokens"]
+    def _process_response(self, response: dict) -> ChatMessage:
+        self._set_token_counts_from_usage(response["usage"])
 
         # Get first message
         response["output"]["message"]["content"] = response["output"]["message"]["content"][0]["text"]
         return ChatMessage.from_dict(response["output"]["message"], raw=response)
 
+    def generate(
+        self,
+        messages: list[dict[str, str | list[dict]]],
+        stop_sequences: list[str] | None = None,
+        grammar: str | None = None,
+        tools_to_call_from: list[Tool] | None = None,
+        **kwargs,
+    ) -> ChatMessage:
+        # Stop sequences are only sent to `converse_stream`: some Bedrock models reject them in `converse` requests
+        completion_kwargs = self._prepare_api_completion_kwargs(
+            messages, stop_sequences=None, grammar=grammar, tools_to_call_from=tools_to_call_from, **kwargs
+        )
+        # self.client is created in ApiModel class
+        response = self.client.converse(**completion_kwargs)
+        return self._process_response(response)
+
+    async def agenerate(
+        self,
+        messages: list[dict[str, str | list[dict]]],
+        stop_sequences: list[str] | None = None,
+        grammar: str | None = None,
+        tools_to_call_from: list[Tool] | None = None,
+        **kwargs,
+    ) -> ChatMessage:
+        # Stop sequences are only sent to `converse_stream`: some Bedrock models reject them in `converse` requests
+        completion_kwargs = self._prepare_api_completion_kwargs(
+            messages, stop_sequences=None, grammar=grammar, tools_to_call_from=tools_to_call_from, **kwargs
+        )
+        client = await self.async_client.get()
+        response = await client.converse(**completion_kwargs)
+        return self._process_response(response)
+
+    def _process_stream_event(self, event: dict) -> ChatMessageStreamDelta | None:
+        """Convert an event of a Converse stream to a delta, recording the token counts of its metadata event."""
+        if "contentBlockStart" in event:
+            tool_use = event["contentBlockStart"]["start"].get("toolUse")
+            if tool_use is None:
+                return None
+            return ChatMessageStreamDelta(
+                tool_calls=[
+                    ChatMessageToolCallStreamDelta(
+                        index=event["contentBlockStart"]["contentBlockIndex"],
+                        id=tool_use["toolUseId"],
+                        type="function",
+                        name=tool_use["name"],
+                    )
+                ]
+            )
+        if "contentBlockDelta" in event:
+            delta = event["contentBlockDelta"]["delta"]
+            if "text" in delta:
+                return ChatMessageStreamDelta(content=delta["text"])
+            if "toolUse" in delta:
+                return ChatMessageStreamDelta(
+                    tool_calls=[
+                        ChatMessageToolCallStreamDelta(
+                            index=event["contentBlockDelta"]["contentBlockIndex"], arguments=delta["toolUse"]["input"]
+                        )
+                    ]
+                )
+            return None
+        if "metadata" in event:
+            self._set_token_counts_from_usage(event["metadata"]["usage"])
+            return None
+        # Errors during the stream are sent as events, like `throttlingException`
+        for key, value in event.items():
+            if key.endswith("Exception"):
+                raise ValueError(f"Error in the Bedrock stream: {key}: {value.get('message', value)}")
+        return None
+
+    def generate_stream(
+        self,
+        messages: list[dict[str, str | list[dict]]],
+        stop_sequences: list[str] | None = None,
+        grammar: str | None = None,
+        tools_to_call_from: list[Tool] | None = None,
+        **kwargs,
+    ) -> Generator[ChatMessageStreamDelta]:
+        completion_kwargs = self._prepare_api_completion_kwargs(
+            messages, stop_sequences=stop_sequences, grammar=grammar, tools_to_call_from=tools_to_call_from, **kwargs
+        )
+        response = self.client.converse_stream(**completion_kwargs)
+        yield from self._process_stream(response["stream"], stop_sequences)
+
+    async def agenerate_stream(
+        self,
+        messages: list[dict[str, str | list[dict]]],
+        stop_sequences: list[str] | None = None,
+        grammar: str | None = None,
+        tools_to_call_from: list[Tool] | None = None,
+        **kwargs,
+    ) -> AsyncGenerator[ChatMessageStreamDelta]:
+        completion_kwargs = self._prepare_api_completion_kwargs(
+            messages, stop_sequences=stop_sequences, grammar=grammar, tools_to_call_from=tools_to_call_from, **kwargs
+        )
+        client = await self.async_client.get()
+        response = await client.converse_stream(**completion_kwargs)
+        async for stream_delta in self._aprocess_stream(response["stream"], stop_sequences):
+            yield stream_delta
+
+
+def _expose_generate_stream(wrapper: Model, models: list[Model]):
+    """
+    Expose the `_generate_stream` method of a model wrapping others as its `generate_stream` method, only if all the
+    wrapped models support streaming, since agents check for `generate_stream`.
+    """
+    if all(hasattr(model, "generate_stream") for model in models):
+        wrapper.generate_stream = wrapper._generate_stream
+
+
+class CachedModel(Model):
+    """Wraps a model to store its responses in a local SQLite database, and replay them for identical requests.
+
+    Requests are keyed by a hash of the completion kwargs prepared by the wrapped model, which cover the messages,
+    stop sequences, tools, model id and sampling parameters: this is mostly useful with deterministic generation, for
+    instance at temperature 0 to rerun benchmarks or during development. Cache hits restore the `ChatMessage`, or the
+    streamed deltas, and the token counts of the original response. When the database grows over `max_size_bytes`,
+    the least recently used responses are evicted.
+
+    Parameters:
+        model (`Model`):
+            The model whose responses are cached.
+        cache_path (`str` or `Path`, *optional*):
+            Path of the SQLite database, which can be shared by several models and processes.
+            Defaults to `~/.cache/smolagents/model_cache.sqlite`.
+        max_size_bytes (`int`, default `1073741824`):
+            Maximum total size of the stored responses, in bytes.
+
+    Example:
+    ```python
+    >>> model = CachedModel(InferenceClientModel(model_id="Qwen/Qwen2.5-Coder-32B-Instruct", temperature=0))
+    >>> messages = [{"role": "user", "content": "Explain quantum mechanics in simple terms."}]
+    >>> response = model(messages)  # Calls the API
+    >>> response = model(messages)  # Replayed from the cache
+    >>> print(model.hits, model.misses)
+    1 1
+    ```
+    """
+
+    def __init__(self, model: Model, cache_path: str | Path | None = None, max_size_bytes: int = 1024**3):
+        super().__init__(model_id=model.model_id)
+        self.model = model
+        self.cache_path = Path(cache_path or Path.home() / ".cache" / "smolagents" / "model_cache.sqlite").expanduser()
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_size_bytes = max_size_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+        self._connection = sqlite3.connect(self.cache_path, check_same_thread=False, isolation_level=None)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses "
+            "(key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+        self.thread_safe = model.thread_safe
+        _expose_generate_stream(self, [model])
+
+    def get_cache_key(
+        self,
+        messages: list[dict[str, str | list[dict]]],
+        stop_sequences: list[str] | None = None,
+        grammar: str | None = None,
+        tools_to_call_from: list[Tool] | None = None,
+        stream: bool = False,
+        **kwargs,
+    ) -> str:
+        """Return the hash of the request, computed from the completion kwargs prepared by the wrapped model."""
+        prepare_completion_kwargs = getattr(
+            self.model, "_prepare_api_completion_kwargs", self.model._prepare_completion_kwargs
+        )
+        completion_kwargs = prepare_completion_kwargs(
+            messages,
+            stop_sequences=stop_sequences,
+            grammar=grammar,
+            tools_to_call_from=tools_to_call_from,
+            **kwargs,
+        )
+        request = {
+            "model_class": type(self.model).__name__,
+            "model_id": self.model.model_id,
+            "stop_sequences": stop_sequences,
+            "stream": stream,
+            "completion_kwargs": {key: value for key, value in completion_kwargs.items() if key != "api_key"},
+        }
+        canonical_request = json.dumps(request, sort_keys=True, separators=(",", ":"), default=_canonical_json_default)
+        return hashlib.sha256(canonical_request.encode()).hexdigest()
+
+    def generate(
+        self,
+        messages: list[dict[str, str | list[dict]]],
+        stop_sequences: list[str] | None = None,
+        grammar: str | None = None,
+        tools_to_call_from: list[Tool] | None = None,
+        **kwargs,
+    ) -> ChatMessage:
+        key = self.get_cache_key(
+            messages, stop_sequences=stop_sequences, grammar=grammar, tools_to_call_from=tools_to_call_from, **kwargs
+        )
+        if (entry := self._get_entry(key)) is not None:
+            self.hits += 1
+            self._set_token_counts(entry)
+            return ChatMessage.from_dict(entry["message"])
+        self.misses += 1
+        message = self.model.generate(
+            messages, stop_sequences=stop_sequences, grammar=grammar, tools_to_call_from=tools_to_call_from, **kwargs
+        )
+        entry = self._get_token_counts() | {"message": get_dict_from_nested_dataclasses(replace(message, raw=None))}
+        self._set_entry(key, entry)
+        self._set_token_counts(entry)
+        return message
+
+    def _generate_stream(
+        self,
+        messages: list[dict[str, str | list[dict]]],
+        stop_sequences: list[str] | None = None,
+        grammar: str | None = None,
+        tools_to_call_from: list[Tool] | None = None,
+        **kwargs,
+    ) -> Generator[ChatMessageStreamDelta]:
+        key = self.get_cache_key(
+            messages,
+            stop_sequences=stop_sequences,
+            grammar=grammar,
+            tools_to_call_from=tools_to_call_from,
+            stream=True,
+            **kwargs,
+        )
+        if (entry := self._get_entry(key)) is not None:
+            self.hits += 1
+            for stream_delta in entry["stream_deltas"]:
+                tool_calls = stream_delta["tool_calls"]
+                yield ChatMessageStreamDelta(
+                    content=stream_delta["content"],
+                    tool_calls=[
+                        ChatMessageToolCall(
+                            function=ChatMessageToolCallDefinition(**tool_call["function"]),
+                            id=tool_call["id"],
+                            type=tool_call["type"],
+                        )
+                        if "function" in tool_call
+                        else ChatMessageToolCallStreamDelta(**tool_call)
+                        for tool_call in tool_calls
+                    ]
+                    if tool_calls
+                    else None,
+                )
+            self._set_token_counts(entry)
+            return
+        self.misses += 1
+        stream_deltas = []
+        for stream_delta in self.model.generate_stream(
+            messages, stop_sequences=stop_sequences, grammar=grammar, tools_to_call_from=tools_to_call_from, **kwargs
+        ):
+            stream_deltas.append(get_dict_from_nested_dataclasses(stream_delta))
+            yield stream_delta
+        # Only complete streams are stored
+        entry = self._get_token_counts() | {"stream_deltas": stream_deltas}
+        self._set_entry(key, entry)
+        self._set_token_counts(entry)
+
+    def parse_tool_calls(self, message: ChatMessage) -> ChatMessage:
+        return self.model.parse_tool_calls(message)
+
+    def to_dict(self) -> dict:
+        return self.model.to_dict()
+
+    def clear(self):
+        """Remove all the responses from the cache."""
+        with self._lock:
+            self._connection.execute("DELETE FROM responses")
+
+    def _get_token_counts(self) -> dict[str, int | None]:
+        return {
+            "input_token_count": self.model.last_input_token_count,
+            "output_token_count": self.model.last_output_token_count,
+            "cached_input_token_count": getattr(self.model, "last_cached_input_token_count", None),
+        }
+
+    def _set_token_counts(self, entry: dict):
+        self.last_input_token_count = entry["input_token_count"]
+        self.last_output_token_count = entry["output_token_count"]
+        self.last_cached_input_token_count = entry.get("cached_input_token_count")
+
+    def _get_entry(self, key: str) -> dict | None:
+        with self._lock:
+            row = self._connection.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self._connection.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+        return json.loads(row[0])
+
+    def _set_entry(self, key: str, entry: dict):
+        value = json.dumps(entry)
+        size = len(value.encode())
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)", (key, value, size, time.time())
+            )
+            # Evict the least recently used responses
+            excess = self._connection.execute("SELECT SUM(size) FROM responses").fetchone()[0] - self.max_size_bytes
+            if excess > 0:
+                keys_to_evict = []
+                for evicted_key, evicted_size in self._connection.execute(
+                    "SELECT key, size FROM responses ORDER BY last_access"
+                ):
+                    if excess <= 0:
+                        break
+                    keys_to_evict.append((evicted_key,))
+                    excess -= evicted_size
+                self._connection.executemany("DELETE FROM responses WHERE key = ?", keys_to_evict)
+
+
+class RateLimiter:
+    """
+    Token buckets limiting the requests and the tokens sent per minute to a provider, shared by all the models using it.
+
+    Callers reserve their share of both buckets before sending a request, and wait for the time the buckets need to
+    refill: reservations are served in order, and the number of waiting callers is the queue depth. When the provider
+    rate limits a request anyway, all the callers are paused until the time it asks to retry after.
+
+    Args:
+        requests_per_minute (`float`, *optional*): Maximum number of requests per minute.
+        tokens_per_minute (`float`, *optional*): Maximum number of input and output tokens per minute.
+    """
+
+    def __init__(self, requests_per_minute: float | None = None, tokens_per_minute: float | None = None):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._lock = Lock()
+        now = time.monotonic()
+        # Buckets start full, with a minute of capacity, and may go negative with reservations
+        self._buckets = {
+            name: [limit, now] for name, limit in [("requests", requests_per_minute), ("tokens", tokens_per_minute)]
+        }
+        self._paused_until = 0.0
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.total_wait_time = 0.0
+        self.rate_limited_count = 0
+
+    def _take(self, name: str, amount: float, now: float) -> float:
+        """Take an amount from a bucket, and return how long to wait until it is available."""
+        limit = getattr(self, f"{name}_per_minute")
+        if limit is None:
+            return 0.0
+        bucket = self._buckets[name]
+        bucket[0] = min(limit, bucket[0] + (now - bucket[1]) * limit / 60)
+        bucket[1] = now
+        bucket[0] -= amount
+        return max(0.0, -bucket[0] * 60 / limit)
+
+    def reserve(self, token_count: int) -> float:
+        """
+        Reserve a request of `token_count` tokens, and return how long to wait before sending it. The caller must call
+        `wait_done` once it has waited.
+        """
+        with self._lock:
+            now = time.monotonic()
+            wait_time = max(
+                self._take("requests", 1, now), self._take("tokens", token_count, now), self._paused_until - now
+            )
+            self.queue_depth += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+            self.total_wait_time += wait_time
+            return wait_time
+
+    def wait_done(self):
+        with self._lock:
+            self.queue_depth -= 1
+
+    def acquire(self, token_count: int):
+        """Wait until a request of `token_count` tokens can be sent."""
+        try:
+            time.sleep(self.reserve(token_count))
+        finally:
+            self.wait_done()
+
+    async def aacquire(self, token_count: int):
+        """Async version of `acquire`."""
+        try:
+            await asyncio.sleep(self.reserve(token_count))
+        finally:
+            self.wait_done()
+
+    def record_usage(self, estimated_token_count: int, token_count: int):
+        """Correct the reservation of a request with the number of tokens it actually used."""
+        with self._lock:
+            if self.tokens_per_minute is not None:
+                self._buckets["tokens"][0] += estimated_token_count - token_count
+
+    def pause(self, delay: float):
+        """Pause all the requests for `delay` seconds, after the provider rate limited one."""
+        with self._lock:
+            self.rate_limited_count += 1
+            self._paused_until = max(self._paused_until, time.monotonic() + delay)
+
+    def get_metrics(self) -> dict[str, float]:
+        """Return the current and maximum queue depths, the total time spent waiting and the number of rate limits."""
+        with self._lock:
+            return {
+                "queue_depth": self.queue_depth,
+                "max_queue_depth": self.max_queue_depth,
+                "total_wait_time": self.total_wait_time,
+                "rate_limited_count": self.rate_limited_count,
+            }
+
+
+_rate_limiters: dict[tuple, RateLimiter] = {}
+_rate_limiters_lock = Lock()
+
+
+def get_rate_limiter(
+    key: tuple, requests_per_minute: float | None = None, tokens_per_minute: float | None = None
+) -> RateLimiter:
+    """Return the process-wide rate limiter of `key`, like a provider and model, creating it with the given limits."""
+    with _rate_limiters_lock:
+        key = key + (requests_per_minute, tokens_per_minute)
+        if key not in _rate_limiters:
+            _rate_limiters[key] = RateLimiter(requests_per_minute, tokens_per_minute)
+        return _rate_limiters[key]
+
+
+def _get_retry_after(error: Exception) -> float | None:
+    """Return the delay asked by the provider in a rate limit error, or `None` if the error is not a rate limit."""
+    response = getattr(error, "response", None)
+    if isinstance(response, dict):  # botocore
+        if response.get("Error", {}).get("Code") not in ("ThrottlingException", "TooManyRequestsException"):
+            return None
+        headers = response.get("ResponseMetadata", {}).get("HTTPHeaders", {})
+    else:
+        status_code = getattr(error, "status_code", None) or getattr(response, "status_code", None)
+        if status_code != 429:
+            return None
+        headers = getattr(response, "headers", None) or {}
+    headers = {key.lower(): value for key, value in dict(headers).items()}
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            try:
+                return float(headers["retry-after"])
+            except ValueError:  # HTTP date
+                retry_date = email.utils.parsedate_to_datetime(headers["retry-after"])
+                return max(0.0, retry_date.timestamp() - time.time())
+    except (TypeError, ValueError):
+        pass
+    return 0.0
+
+
+class RateLimitedModel(Model):
+    """Wraps a model to keep its requests under the rate limits of its provider, and retry the rate limited ones.
+
+    Requests wait for their share of the requests and tokens per minute of the provider and model, which are shared
+    by all the rate limited models using them in the process. Their tokens are estimated with the token counter of the
+    model, or from the length of the messages, plus the maximum number of output tokens, then corrected with the usage
+    reported by the provider for each call. Requests
+    rate limited by the provider anyway are retried with a jittered exponential backoff, or after the delay of its
+    `Retry-After` header.
+
+    Parameters:
+        model (`Model`):
+            The model whose requests are rate limited.
+        requests_per_minute (`float`, *optional*):
+            Maximum number of requests per minute.
+        tokens_per_minute (`float`, *optional*):
+            Maximum number of input and output tokens per minute.
+        max_retries (`int`, default `5`):
+            Maximum number of retries of a rate limited request.
+        base_delay (`float`, default `1.0`):
+            Delay in seconds before the first retry, doubled at each retry.
+        max_delay (`float`, default `60.0`):
+            Maximum delay in seconds before a retry.
+        rate_limiter (`RateLimiter`, *optional*):
+            Rate limiter to use, instead of the one shared by the models with the same provider and model id.
+
+    Example:
+    ```python
+    >>> model = RateLimitedModel(OpenAIServerModel(model_id="gpt-4o"), requests_per_minute=500, tokens_per_minute=30_000)
+    >>> response = model([{"role": "user", "content": "Explain quantum mechanics in simple terms."}])
+    >>> print(model.rate_limiter.get_metrics())
+    {'queue_depth': 0, 'max_queue_depth': 1, 'total_wait_time': 0.0, 'rate_limited_count': 0}
+    ```
+    """
+
+    def __init__(
+        self,
+        model: Model,
+        requests_per_minute: float | None = None,
+        tokens_per_minute: float | None = None,
+        max_retries: int = 5,
+        base_delay: float = 1.0,
+        max_delay: float = 60.0,
+        rate_limiter: RateLimiter | None = None,
+    ):
+        super().__init__(model_id=model.model_id)
+        self.model = model
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        client_kwargs = getattr(model, "client_kwargs", None) or {}
+        provider = getattr(model, "api_base", None) or client_kwargs.get("base_url") or client_kwargs.get("provider")
+        self.rate_limiter = rate_limiter or get_rate_limiter(
+            (type(model).__name__, provider, model.model_id), requests_per_minute, tokens_per_minute
+        )
+        self.thread_safe = model.thread_safe
+        _expose_generate_stream(self, [model])
+
+    def _estimate_token_count(
+        self, messages: list[dict[str, str | list[dict]]], tools_to_call_from: list[Tool] | None = None, **kwargs
+    ) -> int:
+        """
+        Estimate the tokens of a request: its input tokens, counted by the token counter of the model or else from
+        their number of characters, plus its maximum output tokens.
+        """
+        token_counter = getattr(self.model, "token_counter", None) or CharacterTokenCounter()
+        tools = [get_tool_json_schema(tool) for tool in tools_to_call_from] if tools_to_call_from else None
+        input_token_count = token_counter.count_tokens(messages, tools)
+        output_kwargs = {**getattr(self.model, "kwargs", {}), **kwargs}
+        max_output_tokens = next(
+            (
+                output_kwargs[key]
+                for key in ("max_tokens", "max_completion_tokens", "max_new_tokens")
+                if isinstance(output_kwargs.get(key), int)
+            ),
+            0,
+        )
+        return input_token_count + max_output_tokens
+
+    def _get_retry_delay(self, error: Exception, attempt: int) -> float | None:
+        """Return the delay before retrying a failed request, or `None` if it must not be retried."""
+        retry_after = _get_retry_after(error)
+        if retry_after is None or attempt >= self.max_retries:
+            return None
+        # Full jitter spreads the retries of the concurrent requests, but never before the provider's delay
+        backoff = random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+        delay = max(retry_after, backoff)
+        self.rate_limiter.pause(delay)
+        return delay
+
+    def _handle_failed_attempt(self, error: Exception, attempt: int, estimated_token_count: int):
+        """
+        Give back the tokens reserved for a failed attempt, which the provider did not process, then raise the error
+        if it must not be retried: the next attempt waits for the rate limiter.
+        """
+        self.rate_limiter.record_usage(estimated_token_count, 0)
+        if (delay := self._get_retry_delay(error, attempt)) is None:
+            raise error
+        logger.warning(f"Request rate limited, retrying in {delay:.1f}s: {error}")
+
+    def get_message_token_counts(self, message: ChatMessage) -> tuple[int | None, int | None]:
+        return self.model.get_message_token_counts(message)
+
+    def _record_usage(self, message: ChatMessage, estimated_token_count: int):
+        # The token counts of the wrapped model may be those of another call, when it is shared by several agents
+        self.last_input_token_count, self.last_output_token_count = self.model.get_message_token_counts(message)
+        self.last_cached_input_token_count = getattr(self.model, "last_cached_input_token_count", None)
+        if isinstance(self.last_input_token_count, int) and isinstance(self.last_output_token_count, int):
+            self.rate_limiter.record_usage(
+                estimated_token_count, self.last_input_token_count + self.last_output_token_count
+            )
+
+    def generate(
+        self,
+        messages: list[dict[str, str | list[dict]]],
+        stop_sequences: list[str] | None = None,
+        grammar: str | None = None,
+        tools_to_call_from: list[Tool] | None = None,
+        **kwargs,
+    ) -> ChatMessage:
+        estimated_token_count = self._estimate_token_count(messages, tools_to_call_from, **kwargs)
+        attempt = 0
+        while True:
+            self.rate_limiter.acquire(estimated_token_count)
+            try:
+                message = self.model.generate(
+                    messages,
+                    stop_sequences=stop_sequences,
+                    grammar=grammar,
+                    tools_to_call_from=tools_to_call_from,
+                    **kwargs,
+                )
+                break
+            except Exception as e:
+                self._handle_failed_attempt(e, attempt, estimated_token_count)
+                attempt += 1
+        self._record_usage(message, estimated_token_count)
+        return message
+
+    async def agenerate(
+        self,
+        messages: list[dict[str, str | list[dict]]],
+        stop_sequences: list[str] | None = None,
+        grammar: str | None = None,
+        tools_to_call_from: list[Tool] | None = None,
+        **kwargs,
+    ) -> ChatMessage:
+        estimated_token_count = self._estimate_token_count(messages, tools_to_call_from, **kwargs)
+        attempt = 0
+        while True:
+            await self.rate_limiter.aacquire(estimated_token_count)
+            try:
+                message = await self.model.agenerate(
+                    messages,
+                    stop_sequences=stop_sequences,
+                    grammar=grammar,
+                    tools_to_call_from=tools_to_call_from,
+                    **kwargs,
+                )
+                break
+            except Exception as e:
+                self._handle_failed_attempt(e, attempt, estimated_token_count)
+                attempt += 1
+        self._record_usage(message, estimated_token_count)
+        return message
+
+    def _generate_stream(
+        self,
+        messages: list[dict[str, str | list[dict]]],
+        stop_sequences: list[str] | None = None,
+        grammar: str | None = None,
+        tools_to_call_from: list[Tool] | None = None,
+        **kwargs,
+    ) -> Generator[ChatMessageStreamDelta]:
+        estimated_token_count = self._estimate_token_count(messages, tools_to_call_from, **kwargs)
+        attempt = 0
+        while True:
+            self.rate_limiter.acquire(estimated_token_count)
+            stream = self.model.generate_stream(
+                messages,
+                stop_sequences=stop_sequences,
+                grammar=grammar,
+                tools_to_call_from=tools_to_call_from,
+                **kwargs,
+            )
+            try:
+                # Rate limits are reported before the first delta: only then can the request be retried
+                first_stream_delta = next(stream, None)
+                break
+            except Exception as e:
+                self._handle_failed_attempt(e, attempt, estimated_token_count)
+                attempt += 1
+        accumulator = ChatMessageStreamAccumulator()
+        if first_stream_delta is not None:
+            accumulator.add(first_stream_delta)
+            yield first_stream_delta
+            for stream_delta in stream:
+                accumulator.add(stream_delta)
+                yield stream_delta
+        self._record_usage(accumulator.to_message(), estimated_token_count)
+
+    def parse_tool_calls(self, message: ChatMessage) -> ChatMessage:
+        return self.model.parse_tool_calls(message)
+
+    def to_dict(self) -> dict:
+        return self.model.to_dict()
+
+
+class _CircuitBreaker:
+    """
+    Stops sending requests to a backend after `failure_threshold` consecutive failures, for `recovery_timeout` seconds.
+    Then a single trial request is let through: its success closes the circuit, its failure opens it again.
+    """
+
+    def __init__(self, failure_threshold: int, recovery_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self._lock = Lock()
+        self.failure_count = 0
+        self.opened_at: float | None = None
+        self._trial_in_progress = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if time.monotonic() - self.opened_at >= self.recovery_timeout else "open"
+
+    def allow_request(self) -> bool:
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half_open" and not self._trial_in_progress:
+                self._trial_in_progress = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failure_count = 0
+            self.opened_at = None
+            self._trial_in_progress = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failure_count += 1
+            if self._trial_in_progress or self.failure_count >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self._trial_in_progress = False
+
+    def release_trial(self):
+        """Let another trial request through, when the trial request was cancelled before its result was known."""
+        with self._lock:
+            self._trial_in_progress = False
+
+
+class HedgedModel(Model):
+    """Routes the requests to several models, hedging the slow ones and falling back on the failing ones.
+
+    Requests are sent to the first of the models whose circuit breaker is closed. If it has not answered after the
+    `hedge_percentile` percentile of its recent latencies, the request is also sent to the next model, and the first
+    answer is returned: the other requests are cancelled, or their answers discarded if the model cannot be
+    interrupted during a synchronous call. Failed requests fall back on the next model, and the circuit breaker of a
+    model failing `failure_threshold` times in a row stops sending it requests for `recovery_timeout` seconds.
+
+    Token counts are those of the call that answered. The tokens of discarded answers are counted in the metrics, but
+    those of cancelled requests are unknown, as providers only report usage with complete answers.
+
+    Streamed requests are not hedged, since their output is already consumed, but fall back on the next model when
+    they fail before their first delta.
+
+    Parameters:
+        models (`list[Model]`):
+            The models to route the requests to, by order of preference.
+        hedge_percentile (`float`, default `95`):
+            Percentile of the latencies of a model after which a request to it is hedged.
+        hedge_delay (`float`, *optional*):
+            Delay in seconds after which requests are hedged while a model has less than `min_latency_samples`
+            latencies, or never hedge them before if `None`.
+        min_latency_samples (`int`, default `10`):
+            Number of latencies of a model needed to compute their percentile.
+        latency_window (`int`, default `100`):
+            Number of the most recent latencies of each model to keep.
+        failure_threshold (`int`, default `3`):
+            Number of consecutive failures of a model opening its circuit breaker.
+        recovery_timeout (`float`, default `30.0`):
+            Delay in seconds before a model with an open circuit breaker is tried again.
+        max_hedges (`int`, default `1`):
+            Maximum number of hedged requests sent for a request, each after the hedge delay of the previous one.
+            Synchronous calls run in a pool of `len(models) * max_hedges` threads.
+
+    Example:
+    ```python
+    >>> model = HedgedModel([OpenAIServerModel(model_id="gpt-4o"), AzureOpenAIServerModel(model_id="gpt-4o")])
+    >>> response = model([{"role": "user", "content": "Explain quantum mechanics in simple terms."}])
+    >>> print(model.get_metrics())
+    {'requests': 1, 'hedged_requests': 0, 'hedge_wins': 0, 'fallbacks': 0, 'discarded_input_tokens': 0, 'discarded_output_tokens': 0, 'circuit_states': ['closed', 'closed']}
+    ```
+    """
+
+    def __init__(
+        self,
+        models: list[Model],
+        hedge_percentile: float = 95,
+        hedge_delay: float | None = None,
+        min_latency_samples: int = 10,
+        latency_window: int = 100,
+        failure_threshold: int = 3,
+        recovery_timeout: float = 30.0,
+        max_hedges: int = 1,
+    ):
+        if len(models) < 2:
+            raise ValueError("HedgedModel needs at least two models to route the requests to.")
+        if max_hedges < 1:
+            raise ValueError("max_hedges must be at least 1.")
+        super().__init__(model_id=models[0].model_id)
+        self.models = models
+        self.hedge_percentile = hedge_percentile
+        self.hedge_delay = hedge_delay
+        self.max_hedges = max_hedges
+        self.min_latency_samples = min_latency_samples
+        self.latencies = [deque(maxlen=latency_window) for _ in models]
+        self.circuit_breakers = [_CircuitBreaker(failure_threshold, recovery_timeout) for _ in models]
+        self._metrics_lock = Lock()
+        self._metrics = {
+            "requests": 0,
+            "hedged_requests": 0,
+            "hedge_wins": 0,
+            "fallbacks": 0,
+            "discarded_input_tokens": 0,
+            "discarded_output_tokens": 0,
+        }
+        self._executor = ThreadPoolExecutor(max_workers=len(models) * max_hedges, thread_name_prefix="hedged-model")
+        self._last_model = models[0]
+        self.thread_safe = all(model.thread_safe for model in models)
+        _expose_generate_stream(self, models)
+
+    def _count(self, metric: str, amount: int = 1):
+        with self._metrics_lock:
+            self._metrics[metric] += amount
+
+    def _count_discarded_tokens(self, future: "Future | asyncio.Task"):
+        """Count the tokens of a call whose answer is discarded, once it is complete."""
+        if future.cancelled() or future.exception() is not None:
+            return
+        for metric, token_count in zip(("discarded_input_tokens", "discarded_output_tokens"), future.result()[1]):
+            if isinstance(token_count, int):
+                self._count(metric, token_count)
+
+    def get_metrics(self) -> dict[str, Any]:
+        """
+        Return the number of requests, hedged requests, hedges answering first and fallbacks, the tokens of discarded
+        answers, and the circuit states.
+        """
+        with self._metrics_lock:
+            return self._metrics | {"circuit_states": [breaker.state for breaker in self.circuit_breakers]}
+
+    def _release_cancelled_trial(self, index: int, future: "Future | asyncio.Task"):
+        """Release the trial of a half-open circuit breaker whose request was cancelled, as it records no result."""
+        if future.cancelled():
+            self.circuit_breakers[index].release_trial()
+
+    def _get_hedge_delay(self, index: int) -> float | None:
+        latencies = sorted(self.latencies[index])
+        if len(latencies) < self.min_latency_samples:
+            return self.hedge_delay
+        return latencies[min(len(latencies) - 1, int(len(latencies) * self.hedge_percentile / 100))]
+
+    def _next_backend(self, backends: Generator[int]) -> int | None:
+        """Return the next model whose circuit breaker lets a request through."""
+        return next((index for index in backends if self.circuit_breakers[index].allow_request()), None)
+
+    def _record_result(self, index: int, start_time: float, error: Exception | None = None):
+        if error is None:
+            self.latencies[index].append(time.monotonic() - start_time)
+            self.circuit_breakers[index].record_success()
+        else:
+            logger.warning(f"Model {self.models[index].model_id} failed: {error}")
+            self.circuit_breakers[index].record_failure()
+
+    def _call_model(self, index: int, *args, **kwargs) -> tuple[ChatMessage, tuple]:
+        model, start_time = self.models[index], time.monotonic()
+        try:
+            message = model.generate(*args, **kwargs)
+        except Exception as e:
+            self._record_result(index, start_time, e)
+            raise
+        self._record_result(index, start_time)
+        return message, model.get_message_token_counts(message)
+
+    async def _acall_model(self, index: int, *args, **kwargs) -> tuple[ChatMessage, tuple]:
+        model, start_time = self.models[index], time.monotonic()
+        try:
+            message = await model.agenerate(*args, **kwargs)
+        except Exception as e:
+            self._record_result(index, start_time, e)
+            raise
+        self._record_result(index, start_time)
+        return message, model.get_message_token_counts(message)
+
+    def _set_winner(self, index: int, is_hedge: bool, token_counts: tuple):
+        if is_hedge:
+            self._count("hedge_wins")
+        self._last_model = self.models[index]
+        self.last_input_token_count, self.last_output_token_count = token_counts
+
+    def _get_all_failed_error(self, errors: list[Exception]) -> Exception:
+        if errors:
+            return errors[-1]
+        return RuntimeError("All the models of the HedgedModel have an open circuit breaker.")
+
+    def generate(
+        self,
+        messages: list[dict[str, str | list[dict]]],
+        stop_sequences: list[str] | None = None,
+        grammar: str | None = None,
+        tools_to_call_from: list[Tool] | None = None,
+        **kwargs,
+    ) -> ChatMessage:
+        self._count("requests")
+        kwargs = dict(stop_sequences=stop_sequences, grammar=grammar, tools_to_call_from=tools_to_call_from, **kwargs)
+        backends = iter(range(len(self.models)))
+        pending, errors, hedge_count = {}, [], 0
+
+        def send_request() -> int | None:
+            if (index := self._next_backend(backends)) is not None:
+                future = self._executor.submit(self._call_model, index, messages, **kwargs)
+                future.add_done_callback(partial(self._release_cancelled_trial, index))
+                pending[future] = index
+            return index
+
+        if (primary_index := send_request()) is None:
+            raise self._get_all_failed_error(errors)
+        hedge_delay, start_time = self._get_hedge_delay(primary_index), time.monotonic()
+        while pending:
+            timeout = None
+            if hedge_count < self.max_hedges and hedge_delay is not None:
+                timeout = max(0.0, start_time + hedge_delay - time.monotonic())
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                hedge_count, start_time = hedge_count + 1, time.monotonic()
+                if send_request() is not None:
+                    self._count("hedged_requests")
+                continue
+            for future in done:
+                index = pending.pop(future)
+                try:
+                    message, token_counts = future.result()
+                except Exception as e:
+                    errors.append(e)
+                    continue
+                for other_future in pending:
+                    # Calls already running cannot be interrupted: their tokens are counted once they end
+                    other_future.cancel()
+                    other_future.add_done_callback(self._count_discarded_tokens)
+                self._set_winner(index, index != primary_index, token_counts)
+                return message
+            if not pending and (primary_index := send_request()) is not None:
+                # Fall back on the next model, which may be hedged in turn
+                self._count("fallbacks")
+                hedge_count, hedge_delay, start_time = 0, self._get_hedge_delay(primary_index), time.monotonic()
+        raise self._get_all_failed_error(errors)
+
+    async def agenerate(
+        self,
+        messages: list[dict[str, str | list[dict]]],
+        stop_sequences: list[str] | None = None,
+        grammar: str | None = None,
+        tools_to_call_from: list[Tool] | None = None,
+        **kwargs,
+    ) -> ChatMessage:
+        self._count("requests")
+        kwargs = dict(stop_sequences=stop_sequences, grammar=grammar, tools_to_call_from=tools_to_call_from, **kwargs)
+        backends = iter(range(len(self.models)))
+        pending, errors, hedge_count = {}, [], 0
+
+        def send_request() -> int | None:
+            if (index := self._next_backend(backends)) is not None:
+                # Tasks cancelled before they start never run the call: the callback releases the trial in all cases
+                task = asyncio.ensure_future(self._acall_model(index, messages, **kwargs))
+                task.add_done_callback(partial(self._release_cancelled_trial, index))
+                pending[task] = index
+            return index
+
+        if (primary_index := send_request()) is None:
+            raise self._get_all_failed_error(errors)
+        hedge_delay, start_time = self._get_hedge_delay(primary_index), time.monotonic()
+        try:
+            while pending:
+                timeout = None
+                if hedge_count < self.max_hedges and hedge_delay is not None:
+                    timeout = max(0.0, start_time + hedge_delay - time.monotonic())
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedge_count, start_time = hedge_count + 1, time.monotonic()
+                    if send_request() is not None:
+                        self._count("hedged_requests")
+                    continue
+                for task in done:
+                    index = pending.pop(task)
+                    try:
+                        message, token_counts = task.result()
+                    except Exception as e:
+                        errors.append(e)
+                        continue
+                    self._set_winner(index, index != primary_index, token_counts)
+                    return message
+                if not pending and (primary_index := send_request()) is not None:
+                    self._count("fallbacks")
+                    hedge_count, hedge_delay, start_time = 0, self._get_hedge_delay(primary_index), time.monotonic()
+            raise self._get_all_failed_error(errors)
+        finally:
+            # Cancel the requests still running, when another one answered first or this one is cancelled
+            for task in pending:
+                if task.done():
+                    self._count_discarded_tokens(task)
+                else:
+                    task.cancel()
+
+    def _generate_stream(
+        self,
+        messages: list[dict[str, str | list[dict]]],
+        stop_sequences: list[str] | None = None,
+        grammar: str | None = None,
+        tools_to_call_from: list[Tool] | None = None,
+        **kwargs,
+    ) -> Generator[ChatMessageStreamDelta]:
+        self._count("requests")
+        backends = iter(range(len(self.models)))
+        errors = []
+        while (index := self._next_backend(backends)) is not None:
+            if errors:
+                self._count("fallbacks")
+            model, start_time = self.models[index], time.monotonic()
+            stream = model.generate_stream(
+                messages,
+                stop_sequences=stop_sequences,
+                grammar=grammar,
+                tools_to_call_from=tools_to_call_from,
+                **kwargs,
+            )
+            try:
+                first_stream_delta = next(stream, None)
+            except Exception as e:
+                self._record_result(index, start_time, e)
+                errors.append(e)
+                continue
+            # The latency of a stream is its time to first delta
+            self._record_result(index, start_time)
+            self._last_model = model
+            accumulator = ChatMessageStreamAccumulator()
+            if first_stream_delta is not None:
+                accumulator.add(first_stream_delta)
+                yield first_stream_delta
+                for stream_delta in stream:
+                    accumulator.add(stream_delta)
+                    yield stream_delta
+            self.last_input_token_count, self.last_output_token_count = model.get_message_token_counts(
+                accumulator.to_message()
+            )
+            return
+        raise self._get_all_failed_error(errors)
+
+    def parse_tool_calls(self, message: ChatMessage) -> ChatMessage:
+        return self._last_model.parse_tool_calls(message)
+
+    def to_dict(self) -> dict:
+        return self.models[0].to_dict()
+
+
+def _canonical_json_default(obj: Any) -> Any:
+    """Serialize the objects that JSON does not support in cache keys."""
+    if hasattr(obj, "tobytes"):  # Images and arrays: the same bytes can have different sizes and modes
+        shape = getattr(obj, "size", None) if hasattr(obj, "mode") else getattr(obj, "shape", None)
+        mode = getattr(obj, "mode", None) or str(getattr(obj, "dtype", ""))
+        digest = hashlib.sha256(obj.tobytes()).hexdigest()
+        return [type(obj).__name__, list(shape) if shape is not None else None, mode, digest]
+    if isinstance(obj, bytes):
+        return hashlib.sha256(obj).hexdigest()
+    if is_dataclass(obj):
+        return asdict(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} cannot be serialized in a cache key")
+
 
 __all__ = [
     "MessageRole",
     "tool_role_conversions",
     "get_clean_message_list",
+    "CleanMessageListCache",
     "Model",
     "MLXModel",
     "TransformersModel",
@@ -1699,4 +4557,15 @@ __all__ = [
     "AzureOpenAIServerModel",
     "AmazonBedrockServerModel",
     "ChatMessage",
+    "ChatMessageStreamAccumulator",
+    "CachedModel",
+    "ClientRegistry",
+    "ConnectionPoolConfig",
+    "RateLimitedModel",
+    "RateLimiter",
+    "HedgedModel",
+    "TokenCounter",
+    "CharacterTokenCounter",
+    "TiktokenTokenCounter",
+    "TransformersTokenCounter",
 ]
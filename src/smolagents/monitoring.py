@@ -40,17 +40,25 @@ class Monitor:
         if getattr(self.tracked_model, "last_input_token_count", "Not found") != "Not found":
             self.total_input_token_count = 0
             self.total_output_token_count = 0
+            self.total_cached_input_token_count = 0
+        # Input tokens of each step served from the prompt cache of the provider, and not served from it
+        self.step_cached_input_token_counts = []
+        self.step_uncached_input_token_counts = []
 
     def get_total_token_counts(self):
         return {
             "input": self.total_input_token_count,
             "output": self.total_output_token_count,
+            "cached_input": self.total_cached_input_token_count,
         }
 
     def reset(self):
         self.step_durations = []
         self.total_input_token_count = 0
         self.total_output_token_count = 0
+        self.total_cached_input_token_count = 0
+        self.step_cached_input_token_counts = []
+        self.step_uncached_input_token_counts = []
 
     def update_metrics(self, step_log):
         """Update the metrics of the monitor.
@@ -65,9 +73,27 @@ class Monitor:
         if getattr(self.tracked_model, "last_input_token_count", None) is not None:
             self.total_input_token_count += self.tracked_model.last_input_token_count
             self.total_output_token_count += self.tracked_model.last_output_token_count
+            cached_input_token_count = getattr(self.tracked_model, "last_cached_input_token_count", None)
+            if not isinstance(cached_input_token_count, int):
+                cached_input_token_count = 0  # Not reported by the model
+            self.total_cached_input_token_count += cached_input_token_count
+            self.step_cached_input_token_counts.append(cached_input_token_count)
+            self.step_uncached_input_token_counts.append(
+                self.tracked_model.last_input_token_count - cached_input_token_count
+            )
             console_outputs += (
                 f"| Input tokens: {self.total_input_token_count:,} | Output tokens: {self.total_output_token_count:,}"
             )
+            if self.total_cached_input_token_count:
+                console_outputs += (
+                    f" | Cached input tokens: {self.total_cached_input_token_count:,}"
+                    f" (step: {cached_input_token_count:,} cached,"
+                    f" {self.step_uncached_input_token_counts[-1]:,} uncached)"
+                )
+        elif isinstance(getattr(self.tracked_model, "last_output_token_count", None), int):
+            # The input tokens of the step are unknown, but its output tokens still count
+            self.total_output_token_count += self.tracked_model.last_output_token_count
+            console_outputs += f"| Output tokens: {self.total_output_token_count:,}"
         console_outputs += "]"
         self.logger.log(Text(console_outputs, style="dim"), level=1)
 
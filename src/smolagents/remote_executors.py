@@ -14,12 +14,25 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import asyncio
 import base64
 import json
+import mmap
 import pickle
 import re
+import select
+import signal
+import struct
+import subprocess
+import sys
+import threading
 import time
+import uuid
+import weakref
+from collections.abc import AsyncGenerator
 from io import BytesIO
+from logging import getLogger
+from multiprocessing import shared_memory
 from pathlib import Path
 from textwrap import dedent
 from typing import Any
@@ -30,9 +43,11 @@ import requests
 from .local_python_executor import PythonExecutor
 from .monitoring import LogLevel
 from .tools import Tool, get_tools_definition_code
-from .utils import AgentError
+from .utils import AgentError, AgentExecutionError
 
 
+logger = getLogger(__name__)
+
 try:
     from dotenv import load_dotenv
 
@@ -41,6 +56,46 @@ except ModuleNotFoundError:
     pass
 
 
+RESULT_MIMETYPE = "application/vnd.smolagents.result+pickle"
+
+# Defines the kernel-side helper used to send results as `display_data` messages, instead of printing them to stdout.
+# `final_answer` is defined as a fallback until the final_answer tool is sent, see `FINAL_ANSWER_WRAPPER_CODE`.
+KERNEL_SETUP_CODE = dedent(
+    f"""\
+    import base64 as _smolagents_base64
+    import pickle as _smolagents_pickle
+
+    from IPython.display import display as _smolagents_display
+
+
+    def _smolagents_send_result(value, is_final_answer=False):
+        _smolagents_display(
+            {{"{RESULT_MIMETYPE}": _smolagents_base64.b64encode(_smolagents_pickle.dumps(value)).decode()}},
+            metadata={{"{RESULT_MIMETYPE}": {{"is_final_answer": is_final_answer}}}},
+            raw=True,
+        )
+        return value
+
+
+    def final_answer(answer):
+        return _smolagents_send_result(answer, is_final_answer=True)
+    """
+)
+
+# Frames the pickled requests and responses exchanged with the kernel of `SubprocessExecutor`
+SUBPROCESS_MESSAGE_HEADER = struct.Struct("!Q")
+
+FINAL_ANSWER_WRAPPER_CODE = dedent(
+    """\
+    _smolagents_final_answer_tool = final_answer
+
+
+    def final_answer(*args, **kwargs):
+        return _smolagents_send_result(_smolagents_final_answer_tool(*args, **kwargs), is_final_answer=True)
+    """
+)
+
+
 class RemotePythonExecutor(PythonExecutor):
     def __init__(self, additional_imports: list[str], logger):
         self.additional_imports = additional_imports
@@ -52,6 +107,10 @@ class RemotePythonExecutor(PythonExecutor):
     def run_code_raise_errors(self, code: str, return_final_answer: bool = False) -> tuple[Any, str]:
         raise NotImplementedError
 
+    async def arun_code_raise_errors(self, code: str, return_final_answer: bool = False) -> tuple[Any, str]:
+        """Async version of `run_code_raise_errors`: by default, runs it in a worker thread."""
+        return await asyncio.to_thread(self.run_code_raise_errors, code, return_final_answer)
+
     def send_tools(self, tools: dict[str, Tool]):
         # Install tool packages
         packages_to_install = {
@@ -72,13 +131,16 @@ class RemotePythonExecutor(PythonExecutor):
         """
         Send variables to the kernel namespace using pickle.
         """
+        self.run_code_raise_errors(self._get_variables_code(variables))
+
+    @staticmethod
+    def _get_variables_code(variables: dict) -> str:
         pickled_vars = base64.b64encode(pickle.dumps(variables)).decode()
-        code = f"""
+        return f"""
 import pickle, base64
 vars_dict = pickle.loads(base64.b64decode('{pickled_vars}'))
 locals().update(vars_dict)
 """
-        self.run_code_raise_errors(code)
 
     def __call__(self, code_action: str) -> tuple[Any, str, bool]:
         """Check if code is a final answer and run it accordingly"""
@@ -86,6 +148,12 @@ locals().update(vars_dict)
         output = self.run_code_raise_errors(code_action, return_final_answer=is_final_answer)
         return output[0], output[1], is_final_answer
 
+    async def acall(self, code_action: str) -> tuple[Any, str, bool]:
+        """Async version of `__call__`."""
+        is_final_answer = bool(self.final_answer_pattern.search(code_action))
+        output = await self.arun_code_raise_errors(code_action, return_final_answer=is_final_answer)
+        return output[0], output[1], is_final_answer
+
     def install_packages(self, additional_imports: list[str]):
         if additional_imports:
             _, execution_logs = self.run_code_raise_errors(f"!pip install {' '.join(additional_imports)}")
@@ -100,11 +168,13 @@ class E2BExecutor(RemotePythonExecutor):
     Args:
         additional_imports (`list[str]`): Additional imports to install.
         logger (`Logger`): Logger to use.
+        execution_timeout (`float`, *optional*): Maximum duration in seconds of the execution of a code action.
         **kwargs: Additional arguments to pass to the E2B Sandbox.
     """
 
-    def __init__(self, additional_imports: list[str], logger, **kwargs):
+    def __init__(self, additional_imports: list[str], logger, execution_timeout: float | None = None, **kwargs):
         super().__init__(additional_imports, logger)
+        self.execution_timeout = execution_timeout
         try:
             from e2b_code_interpreter import Sandbox
         except ModuleNotFoundError:
@@ -115,10 +185,23 @@ class E2BExecutor(RemotePythonExecutor):
         self.installed_packages = self.install_packages(additional_imports)
         self.logger.log("E2B is running", level=LogLevel.INFO)
 
-    def run_code_raise_errors(self, code: str, return_final_answer: bool = False) -> tuple[Any, str]:
-        execution = self.sandbox.run_code(
-            code,
+    def __call__(self, code_action: str) -> tuple[Any, str, bool]:
+        """Check if code is a final answer and run it accordingly, within the execution timeout"""
+        is_final_answer = bool(self.final_answer_pattern.search(code_action))
+        output = self.run_code_raise_errors(
+            code_action, return_final_answer=is_final_answer, timeout=self.execution_timeout
         )
+        return output[0], output[1], is_final_answer
+
+    def run_code_raise_errors(
+        self, code: str, return_final_answer: bool = False, timeout: float | None = None
+    ) -> tuple[Any, str]:
+        from e2b_code_interpreter import TimeoutException
+
+        try:
+            execution = self.sandbox.run_code(code, timeout=timeout)
+        except TimeoutException as e:
+            raise AgentExecutionError(f"Code execution timed out after {timeout} seconds: {e}", self.logger) from e
         if execution.error:
             execution_logs = "\n".join([str(log) for log in execution.logs.stdout])
             logs = execution_logs
@@ -157,9 +240,228 @@ class E2BExecutor(RemotePythonExecutor):
             return None, execution_logs
 
 
+class KernelTimeoutError(TimeoutError):
+    """
+    Raised when an execution on a kernel exceeds its timeout. `kernel_restarted` tells whether the kernel had to be
+    restarted to stop it, and `kernel_stopped` whether it could be stopped at all.
+    """
+
+    def __init__(self, message: str, kernel_restarted: bool = False, kernel_stopped: bool = True):
+        super().__init__(message)
+        self.kernel_restarted = kernel_restarted
+        self.kernel_stopped = kernel_stopped
+
+
+class KernelGatewayClient:
+    """
+    Asyncio client for the kernels of Jupyter Kernel Gateway servers.
+
+    A single event loop, running in a background thread, serves the websocket connections of all the kernels
+    connected to the client. Incoming messages are routed to the pending execution requests using their
+    `parent_header.msg_id`, so that many executors can wait on their kernels without each holding a thread.
+
+    Coroutines of the client must run on its event loop: use `submit` to await them from another event loop,
+    or `run` to wait for them from synchronous code.
+
+    Args:
+        interrupt_timeout (`float`, default `10`): After interrupting a kernel, how long in seconds to wait for it
+            to become idle before restarting it.
+        request_timeout (`float`, default `30`): Timeout in seconds of the requests to the gateway REST API, to
+            interrupt or restart a kernel.
+    """
+
+    _default_client: "KernelGatewayClient | None" = None
+    _default_client_lock = threading.Lock()
+
+    def __init__(self, interrupt_timeout: float = 10, request_timeout: float = 30):
+        try:
+            import websockets  # noqa: F401
+        except ModuleNotFoundError:
+            raise ModuleNotFoundError(
+                "Please install 'docker' extra to use KernelGatewayClient: `pip install 'smolagents[docker]'`"
+            )
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name="kernel-gateway-client", daemon=True)
+        self._thread.start()
+        self.interrupt_timeout = interrupt_timeout
+        self.request_timeout = request_timeout
+        self._base_urls: dict[str, str] = {}
+        self._connections: dict[str, Any] = {}
+        self._readers: dict[str, asyncio.Task] = {}
+        # Maps the msg_id of each pending execute request to its kernel_id and its message queue
+        self._pending_requests: dict[str, tuple[str, asyncio.Queue]] = {}
+
+    @classmethod
+    def get_default(cls) -> "KernelGatewayClient":
+        """Return the client shared by all executors of the process, creating it if needed."""
+        with cls._default_client_lock:
+            if cls._default_client is None:
+                cls._default_client = cls()
+            return cls._default_client
+
+    def run(self, coroutine):
+        """Run a coroutine on the client event loop and wait for its result."""
+        if threading.current_thread() is self._thread:
+            raise RuntimeError("KernelGatewayClient.run cannot be called from the client event loop: await instead.")
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    async def submit(self, coroutine):
+        """Await a coroutine on the client event loop, from any event loop."""
+        if asyncio.get_running_loop() is self.loop:
+            return await coroutine
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coroutine, self.loop))
+
+    async def connect(self, base_url: str, kernel_id: str):
+        """Open the websocket connection to a kernel of the gateway at `base_url` and start routing its messages."""
+        import websockets
+
+        ws_url = f"{base_url.replace('http', 'ws', 1)}/api/kernels/{kernel_id}/channels"
+        websocket = await websockets.connect(ws_url, max_size=None)
+        self._base_urls[kernel_id] = base_url
+        self._connections[kernel_id] = websocket
+        self._readers[kernel_id] = asyncio.create_task(self._read_messages(kernel_id, websocket))
+
+    async def disconnect(self, kernel_id: str):
+        """Close the websocket connection to a kernel."""
+        self._base_urls.pop(kernel_id, None)
+        websocket = self._connections.pop(kernel_id, None)
+        if websocket is not None:
+            await websocket.close()
+        reader = self._readers.pop(kernel_id, None)
+        if reader is not None:
+            await asyncio.gather(reader, return_exceptions=True)
+
+    async def _read_messages(self, kernel_id: str, websocket):
+        try:
+            async for raw_message in websocket:
+                message = json.loads(raw_message)
+                pending_request = self._pending_requests.get(message.get("parent_header", {}).get("msg_id"))
+                if pending_request is not None:
+                    pending_request[1].put_nowait(message)
+        except Exception as e:
+            logger.debug(f"Connection to kernel {kernel_id} failed: {e}")
+        finally:
+            if self._connections.get(kernel_id) is websocket:
+                del self._connections[kernel_id]
+            # Wake up the requests still waiting on this kernel
+            for request_kernel_id, queue in list(self._pending_requests.values()):
+                if request_kernel_id == kernel_id:
+                    queue.put_nowait(None)
+
+    async def execute(self, kernel_id: str, code: str, timeout: float | None = None) -> AsyncGenerator[dict]:
+        """
+        Send an execute request to a kernel, and yield the messages it produces until the kernel is idle again.
+
+        If the execution exceeds `timeout`, the kernel is interrupted and the remaining messages of the request are
+        drained. If the kernel does not become idle within `interrupt_timeout`, it is restarted, losing its state.
+        A [`KernelTimeoutError`] is then raised, also when the kernel could not be restarted.
+
+        Args:
+            kernel_id (`str`): ID of a kernel connected with `connect`.
+            code (`str`): Code to execute.
+            timeout (`float`, *optional*): Maximum duration of the execution in seconds.
+        """
+        if kernel_id not in self._connections:
+            raise ConnectionError(f"Kernel {kernel_id} is not connected.")
+        msg_id = str(uuid.uuid4())
+        queue = asyncio.Queue()
+        self._pending_requests[msg_id] = (kernel_id, queue)
+        deadline = self.loop.time() + timeout if timeout is not None else None
+        try:
+            await self._connections[kernel_id].send(json.dumps(self._make_execute_request(msg_id, code)))
+            while True:
+                try:
+                    message = await asyncio.wait_for(
+                        queue.get(), timeout=max(deadline - self.loop.time(), 0) if deadline is not None else None
+                    )
+                except asyncio.TimeoutError:
+                    error_message = f"Execution on kernel {kernel_id} exceeded the timeout of {timeout} seconds."
+                    try:
+                        kernel_restarted = await self._stop_execution(kernel_id, queue)
+                    except Exception as e:
+                        raise KernelTimeoutError(
+                            f"{error_message} It could not be restarted: {e}", kernel_stopped=False
+                        ) from e
+                    raise KernelTimeoutError(error_message, kernel_restarted=kernel_restarted) from None
+                if message is None:
+                    raise ConnectionError(f"Connection to kernel {kernel_id} was closed.")
+                yield message
+                if self._is_idle_status(message):
+                    return
+        finally:
+            self._pending_requests.pop(msg_id, None)
+
+    async def interrupt(self, kernel_id: str):
+        """Interrupt the execution running on a kernel, using the gateway REST API."""
+        response = await asyncio.to_thread(
+            requests.post,
+            f"{self._base_urls[kernel_id]}/api/kernels/{kernel_id}/interrupt",
+            timeout=self.request_timeout,
+        )
+        response.raise_for_status()
+
+    async def restart(self, kernel_id: str):
+        """Restart a kernel using the gateway REST API, and reconnect to it. The kernel state is lost."""
+        base_url = self._base_urls[kernel_id]
+        response = await asyncio.to_thread(
+            requests.post, f"{base_url}/api/kernels/{kernel_id}/restart", timeout=self.request_timeout
+        )
+        response.raise_for_status()
+        await self.disconnect(kernel_id)
+        await self.connect(base_url, kernel_id)
+
+    async def _stop_execution(self, kernel_id: str, queue: asyncio.Queue) -> bool:
+        """Interrupt a kernel and drain the messages of its current request. Returns whether it had to be restarted."""
+        try:
+            await self.interrupt(kernel_id)
+            await asyncio.wait_for(self._drain(queue), timeout=self.interrupt_timeout)
+            return False
+        except Exception as e:
+            logger.warning(f"Kernel {kernel_id} did not stop after interrupt, restarting it: {e}")
+            await self.restart(kernel_id)
+            return True
+
+    async def _drain(self, queue: asyncio.Queue):
+        while True:
+            message = await queue.get()
+            if message is None:
+                raise ConnectionError("Connection to the kernel was closed.")
+            if self._is_idle_status(message):
+                return
+
+    @staticmethod
+    def _is_idle_status(message: dict) -> bool:
+        return message.get("msg_type") == "status" and message["content"]["execution_state"] == "idle"
+
+    @staticmethod
+    def _make_execute_request(msg_id: str, code: str) -> dict:
+        return {
+            "header": {
+                "msg_id": msg_id,
+                "username": "anonymous",
+                "session": str(uuid.uuid4()),
+                "msg_type": "execute_request",
+                "version": "5.0",
+            },
+            "parent_header": {},
+            "metadata": {},
+            "content": {
+                "code": code,
+                "silent": False,
+                "store_history": True,
+                "user_expressions": {},
+                "allow_stdin": False,
+            },
+        }
+
+
 class DockerExecutor(RemotePythonExecutor):
     """
     Executes Python code using Jupyter Kernel Gateway in a Docker container.
+
+    The kernel is driven through a [`KernelGatewayClient`], by default the one shared by all executors of the process:
+    the synchronous methods wait on the client event loop, while `acall` and `arun_code_raise_errors` can be awaited
+    from any event loop.
     """
 
     def __init__(
@@ -171,6 +473,8 @@ class DockerExecutor(RemotePythonExecutor):
         image_name: str = "jupyter-kernel",
         build_new_image: bool = True,
         container_run_kwargs: dict[str, Any] | None = None,
+        gateway_client: KernelGatewayClient | None = None,
+        execution_timeout: float | None = None,
     ):
         """
         Initialize the Docker-based Jupyter Kernel Gateway executor.
@@ -183,11 +487,13 @@ class DockerExecutor(RemotePythonExecutor):
             image_name: Name of the Docker image to use. If the image doesn't exist, it will be built.
             build_new_image: If True, the image will be rebuilt even if it already exists.
             container_run_kwargs: Additional keyword arguments to pass to the Docker container run command.
+            gateway_client: Client used to communicate with the kernel. Defaults to the client shared by all executors.
+            execution_timeout: Maximum duration in seconds of the execution of a code action. When exceeded, the kernel
+                is interrupted, or restarted if it stays busy, and an `AgentExecutionError` is raised.
         """
         super().__init__(additional_imports, logger)
         try:
             import docker
-            from websocket import create_connection
         except ModuleNotFoundError:
             raise ModuleNotFoundError(
                 "Please install 'docker' extra to use DockerExecutor: `pip install 'smolagents[docker]'`"
@@ -195,6 +501,10 @@ class DockerExecutor(RemotePythonExecutor):
         self.host = host
         self.port = port
         self.image_name = image_name
+        self.gateway_client = gateway_client or KernelGatewayClient.get_default()
+        self.execution_timeout = execution_timeout
+        # Code to run again to restore the kernel namespace after a restart
+        self._kernel_state_codes: dict[str, str] = {"setup": KERNEL_SETUP_CODE}
 
         # Initialize Docker
         try:
@@ -275,9 +585,9 @@ class DockerExecutor(RemotePythonExecutor):
 
             self.kernel_id = r.json()["id"]
 
-            ws_url = f"ws://{host}:{port}/api/kernels/{self.kernel_id}/channels"
-            self.ws = create_connection(ws_url)
+            self.gateway_client.run(self.gateway_client.connect(self.base_url, self.kernel_id))
 
+            self.run_code_raise_errors(KERNEL_SETUP_CODE)
             self.installed_packages = self.install_packages(additional_imports)
             self.logger.log(
                 f"Container {self.container.short_id} is running with kernel {self.kernel_id}", level=LogLevel.INFO
@@ -287,95 +597,103 @@ class DockerExecutor(RemotePythonExecutor):
             self.cleanup()
             raise RuntimeError(f"Failed to initialize Jupyter kernel: {e}") from e
 
+    def __call__(self, code_action: str) -> tuple[Any, str, bool]:
+        """Run code and report whether a final answer was sent through the result channel"""
+        return self.gateway_client.run(self._arun_code(code_action, timeout=self.execution_timeout))
+
+    async def acall(self, code_action: str) -> tuple[Any, str, bool]:
+        """Async version of `__call__`."""
+        return await self.gateway_client.submit(self._arun_code(code_action, timeout=self.execution_timeout))
+
+    def send_tools(self, tools: dict[str, Tool]):
+        super().send_tools(tools)
+        tools_code = get_tools_definition_code(tools)
+        if "final_answer" in tools:
+            # Route the final_answer tool output through the result channel
+            self.run_code_raise_errors(FINAL_ANSWER_WRAPPER_CODE)
+            tools_code += "\n" + FINAL_ANSWER_WRAPPER_CODE
+        self._kernel_state_codes["tools"] = tools_code
+
+    def send_variables(self, variables: dict):
+        variables_code = self._get_variables_code(variables)
+        self.run_code_raise_errors(variables_code)
+        self._kernel_state_codes["variables"] = variables_code
+
     def run_code_raise_errors(self, code_action: str, return_final_answer: bool = False) -> tuple[Any, str]:
         """
-        Execute code and return result based on whether it's a final answer.
+        Execute code and return its result and logs.
+
+        Args:
+            code_action (`str`): Code to execute.
+            return_final_answer (`bool`, default `False`): Whether the code is expected to send a final answer.
         """
-        try:
-            if return_final_answer:
-                match = self.final_answer_pattern.search(code_action)
-                if match:
-                    pre_final_answer_code = self.final_answer_pattern.sub("", code_action)
-                    result_expr = match.group(1)
-                    wrapped_code = pre_final_answer_code + dedent(f"""
-                        import pickle, base64
-                        _result = {result_expr}
-                        print("RESULT_PICKLE:" + base64.b64encode(pickle.dumps(_result)).decode())
-                        """)
-            else:
-                wrapped_code = code_action
-
-            # Send execute request
-            msg_id = self._send_execute_request(wrapped_code)
-
-            # Collect output and results
-            outputs = []
-            result = None
-            waiting_for_idle = False
+        return self.gateway_client.run(self._arun_code_raise_errors(code_action, return_final_answer))
 
-            while True:
-                msg = json.loads(self.ws.recv())
-                msg_type = msg.get("msg_type", "")
-                parent_msg_id = msg.get("parent_header", {}).get("msg_id")
+    async def arun_code_raise_errors(self, code_action: str, return_final_answer: bool = False) -> tuple[Any, str]:
+        """Async version of `run_code_raise_errors`."""
+        return await self.gateway_client.submit(self._arun_code_raise_errors(code_action, return_final_answer))
 
-                # Only process messages related to our execute request
-                if parent_msg_id != msg_id:
-                    continue
+    async def _arun_code_raise_errors(self, code_action: str, return_final_answer: bool) -> tuple[Any, str]:
+        result, logs, is_final_answer = await self._arun_code(code_action)
+        if return_final_answer and not is_final_answer:
+            raise AgentError("No final answer returned by executor!", self.logger)
+        return result, logs
+
+    async def _arun_code(self, code_action: str, timeout: float | None = None) -> tuple[Any, str, bool]:
+        """
+        Execute code and collect its outputs. Must run on the gateway client event loop.
 
+        Results are not scraped from stdout: they are sent by the kernel as `display_data` messages
+        with the `RESULT_MIMETYPE` mimetype, see `KERNEL_SETUP_CODE`.
+        """
+        # Collect output and results
+        outputs = []
+        result = None
+        is_final_answer = False
+        try:
+            async for msg in self.gateway_client.execute(self.kernel_id, code_action, timeout=timeout):
+                msg_type = msg.get("msg_type", "")
                 if msg_type == "stream":
-                    text = msg["content"]["text"]
-                    if return_final_answer and text.startswith("RESULT_PICKLE:"):
-                        pickle_data = text[len("RESULT_PICKLE:") :].strip()
-                        result = pickle.loads(base64.b64decode(pickle_data))
-                        waiting_for_idle = True
-                    else:
-                        outputs.append(text)
+                    outputs.append(msg["content"]["text"])
+                elif msg_type in ("display_data", "execute_result"):
+                    data = msg["content"].get("data", {})
+                    if RESULT_MIMETYPE in data:
+                        result = pickle.loads(base64.b64decode(data[RESULT_MIMETYPE]))
+                        metadata = msg["content"].get("metadata", {}).get(RESULT_MIMETYPE, {})
+                        is_final_answer = is_final_answer or metadata.get("is_final_answer", False)
                 elif msg_type == "error":
                     traceback = msg["content"].get("traceback", [])
                     raise AgentError("\n".join(traceback), self.logger)
-                elif msg_type == "status" and msg["content"]["execution_state"] == "idle":
-                    if not return_final_answer or waiting_for_idle:
-                        break
 
-            return result, "".join(outputs)
+            return result, "".join(outputs), is_final_answer
 
+        except KernelTimeoutError as e:
+            error_message = f"Code execution timed out after {timeout} seconds and was interrupted."
+            if not e.kernel_stopped:
+                error_message = (
+                    f"Code execution timed out after {timeout} seconds, and the kernel could not be stopped: {e}"
+                )
+            elif e.kernel_restarted:
+                await self._restore_kernel_state()
+                error_message += " The kernel had to be restarted: variables defined in previous steps were lost."
+            if outputs:
+                error_message += "\nExecution logs before the timeout:\n" + "".join(outputs)
+            self.logger.log_error(error_message)
+            raise AgentExecutionError(error_message, self.logger) from e
         except Exception as e:
             self.logger.log_error(f"Code execution failed: {e}")
             raise
 
-    def _send_execute_request(self, code: str) -> str:
-        """Send code execution request to kernel."""
-        import uuid
-
-        # Generate a unique message ID
-        msg_id = str(uuid.uuid4())
-
-        # Create execute request
-        execute_request = {
-            "header": {
-                "msg_id": msg_id,
-                "username": "anonymous",
-                "session": str(uuid.uuid4()),
-                "msg_type": "execute_request",
-                "version": "5.0",
-            },
-            "parent_header": {},
-            "metadata": {},
-            "content": {
-                "code": code,
-                "silent": False,
-                "store_history": True,
-                "user_expressions": {},
-                "allow_stdin": False,
-            },
-        }
-
-        self.ws.send(json.dumps(execute_request))
-        return msg_id
+    async def _restore_kernel_state(self):
+        """Define again the helpers, tools and variables sent to the kernel before it was restarted."""
+        for code in self._kernel_state_codes.values():
+            await self._arun_code(code)
 
     def cleanup(self):
         """Clean up resources."""
         try:
+            if hasattr(self, "kernel_id"):
+                self.gateway_client.run(self.gateway_client.disconnect(self.kernel_id))
             if hasattr(self, "container"):
                 self.logger.log(f"Stopping and removing container {self.container.short_id}...", level=LogLevel.INFO)
                 self.container.stop()
@@ -389,4 +707,320 @@ class DockerExecutor(RemotePythonExecutor):
         self.cleanup()
 
 
-__all__ = ["E2BExecutor", "DockerExecutor"]
+class SubprocessExecutor(RemotePythonExecutor):
+    """
+    Executes Python code in a CPython interpreter running in a local child process.
+
+    The kernel only imports the standard library, so it starts in a few tens of milliseconds. It uses the same Python
+    environment as the current process: additional imports are expected to be installed, as with the local executor.
+    It isolates the agent process from crashes and hangs of the executed code, but it is not a sandbox. Only available
+    on POSIX systems.
+
+    Variables are sent with [`dump_with_shared_memory`]: the buffers of large numpy arrays, pandas and Arrow objects go
+    through shared memory instead of the pipe. To send them without any copy, allocate them with
+    [`create_shared_array`] or map them from a file with `numpy.memmap`.
+
+    Args:
+        additional_imports (`list[str]`): Additional imports, expected to be installed in the current environment.
+        logger (`Logger`): Logger to use.
+        execution_timeout (`float`, *optional*): Maximum duration in seconds of the execution of a code action. When
+            exceeded, the kernel is interrupted, or restarted if it stays busy, and an `AgentExecutionError` is raised.
+        interrupt_timeout (`float`, default `10`): Time in seconds to wait for the kernel to stop after an interruption
+            before restarting it.
+        python_executable (`str`, *optional*): Python interpreter running the kernel. Defaults to the current one.
+        shared_memory_threshold (`int`, default `1048576`): Size in bytes above which variable buffers are sent
+            through shared memory.
+    """
+
+    def __init__(
+        self,
+        additional_imports: list[str],
+        logger,
+        execution_timeout: float | None = None,
+        interrupt_timeout: float = 10,
+        python_executable: str | None = None,
+        shared_memory_threshold: int = 1024 * 1024,
+    ):
+        super().__init__(additional_imports, logger)
+        self.execution_timeout = execution_timeout
+        self.interrupt_timeout = interrupt_timeout
+        self.python_executable = python_executable or sys.executable
+        self.shared_memory_threshold = shared_memory_threshold
+        # Requests to send again to restore the kernel namespace after a restart
+        self._kernel_state_requests: dict[str, dict] = {}
+        self._shared_memories: list[shared_memory.SharedMemory] = []
+        self._lock = threading.Lock()
+        self._start_kernel()
+        self.installed_packages = self.install_packages(additional_imports)
+        self.logger.log(f"Subprocess kernel is running with pid {self.process.pid}", level=LogLevel.INFO)
+
+    def _start_kernel(self):
+        self.process = subprocess.Popen(
+            [self.python_executable, str(Path(__file__).parent / "_subprocess_kernel.py")],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+
+    def __call__(self, code_action: str) -> tuple[Any, str, bool]:
+        """Run code and report whether a final answer was sent through the result channel"""
+        return self._run_request({"type": "execute", "code": code_action}, timeout=self.execution_timeout)
+
+    def install_packages(self, additional_imports: list[str]):
+        # The kernel shares the environment of the current process: packages are not installed on the fly
+        return additional_imports
+
+    def send_tools(self, tools: dict[str, Tool]):
+        super().send_tools(tools)
+        tools_code = get_tools_definition_code(tools)
+        if "final_answer" in tools:
+            # Route the final_answer tool output through the result channel
+            self.run_code_raise_errors(FINAL_ANSWER_WRAPPER_CODE)
+            tools_code += "\n" + FINAL_ANSWER_WRAPPER_CODE
+        self._kernel_state_requests["tools"] = {"type": "execute", "code": tools_code}
+
+    def send_variables(self, variables: dict):
+        data, buffers, shared_memories = dump_with_shared_memory(variables, self.shared_memory_threshold)
+        request = {"type": "set_variables", "data": data, "buffers": buffers}
+        try:
+            self._run_request(request)
+        except BaseException:
+            _release_shared_memories(shared_memories)
+            raise
+        # The segments are kept until the variables are replaced, to restore them if the kernel is restarted
+        _release_shared_memories(self._shared_memories)
+        self._shared_memories = shared_memories
+        self._kernel_state_requests["variables"] = request
+
+    def run_code_raise_errors(self, code_action: str, return_final_answer: bool = False) -> tuple[Any, str]:
+        """
+        Execute code and return its result and logs.
+
+        Args:
+            code_action (`str`): Code to execute.
+            return_final_answer (`bool`, default `False`): Whether the code is expected to send a final answer.
+        """
+        result, logs, is_final_answer = self._run_request({"type": "execute", "code": code_action})
+        if return_final_answer and not is_final_answer:
+            raise AgentError("No final answer returned by executor!", self.logger)
+        return result, logs
+
+    def _run_request(self, request: dict, timeout: float | None = None) -> tuple[Any, str, bool]:
+        with self._lock:
+            if self.process.poll() is not None:
+                self.logger.log_error(f"Kernel exited with code {self.process.returncode}: restarting it")
+                self._restart_kernel()
+            try:
+                self._write_message(request)
+                response = self._read_response(timeout)
+            except ConnectionError as e:
+                self._restart_kernel()
+                error_message = (
+                    f"{e} during execution. It was restarted: variables defined in previous steps were lost."
+                )
+                raise AgentExecutionError(error_message, self.logger) from e
+            except KernelTimeoutError as e:
+                error_message = f"Code execution timed out after {timeout} seconds and was interrupted."
+                if e.kernel_restarted:
+                    error_message += " The kernel had to be restarted: variables defined in previous steps were lost."
+                raise AgentExecutionError(error_message, self.logger) from e
+        if response["error"]:
+            raise AgentError(response["logs"] + response["error"], self.logger)
+        return response["result"], response["logs"], response["is_final_answer"]
+
+    def _read_response(self, timeout: float | None) -> dict:
+        if timeout is None or self._wait_for_response(timeout):
+            return self._read_message()
+        self.process.send_signal(signal.SIGINT)
+        if self._wait_for_response(self.interrupt_timeout):
+            self._read_message()
+            raise KernelTimeoutError(f"Execution timed out after {timeout} seconds")
+        self._restart_kernel()
+        raise KernelTimeoutError(f"Execution timed out after {timeout} seconds", kernel_restarted=True)
+
+    def _wait_for_response(self, timeout: float) -> bool:
+        readable, _, _ = select.select([self.process.stdout], [], [], timeout)
+        return bool(readable)
+
+    def _write_message(self, message: dict):
+        payload = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+        self.process.stdin.write(SUBPROCESS_MESSAGE_HEADER.pack(len(payload)) + payload)
+        self.process.stdin.flush()
+
+    def _read_message(self) -> dict:
+        header = self.process.stdout.read(SUBPROCESS_MESSAGE_HEADER.size)
+        if len(header) < SUBPROCESS_MESSAGE_HEADER.size:
+            raise ConnectionError(f"Kernel exited with code {self.process.wait()}")
+        return pickle.loads(self.process.stdout.read(SUBPROCESS_MESSAGE_HEADER.unpack(header)[0]))
+
+    def _restart_kernel(self):
+        """Start a new kernel and send it the tools and variables sent to the previous one."""
+        self._stop_kernel()
+        self._start_kernel()
+        for request in self._kernel_state_requests.values():
+            self._write_message(request)
+            self._read_message()
+
+    def _stop_kernel(self):
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+        self.process.stdin.close()
+        self.process.stdout.close()
+
+    def cleanup(self):
+        """Clean up resources."""
+        try:
+            if hasattr(self, "process"):
+                self._stop_kernel()
+            _release_shared_memories(self._shared_memories)
+            self._shared_memories = []
+        except Exception as e:
+            self.logger.log_error(f"Error during cleanup: {e}")
+
+    def delete(self):
+        """Ensure cleanup on deletion."""
+        self.cleanup()
+
+
+# Shared memory segments backing the arrays created with `create_shared_array`, with the address of their buffer
+_shared_array_segments: dict[str, tuple[shared_memory.SharedMemory, int]] = {}
+
+
+def create_shared_array(shape: int | tuple[int, ...], dtype="float64"):
+    """
+    Create a numpy array backed by a shared memory segment, to send it to a [`SubprocessExecutor`] without copy.
+
+    The array, and the views, pandas or Arrow objects built on top of it without copy, are sent to the kernel as a
+    reference to the segment: the kernel maps the same memory, so writes on either side are visible on the other.
+    The segment is released once the array and all the objects built on top of it are garbage collected.
+
+    Args:
+        shape (`int` or `tuple[int, ...]`): Shape of the array.
+        dtype (default `"float64"`): Data type of the array.
+
+    Returns:
+        `numpy.ndarray`: Uninitialized array.
+    """
+    import numpy as np
+
+    dtype = np.dtype(dtype)
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    shm = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+    _shared_array_segments[shm.name] = (shm, _get_buffer_address(shm.buf))
+    array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    weakref.finalize(array, _release_shared_array_segment, shm.name)
+    return array
+
+
+def _release_shared_array_segment(name: str):
+    shm, _ = _shared_array_segments.pop(name)
+    shm.unlink()
+    try:
+        shm.close()
+    except BufferError:
+        pass  # The array is still alive at interpreter exit
+
+
+def _release_shared_memories(shared_memories: list[shared_memory.SharedMemory]):
+    for shm in shared_memories:
+        shm.close()
+        shm.unlink()
+
+
+def _get_buffer_address(buffer: memoryview) -> int:
+    import numpy as np
+
+    return np.frombuffer(buffer, dtype=np.uint8).ctypes.data
+
+
+def _get_shared_regions(variables: dict) -> list[tuple[int, int, str, str, int]]:
+    """
+    List the memory regions whose content can be mapped by another process: the segments of the shared arrays, and the
+    files mapped by the `numpy.memmap` variables, unless mapped copy-on-write.
+
+    Each region is given as `(address, size, kind, location, offset)`, where `kind` is `"shm"` for a shared memory
+    segment named `location`, or `"file"` for the file at path `location`, `offset` being the offset of the region in it.
+    """
+    regions = [(address, shm.size, "shm", name, 0) for name, (shm, address) in _shared_array_segments.items()]
+    if "numpy" in sys.modules:
+        import numpy as np
+
+        for value in variables.values():
+            if isinstance(value, np.memmap) and value._mmap is not None and value.mode != "c":
+                file_offset = value.offset - value.offset % mmap.ALLOCATIONGRANULARITY
+                regions.append(
+                    (
+                        _get_buffer_address(memoryview(value._mmap)),
+                        len(value._mmap),
+                        "file",
+                        value.filename,
+                        file_offset,
+                    )
+                )
+    return regions
+
+
+def dump_with_shared_memory(
+    obj: Any, threshold: int = 1024 * 1024
+) -> tuple[bytes, list[tuple[str, str, int, int]], list[shared_memory.SharedMemory]]:
+    """
+    Pickle an object with protocol 5, passing its large buffers through shared memory instead of the pickle stream.
+
+    The buffers exposed out-of-band by numpy arrays, and by the pandas and Arrow objects holding them, are handled as
+    follows:
+    - buffers lying in an array created with [`create_shared_array`], or in a file mapped by a `numpy.memmap` value of
+      `obj` when it is a dict, are sent as a descriptor of their location, without copy, in constant time;
+    - other buffers of at least `threshold` bytes are copied once into new shared memory segments;
+    - smaller buffers are serialized in the pickle stream.
+
+    Args:
+        obj (`Any`): Object to pickle.
+        threshold (`int`, default `1048576`): Size in bytes from which buffers are copied into shared memory.
+
+    Returns:
+        `tuple`: The pickled bytes; the descriptors `(kind, location, offset, size)` of the out-of-band buffers, in
+        order, where `kind` is `"shm"` for a shared memory segment or `"file"` for a file; and the shared memory
+        segments created for the copies, to close and unlink by the caller once the object is loaded.
+    """
+    regions = _get_shared_regions(obj if isinstance(obj, dict) else {})
+    if isinstance(obj, dict) and "numpy" in sys.modules:
+        import numpy as np
+
+        # Memory-mapped arrays are pickled in-band: send them as plain arrays sharing the same memory
+        obj = {name: value.view(np.ndarray) if isinstance(value, np.memmap) else value for name, value in obj.items()}
+    descriptors = []
+    shared_memories = []
+
+    def buffer_callback(buffer: pickle.PickleBuffer) -> bool:
+        data = buffer.raw()
+        if regions:
+            address = _get_buffer_address(data)
+            for start, size, kind, location, offset in regions:
+                if start <= address and address + data.nbytes <= start + size:
+                    descriptors.append((kind, location, offset + address - start, data.nbytes))
+                    return False
+        if data.nbytes < threshold:
+            return True  # Serialize in-band
+        shm = shared_memory.SharedMemory(create=True, size=data.nbytes)
+        shared_memories.append(shm)
+        shm.buf[: data.nbytes] = data
+        descriptors.append(("shm", shm.name, 0, data.nbytes))
+        return False
+
+    try:
+        data = pickle.dumps(obj, protocol=5, buffer_callback=buffer_callback)
+    except BaseException:
+        _release_shared_memories(shared_memories)
+        raise
+    return data, descriptors, shared_memories
+
+
+__all__ = [
+    "E2BExecutor",
+    "DockerExecutor",
+    "KernelGatewayClient",
+    "KernelTimeoutError",
+    "SubprocessExecutor",
+    "create_shared_array",
+    "dump_with_shared_memory",
+]
@@ -16,6 +16,7 @@
 # limitations under the License.
 import ast
 import base64
+import hashlib
 import importlib.metadata
 import importlib.util
 import inspect
@@ -24,10 +25,14 @@ import keyword
 import os
 import re
 import types
+import weakref
+from collections import OrderedDict
+from dataclasses import dataclass
 from functools import lru_cache
 from io import BytesIO
 from pathlib import Path
 from textwrap import dedent
+from threading import RLock
 from typing import TYPE_CHECKING, Any
 
 
@@ -35,7 +40,7 @@ if TYPE_CHECKING:
     from smolagents.memory import AgentLogger
 
 
-__all__ = ["AgentError"]
+__all__ = ["AgentError", "ImageEncodingCache", "ImageEncodingPolicy"]
 
 
 @lru_cache
@@ -229,6 +234,71 @@ def parse_code_blobs(text: str) -> str:
     )
 
 
+class IncrementalCodeParser:
+    """
+    Finds the complete top-level statements of the first code block of a text received in chunks, like a streamed LLM
+    output, so that they can be executed before the end of the text.
+
+    A statement is known to be complete once a line of another top-level statement starts after it: the last statement
+    of the block is only complete at the end of the text, and is left to the parsing of the whole text.
+    """
+
+    _code_block_start_pattern = re.compile(r"```(?:py|python)?\s*\n")
+    # Top-level lines that continue the previous statement
+    _continuation_pattern = re.compile(r"(?:else|elif|except|finally)\b|[#)\]}]")
+
+    def __init__(self):
+        self.text = ""
+        self._code_start: int | None = None
+        self._code_end: int | None = None
+        # Length of the code split into complete statements so far
+        self._parsed_length = 0
+
+    @property
+    def parsed_code(self) -> str:
+        """Code of the complete statements found so far."""
+        if self._code_start is None:
+            return ""
+        return self.text[self._code_start : self._code_start + self._parsed_length]
+
+    def feed(self, text: str) -> str | None:
+        """
+        Process the next chunk of text.
+
+        Returns:
+            `str | None`: Code of the statements completed by this chunk, if any.
+        """
+        self.text += text
+        if self._code_end is not None:
+            return None
+        if self._code_start is None:
+            if (match := self._code_block_start_pattern.search(self.text)) is None:
+                return None
+            self._code_start = match.end()
+        code = self.text[self._code_start :]
+        if (code_end := code.find("\n```")) != -1:
+            # The last statement is completed by the end of the block, but the text may still change its meaning
+            self._code_end = code_end
+            return None
+        # Line starts of new top-level statements, from the last one
+        line_starts = [
+            match.start()
+            for match in re.finditer(r"^\S", code[: code.rfind("\n") + 1], re.MULTILINE)
+            if match.start() > self._parsed_length and not self._continuation_pattern.match(code, match.start())
+        ]
+        for line_start in reversed(line_starts):
+            try:
+                statements = ast.parse(code[self._parsed_length : line_start]).body
+            except SyntaxError:
+                continue  # Unterminated string or parenthesis: the statement is not complete yet
+            if not statements:
+                return None
+            new_code = code[self._parsed_length : line_start]
+            self._parsed_length = line_start
+            return new_code
+        return None
+
+
 MAX_LENGTH_TRUNCATE_CONTENT = 20000
 
 
@@ -435,14 +505,144 @@ def get_source(obj) -> str:
         raise e from inspect_error
 
 
-def encode_image_base64(image):
-    buffered = BytesIO()
-    image.save(buffered, format="PNG")
-    return base64.b64encode(buffered.getvalue()).decode("utf-8")
+@dataclass(frozen=True)
+class ImageEncodingPolicy:
+    """
+    How images are encoded before being sent to a model.
+
+    The default policy encodes images losslessly to PNG at their original size. Downscaling images and transcoding
+    them to a lossy format reduces the size of the requests, and the image tokens billed by most providers.
+
+    Args:
+        format (`str`, default `"PNG"`): Image format, for instance `"PNG"`, `"JPEG"` or `"WEBP"`.
+        max_side (`int`, *optional*): If set, images with a larger width or height are downscaled to fit in a
+            square of this side, keeping their aspect ratio.
+        quality (`int`, *optional*): Quality of lossy formats, between 1 and 100. Defaults to the Pillow default.
+    """
+
+    format: str = "PNG"
+    max_side: int | None = None
+    quality: int | None = None
+
+    @property
+    def mime_type(self) -> str:
+        return f"image/{self.format.lower()}"
+
+    def encode(self, image) -> bytes:
+        if self.max_side is not None and max(image.size) > self.max_side:
+            image = image.copy()
+            image.thumbnail((self.max_side, self.max_side))
+        if self.format.upper() == "JPEG" and image.mode not in ("L", "RGB", "CMYK"):
+            # JPEG does not support transparency nor palettes
+            image = image.convert("RGB")
+        save_kwargs = {"quality": self.quality} if self.quality is not None else {}
+        buffered = BytesIO()
+        image.save(buffered, format=self.format, **save_kwargs)
+        return buffered.getvalue()
+
+
+class ImageEncodingCache:
+    """
+    Least recently used cache of encoded images, so that images sent at every step, like the task images, are only
+    encoded once.
+
+    Args:
+        max_size_bytes (`int`, default `64 * 1024 * 1024`): Maximum total size of the encoded images kept.
+        key (`str`, default `"content"`): How images are identified:
+            - `"content"`: by a hash of their pixels, which is much cheaper than encoding them, and also detects
+              images modified in place or copies of the same image.
+            - `"identity"`: by the image object itself, which is free but assumes images are never modified in place.
+    """
+
+    def __init__(self, max_size_bytes: int = 64 * 1024 * 1024, key: str = "content"):
+        if key not in ("content", "identity"):
+            raise ValueError(f"Unknown image cache key {key!r}: should be 'content' or 'identity'.")
+        self.max_size_bytes = max_size_bytes
+        self.key = key
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[tuple, str] = OrderedDict()
+        self._size_bytes = 0
+        # With identity keys, the images of the entries, whose collection removes their entries
+        self._images: dict[int, weakref.ref] = {}
+        # Reentrant, as the collection of an image can trigger the removal of its entries at any time
+        self._lock = RLock()
+
+    def encode(self, image, policy: ImageEncodingPolicy) -> str:
+        """Return the base64 encoding of `image` with the given policy, encoding it only if not cached."""
+        key = (self._get_image_key(image), policy)
+        with self._lock:
+            if key in self._entries:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return self._entries[key]
+            self.misses += 1
+        encoded_image = base64.b64encode(policy.encode(image)).decode("utf-8")
+        if len(encoded_image) <= self.max_size_bytes:
+            with self._lock:
+                self._add(key, encoded_image, image)
+        return encoded_image
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._images.clear()
+            self._size_bytes = 0
+
+    def _get_image_key(self, image) -> tuple:
+        if self.key == "identity":
+            return ("identity", id(image))
+        return ("content", image.mode, image.size, hashlib.sha256(image.tobytes()).hexdigest())
+
+    def _add(self, key: tuple, encoded_image: str, image):
+        if key in self._entries:
+            return
+        if self.key == "identity":
+            image_id = key[0][1]
+            if image_id not in self._images:
+                self._images[image_id] = weakref.ref(image, lambda _: self._remove_image(image_id))
+        self._entries[key] = encoded_image
+        self._size_bytes += len(encoded_image)
+        while self._size_bytes > self.max_size_bytes:
+            _, evicted_image = self._entries.popitem(last=False)
+            self._size_bytes -= len(evicted_image)
+
+    def _remove_image(self, image_id: int):
+        # The id of a collected image can be reused by a new one: forget the encodings of the collected image
+        with self._lock:
+            self._images.pop(image_id, None)
+            for key in [key for key in self._entries if key[0] == ("identity", image_id)]:
+                self._size_bytes -= len(self._entries.pop(key))
+
+
+DEFAULT_IMAGE_ENCODING_POLICY = ImageEncodingPolicy()
+
+image_encoding_cache = ImageEncodingCache()
+
+
+def encode_image(
+    image, policy: ImageEncodingPolicy | None = None, cache: ImageEncodingCache | None = None
+) -> tuple[str, str]:
+    """
+    Encode an image to base64 with the given policy, by default losslessly to PNG, and return it with its MIME type.
+
+    Encoded images are kept in `cache`, by default the module-level `image_encoding_cache`.
+    """
+    policy = policy or DEFAULT_IMAGE_ENCODING_POLICY
+    return (cache or image_encoding_cache).encode(image, policy), policy.mime_type
+
+
+def encode_image_base64(image, policy: ImageEncodingPolicy | None = None, cache: ImageEncodingCache | None = None):
+    """
+    Encode an image to base64 with the given policy, by default losslessly to PNG.
+
+    Encoded images are kept in `cache`, by default the module-level `image_encoding_cache`.
+    """
+    return encode_image(image, policy=policy, cache=cache)[0]
 
 
-def make_image_url(base64_image):
-    return f"data:image/png;base64,{base64_image}"
+def make_image_url(base64_image, mime_type: str = "image/png"):
+    return f"data:{mime_type};base64,{base64_image}"
 
 
 def make_init_file(folder: str | Path):
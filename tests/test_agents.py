@@ -15,6 +15,8 @@
 import io
 import os
 import tempfile
+import threading
+import time
 import uuid
 from collections.abc import Generator
 from contextlib import nullcontext as does_not_raise
@@ -41,11 +43,13 @@ from smolagents.agents import (
     populate_template,
 )
 from smolagents.default_tools import DuckDuckGoSearchTool, FinalAnswerTool, PythonInterpreterTool, VisitWebpageTool
-from smolagents.memory import ActionStep, PlanningStep
+from smolagents.memory import ActionStep, PlanningStep, TaskStep
 from smolagents.models import (
     ChatMessage,
+    ChatMessageStreamDelta,
     ChatMessageToolCall,
     ChatMessageToolCallDefinition,
+    ChatMessageToolCallStreamDelta,
     InferenceClientModel,
     MessageRole,
     Model,
@@ -1039,6 +1043,105 @@ class TestToolCallingAgent:
         assert "Error while parsing" in capture.get()
         assert len(agent.memory.steps) == 4
 
+    def test_stream_outputs(self):
+        class FakeToolCallStreamingModel(Model):
+            def generate(self, messages, tools_to_call_from=None, stop_sequences=None, grammar=None):
+                raise AssertionError("The model output should be streamed")
+
+            def generate_stream(self, messages, tools_to_call_from=None, stop_sequences=None, grammar=None):
+                yield ChatMessageStreamDelta(content="Calling the final answer.")
+                yield ChatMessageStreamDelta(
+                    tool_calls=[
+                        ChatMessageToolCallStreamDelta(
+                            index=0, id="call_0", type="function", name="final_answer", arguments='{"ans'
+                        )
+                    ]
+                )
+                yield ChatMessageStreamDelta(
+                    tool_calls=[ChatMessageToolCallStreamDelta(index=0, arguments='wer": "7.2904"}')]
+                )
+
+        agent = ToolCallingAgent(tools=[], model=FakeToolCallStreamingModel(), stream_outputs=True, max_steps=1)
+        steps = list(agent.run("What is 2 multiplied by 3.6452?", stream=True))
+        stream_deltas = [step for step in steps if isinstance(step, ChatMessageStreamDelta)]
+        assert len(stream_deltas) == 3
+        assert steps[-1].final_answer == "7.2904"
+        action_step = agent.memory.steps[1]
+        assert action_step.model_output_message.content == "Calling the final answer."
+        assert action_step.tool_calls[0].name == "final_answer"
+        assert action_step.tool_calls[0].arguments == {"answer": "7.2904"}
+
+    def test_stream_outputs_executes_tool_call_before_end_of_stream(self):
+        tool_started = threading.Event()
+
+        @tool
+        def get_weather(location: str) -> str:
+            """
+            Get the weather at a location.
+
+            Args:
+                location: The location.
+            """
+            tool_started.set()
+            return "sunny"
+
+        class FakeToolCallStreamingModel(Model):
+            def generate_stream(self, messages, tools_to_call_from=None, stop_sequences=None, grammar=None):
+                if any(message["role"] == MessageRole.TOOL_RESPONSE for message in messages):
+                    name, arguments = "final_answer", '{"answer": "sunny"}'
+                else:
+                    name, arguments = "get_weather", '{"location": "Paris"}'
+                yield ChatMessageStreamDelta(
+                    tool_calls=[ChatMessageToolCallStreamDelta(index=0, id="call_0", name=name, arguments=arguments)]
+                )
+                if name == "get_weather":
+                    # The complete tool call is executed while the rest of the output is generated
+                    assert tool_started.wait(timeout=5)
+                yield ChatMessageStreamDelta(content=" Done.")
+
+        agent = ToolCallingAgent(tools=[get_weather], model=FakeToolCallStreamingModel(), stream_outputs=True)
+        with patch.object(agent, "execute_tool_call", wraps=agent.execute_tool_call) as execute_tool_call:
+            assert agent.run("What is the weather in Paris?") == "sunny"
+        assert agent.memory.steps[1].observations == "sunny"
+        # The tool call executed during the stream is not executed again
+        assert [call.args[0] for call in execute_tool_call.call_args_list] == ["get_weather", "final_answer"]
+
+    def test_stream_outputs_waits_for_early_tool_call_of_failed_step(self):
+        tool_calls = []
+
+        @tool
+        def get_weather(location: str) -> str:
+            """
+            Get the weather at a location.
+
+            Args:
+                location: The location.
+            """
+            time.sleep(0.1)
+            tool_calls.append(location)
+            return "sunny"
+
+        class FakeToolCallStreamingModel(Model):
+            def generate_stream(self, messages, tools_to_call_from=None, stop_sequences=None, grammar=None):
+                yield ChatMessageStreamDelta(
+                    tool_calls=[
+                        ChatMessageToolCallStreamDelta(
+                            index=0, id="call_0", name="get_weather", arguments='{"location": "Paris"}'
+                        )
+                    ]
+                )
+                raise ValueError("Connection lost")
+
+        agent = ToolCallingAgent(tools=[get_weather], model=FakeToolCallStreamingModel(), stream_outputs=True)
+        with pytest.raises(AgentGenerationError, match="Connection lost"):
+            agent.run("What is the weather in Paris?")
+        # The tool call started during the stream ended with its step, and was not executed again
+        assert tool_calls == ["Paris"]
+
+    def test_stream_outputs_requires_generate_stream(self):
+        with pytest.raises(ValueError, match="no `generate_stream` method"):
+            ToolCallingAgent(tools=[], model=FakeToolCallModel(), stream_outputs=True)
+
     def test_change_tools_after_init(self):
         from smolagents import tool
 
@@ -1143,6 +1246,199 @@ class TestCodeAgent:
         agent.run("What is 2 multiplied by 3.6452?")
         assert "Flag!" in str(agent.memory.steps[1].observations)
 
+    def test_incremental_execution_overlaps_generation(self):
+        tool_called = threading.Event()
+
+        @tool
+        def slow_search(query: str) -> str:
+            """
+            Searches the web.
+
+            Args:
+                query: The query.
+            """
+            tool_called.set()
+            return "result"
+
+        class FakeCodeStreamingModel(Model):
+            def generate_stream(self, messages, stop_sequences=None, grammar=None):
+                yield ChatMessageStreamDelta(content="Code:\n```py\nresult = slow_search('a')\n")
+                yield ChatMessageStreamDelta(content="print(result)\n")
+                # The first statement is executed while the rest of the action is generated
+                assert tool_called.wait(timeout=5)
+                yield ChatMessageStreamDelta(content="final_answer(result)\n```<end_code>")
+
+        agent = CodeAgent(
+            tools=[slow_search], model=FakeCodeStreamingModel(), stream_outputs=True, incremental_execution=True
+        )
+        assert agent.run("Search.") == "result"
+        assert "result" in agent.memory.steps[1].observations
+
+    def test_incremental_execution_falls_back_on_mismatch(self):
+        class FakeCodeStreamingModel(Model):
+            def generate_stream(self, messages, stop_sequences=None, grammar=None):
+                # The code action is rewritten by fix_final_answer_code, so the first statement fails when executed alone
+                yield ChatMessageStreamDelta(content="Code:\n```py\nfinal_answer = 5\n")
+                yield ChatMessageStreamDelta(content="print(final_answer)\nfinal_answer(final_answer)\n```<end_code>")
+
+        agent = CodeAgent(tools=[], model=FakeCodeStreamingModel(), stream_outputs=True, incremental_execution=True)
+        assert agent.run("Answer.") == 5
+        assert agent.memory.steps[1].error is None
+        assert "final_answer_variable" in agent.python_executor.state
+
+    def test_incremental_execution_error_keeps_previous_print_outputs(self):
+        class FakeCodeStreamingModel(Model):
+            def generate_stream(self, messages, stop_sequences=None, grammar=None):
+                yield ChatMessageStreamDelta(content="Code:\n```py\nprint('Flag!')\nerror_function()\n")
+                yield ChatMessageStreamDelta(content="print('Not executed')\n```<end_code>")
+
+        agent = CodeAgent(
+            tools=[], model=FakeCodeStreamingModel(), stream_outputs=True, incremental_execution=True, max_steps=1
+        )
+        agent.run("Fail.")
+        assert "Flag!" in agent.memory.steps[1].observations
+        assert "Not executed" not in agent.memory.steps[1].observations
+        assert "error_function" in str(agent.memory.steps[1].error)
+
+    def test_incremental_execution_rolls_back_when_closed_mid_stream(self):
+        class FakeCodeStreamingModel(Model):
+            def generate_stream(self, messages, stop_sequences=None, grammar=None):
+                yield ChatMessageStreamDelta(content="Code:\n```py\nx = 1\n")
+                yield ChatMessageStreamDelta(content="y = 2\n")
+                yield ChatMessageStreamDelta(content="final_answer(x + y)\n```<end_code>")
+
+        agent = CodeAgent(tools=[], model=FakeCodeStreamingModel(), stream_outputs=True, incremental_execution=True)
+        agent.memory.steps.append(TaskStep(task="Answer."))
+        step_stream = agent._step_stream(ActionStep(step_number=1, start_time=time.time()))
+        for event in step_stream:
+            if isinstance(event, ChatMessageStreamDelta) and event.content == "y = 2\n":
+                break
+        # The first statement is executed in the background while the action is generated
+        for _ in range(100):
+            if "x" in agent.python_executor.state:
+                break
+            time.sleep(0.05)
+        assert agent.python_executor.state["x"] == 1
+        step_stream.close()
+        assert "x" not in agent.python_executor.state
+
+    def test_incremental_execution_requires_streaming(self):
+        with pytest.raises(ValueError, match="incremental_execution"):
+            CodeAgent(tools=[], model=FakeCodeModel(), incremental_execution=True)
+
+    def test_best_of_n_keeps_first_candidate_without_error(self):
+        class FakeCandidatesModel(Model):
+            def __init__(self):
+                super().__init__()
+                self.contents = iter(
+                    ["x = 'bad'\nerror_function()", "x = 'good'\nfinal_answer(x)", "x = 'bad'\nerror_function()"]
+                )
+                self.lock = threading.Lock()
+
+            def generate(self, messages, stop_sequences=None, grammar=None):
+                with self.lock:
+                    code = next(self.contents)
+                self.last_input_token_count, self.last_output_token_count = 10, 5
+                return ChatMessage(role="assistant", content=f"Code:\n```py\n{code}\n```<end_code>")
+
+        model = FakeCandidatesModel()
+        agent = CodeAgent(tools=[], model=model, num_candidates=3)
+        assert agent.run("Answer.") == "good"
+        assert len(agent.memory.steps) == 2
+        assert "good" in agent.memory.steps[1].model_output and agent.memory.steps[1].error is None
+        assert agent.python_executor.state["x"] == "good"
+        # Token counts are those of all the candidates
+        assert (model.last_input_token_count, model.last_output_token_count) == (30, 15)
+
+    def test_best_of_n_counts_tokens_of_each_candidate(self):
+        class FakeCandidatesModel(Model):
+            def __init__(self):
+                super().__init__()
+                self.token_counts = iter([(10, 1), (20, 2), (30, 3)])
+                self.lock = threading.Lock()
+                self.barrier = threading.Barrier(3, timeout=5)
+
+            def generate(self, messages, stop_sequences=None, grammar=None):
+                with self.lock:
+                    token_counts = next(self.token_counts)
+                self.last_input_token_count, self.last_output_token_count = token_counts
+                # All the candidates have set their token counts before any of them reads them
+                self.barrier.wait()
+                return ChatMessage(
+                    role="assistant",
+                    content="Code:\n```py\nfinal_answer('done')\n```<end_code>",
+                    raw={"usage": token_counts},
+                )
+
+            def get_message_token_counts(self, message):
+                return message.raw["usage"]
+
+        model = FakeCandidatesModel()
+        agent = CodeAgent(tools=[], model=model, num_candidates=3)
+        assert agent.run("Answer.") == "done"
+        assert (model.last_input_token_count, model.last_output_token_count) == (60, 6)
+
+    def test_best_of_n_generates_sequentially_for_unsafe_models(self):
+        class FakeCandidatesModel(Model):
+            thread_safe = False
+
+            def __init__(self):
+                super().__init__()
+                self.running = 0
+                self.max_running = 0
+                self.lock = threading.Lock()
+
+            def generate(self, messages, stop_sequences=None, grammar=None):
+                with self.lock:
+                    self.running += 1
+                    self.max_running = max(self.max_running, self.running)
+                time.sleep(0.05)
+                with self.lock:
+                    self.running -= 1
+                return ChatMessage(role="assistant", content="Code:\n```py\nfinal_answer('done')\n```<end_code>")
+
+        model = FakeCandidatesModel()
+        agent = CodeAgent(tools=[], model=model, num_candidates=3)
+        assert agent.run("Answer.") == "done"
+        assert model.max_running == 1
+
+    def test_best_of_n_candidate_scorer(self):
+        class FakeCandidatesModel(Model):
+            def __init__(self):
+                super().__init__()
+                self.values = iter([1, 3, 2])
+                self.lock = threading.Lock()
+
+            def generate(self, messages, stop_sequences=None, grammar=None):
+                with self.lock:
+                    value = next(self.values)
+                return ChatMessage(role="assistant", content=f"Code:\n```py\ny = {value}\ny\n```<end_code>")
+
+        candidate_scorer = MagicMock(side_effect=lambda code_action, output, execution_logs: output == 3)
+        agent = CodeAgent(
+            tools=[], model=FakeCandidatesModel(), num_candidates=3, candidate_scorer=candidate_scorer, max_steps=1
+        )
+        agent.run("Compute 3.")
+        assert agent.python_executor.state["y"] == 3
+        assert agent.memory.steps[1].action_output == 3
+        assert candidate_scorer.call_args.args == ("y = 3\ny", 3, "")
+
+    def test_best_of_n_keeps_first_candidate_when_all_fail(self):
+        class FakeCandidatesModel(Model):
+            def generate(self, messages, stop_sequences=None, grammar=None):
+                return ChatMessage(
+                    role="assistant", content="Code:\n```py\nprint('Flag!')\nerror_function()\n```<end_code>"
+                )
+
+        agent = CodeAgent(tools=[], model=FakeCandidatesModel(), num_candidates=2, max_steps=1)
+        agent.run("Fail.")
+        assert "error_function" in str(agent.memory.steps[1].error)
+        assert "Flag!" in agent.memory.steps[1].observations
+
+    def test_best_of_n_requires_local_executor_without_streaming(self):
+        with patch("smolagents.agents.DockerExecutor"), pytest.raises(ValueError, match="num_candidates"):
+            CodeAgent(tools=[], model=FakeCodeModel(), num_candidates=2, executor_type="docker")
+
     def test_syntax_error_show_offending_lines(self):
         agent = CodeAgent(tools=[PythonInterpreterTool()], model=FakeCodeModelSyntaxError())
         output = agent.run("What is 2 multiplied by 3.6452?")
@@ -12,21 +12,41 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import asyncio
+import base64
 import json
 import sys
+import threading
+import time
 import unittest
+from concurrent.futures import Future, ThreadPoolExecutor
 from contextlib import ExitStack
-from unittest.mock import MagicMock, patch
+from io import BytesIO
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock, patch
 
+import PIL.Image
 import pytest
-from huggingface_hub import ChatCompletionOutputMessage
+from huggingface_hub import AsyncInferenceClient, ChatCompletionOutputMessage
 
+from smolagents.memory import ActionStep
 from smolagents.models import (
     AmazonBedrockServerModel,
     AzureOpenAIServerModel,
+    CachedModel,
+    CharacterTokenCounter,
     ChatMessage,
+    ChatMessageStreamAccumulator,
+    ChatMessageStreamDelta,
     ChatMessageToolCall,
+    ChatMessageToolCallDefinition,
+    ChatMessageToolCallStreamDelta,
+    CleanMessageListCache,
+    ClientRegistry,
+    ConnectionPoolConfig,
+    HedgedModel,
     HfApiModel,
+    ImageEncodingPolicy,
     InferenceClientModel,
     LiteLLMModel,
     LiteLLMRouterModel,
@@ -34,18 +54,58 @@ from smolagents.models import (
     MLXModel,
     Model,
     OpenAIServerModel,
+    RateLimitedModel,
+    RateLimiter,
+    StopSequenceMatcher,
+    TokenCounter,
     TransformersModel,
+    TransformersTokenCounter,
+    VLLMModel,
+    _get_retry_after,
     get_clean_message_list,
+    get_rate_limiter,
     get_tool_call_from_text,
     get_tool_json_schema,
     parse_json_if_needed,
     supports_stop_parameter,
+    tool_role_conversions,
 )
+from smolagents.monitoring import Monitor
 from smolagents.tools import tool
 
 from .utils.markers import require_run_all
 
 
+def make_chat_completion(content, prompt_tokens=10, completion_tokens=5):
+    response = MagicMock()
+    response.usage.prompt_tokens = prompt_tokens
+    response.usage.completion_tokens = completion_tokens
+    response.choices[0].message.model_dump.return_value = {"role": "assistant", "content": content}
+    return response
+
+
+def make_chat_completion_chunks(contents, prompt_tokens=10, completion_tokens=5):
+    chunks = []
+    for content in contents:
+        chunk = MagicMock(usage=None)
+        chunk.choices[0].delta.content = content
+        chunk.choices[0].delta.tool_calls = None
+        chunks.append(chunk)
+    chunks.append(
+        MagicMock(choices=[], usage=MagicMock(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens))
+    )
+    return chunks
+
+
+async def aiterate(items):
+    for item in items:
+        yield item
+
+
+async def collect_stream(stream):
+    return [stream_delta async for stream_delta in stream]
+
+
 class TestModel:
     @pytest.mark.parametrize(
         "model_id, stop_sequences, should_contain_stop",
@@ -88,6 +148,33 @@ class TestModel:
 
         assert "nullable" in get_tool_json_schema(get_weather)["function"]["parameters"]["properties"]["celsius"]
 
+    def test_get_tool_json_schema_is_cached_on_the_tool(self):
+        @tool
+        def get_weather(location: str) -> str:
+            """
+            Get weather at given location.
+
+            Args:
+                location: the location
+            """
+            return "sunny"
+
+        json_schema = get_tool_json_schema(get_weather)
+        assert get_tool_json_schema(get_weather) is json_schema
+
+        get_weather.inputs["location"]["description"] = "the city"
+        json_schema = get_tool_json_schema(get_weather)
+        assert json_schema["function"]["parameters"]["properties"]["location"]["description"] == "the city"
+        assert get_tool_json_schema(get_weather) is json_schema
+
+        get_weather.inputs["days"] = {"type": "integer", "description": "number of days", "nullable": True}
+        assert get_tool_json_schema(get_weather)["function"]["parameters"]["required"] == ["location"]
+
+        get_weather.name = "get_forecast"
+        assert get_tool_json_schema(get_weather)["function"]["name"] == "get_forecast"
+        get_weather.description = "Get the forecast."
+        assert get_tool_json_schema(get_weather)["function"]["description"] == "Get the forecast."
+
     def test_chatmessage_has_model_dumps_json(self):
         message = ChatMessage("user", [{"type": "text", "text": "Hello!"}])
         data = json.loads(message.model_dump_json())
@@ -152,6 +239,14 @@ class TestModel:
             output_str += el.content
         assert output_str == "I am"
 
+    def test_agenerate_runs_generate_in_a_thread(self):
+        class SyncModel(Model):
+            def generate(self, messages, stop_sequences=None, **kwargs):
+                return ChatMessage(role="assistant", content=f"{len(messages)} {stop_sequences}")
+
+        message = asyncio.run(SyncModel().agenerate([{"role": "user", "content": "Hi"}], stop_sequences=["stop"]))
+        assert message.content == "1 ['stop']"
+
     def test_parse_json_if_needed(self):
         args = "abc"
         parsed_args = parse_json_if_needed(args)
@@ -170,6 +265,55 @@ class TestModel:
         assert parsed_args == 3
 
 
+class TestTokenCounter:
+    def test_character_token_counter(self):
+        token_counter = CharacterTokenCounter(tokens_per_message=3, tokens_per_image=100)
+        messages = [
+            {"role": "system", "content": "a" * 40},
+            {"role": "user", "content": [{"type": "text", "text": "b" * 20}, {"type": "image", "image": "..."}]},
+        ]
+        assert token_counter.count_tokens(messages) == 3 + 10 + 3 + 5 + 100
+        tools = [{"type": "function", "function": {"name": "final_answer"}}]
+        assert token_counter.count_tokens(messages, tools) == 121 + len(json.dumps(tools)) // 4
+
+    def test_transformers_token_counter(self, tiny_transformers_model_path):
+        token_counter = TransformersTokenCounter(str(tiny_transformers_model_path), tokens_per_message=0)
+        # The tokenizer of the tiny model has a token per character
+        assert token_counter.count_tokens([{"role": "user", "content": "Hello"}]) == 5
+        assert TransformersTokenCounter(str(tiny_transformers_model_path)).tokenizer is token_counter.tokenizer
+
+    def test_prompt_over_budget_fails_before_request(self):
+        model = Model(model_id="test-model", max_input_tokens=50)
+        completion_kwargs = model._prepare_completion_kwargs([{"role": "user", "content": "a" * 100}])
+        assert len(completion_kwargs["messages"]) == 1
+        assert model.last_estimated_input_token_count == 29
+        with pytest.raises(ValueError, match="estimated 254 tokens, more than the budget of 50 input tokens"):
+            model._prepare_completion_kwargs([{"role": "user", "content": "a" * 1000}])
+
+    def test_trim_messages_to_budget(self):
+        model = Model(
+            model_id="test-model", token_counter=CharacterTokenCounter(), max_input_tokens=50, trim_messages=True
+        )
+        messages = [
+            {"role": "system", "content": "System prompt"},
+            {"role": "user", "content": "Task"},
+            {"role": "assistant", "content": "a" * 80},
+            {"role": "user", "content": "Observation 1"},
+            {"role": "assistant", "content": "Step 2"},
+            {"role": "user", "content": "Observation 2"},
+        ]
+        completion_kwargs = model._prepare_completion_kwargs(messages)
+        assert [message["content"] for message in completion_kwargs["messages"]] == [
+            "System prompt",
+            "Task",
+            "Step 2",
+            "Observation 2",
+        ]
+        assert model.last_estimated_input_token_count <= 50
+        with pytest.raises(ValueError, match="more than the budget"):
+            model._prepare_completion_kwargs([messages[0], {"role": "user", "content": "a" * 400}])
+
+
 class TestInferenceClientModel:
     def test_call_with_custom_role_conversions(self):
         custom_role_conversions = {MessageRole.USER: MessageRole.SYSTEM}
@@ -184,6 +328,24 @@ class TestInferenceClientModel:
             "role conversion should be applied"
         )
 
+    def test_agenerate_with_async_client(self):
+        async_client = MagicMock()
+        async_client.chat_completion = AsyncMock(return_value=MagicMock())
+        response = async_client.chat_completion.return_value
+        response.choices[0].message = ChatCompletionOutputMessage(role="assistant", content="Hello")
+        response.usage.prompt_tokens, response.usage.completion_tokens = 10, 5
+        model = InferenceClientModel(model_id="test-model", async_client=async_client)
+        message = asyncio.run(model.agenerate([{"role": "user", "content": "Hi"}], stop_sequences=["stop"]))
+        assert message.content == "Hello"
+        assert async_client.chat_completion.call_args.kwargs["stop"] == ["stop"]
+        assert (model.last_input_token_count, model.last_output_token_count) == (10, 5)
+
+    def test_create_async_client(self):
+        model = InferenceClientModel(model_id="test-model", token="abc", provider="together")
+        assert isinstance(model.async_client, AsyncInferenceClient)
+        assert model.async_client.token == "abc"
+        assert model.async_client is model.async_client
+
     def test_init_model_with_tokens(self):
         model = InferenceClientModel(model_id="test-model", token="abc")
         assert model.client.token == "abc"
@@ -258,6 +420,26 @@ class TestLiteLLMModel:
                 assert el.content is not None
         assert error_flag in str(e)
 
+    def test_agenerate_and_agenerate_stream_use_acompletion(self):
+        client = MagicMock()
+        client.acompletion = AsyncMock(
+            side_effect=[make_chat_completion("Hello"), aiterate(make_chat_completion_chunks(["Hel", "lo"], 12, 2))]
+        )
+        model = LiteLLMModel(model_id="openai/gpt-4o", api_key="key", client=client)
+        messages = [{"role": "user", "content": "Hi"}]
+
+        message = asyncio.run(model.agenerate(messages))
+        assert message.content == "Hello"
+        assert client.acompletion.call_args.kwargs["model"] == "openai/gpt-4o"
+        assert client.acompletion.call_args.kwargs["api_key"] == "key"
+        assert (model.last_input_token_count, model.last_output_token_count) == (10, 5)
+
+        stream_deltas = asyncio.run(collect_stream(model.agenerate_stream(messages)))
+        assert [stream_delta.content for stream_delta in stream_deltas] == ["Hel", "lo"]
+        assert client.acompletion.call_args.kwargs["stream"] is True
+        assert (model.last_input_token_count, model.last_output_token_count) == (12, 2)
+        client.completion.assert_not_called()
+
     def test_passing_flatten_messages(self):
         model = LiteLLMModel(model_id="groq/llama-3.3-70b", flatten_messages_as_text=False)
         assert not model.flatten_messages_as_text
@@ -265,6 +447,62 @@ class TestLiteLLMModel:
         model = LiteLLMModel(model_id="fal/llama-3.3-70b", flatten_messages_as_text=True)
         assert model.flatten_messages_as_text
 
+    def test_prompt_caching_marks_system_prompt_and_prompt_end(self):
+        model = LiteLLMModel(model_id="anthropic/claude-3-7-sonnet", client=MagicMock(), prompt_caching=True)
+        messages = [
+            {"role": "system", "content": [{"type": "text", "text": "System prompt"}]},
+            {"role": "user", "content": [{"type": "text", "text": "Task"}]},
+            {"role": "assistant", "content": [{"type": "text", "text": "Step 1"}]},
+            {"role": "tool-call", "content": [{"type": "text", "text": "Calling tools"}]},
+        ]
+        cache_control = {"type": "ephemeral"}
+        completion_kwargs = model._prepare_api_completion_kwargs(messages)
+        assert completion_kwargs["messages"] == [
+            {"role": "system", "content": [{"type": "text", "text": "System prompt", "cache_control": cache_control}]},
+            {"role": "user", "content": [{"type": "text", "text": "Task"}]},
+            {
+                "role": "assistant",
+                "content": [
+                    {"type": "text", "text": "Step 1"},
+                    {"type": "text", "text": "Calling tools", "cache_control": cache_control},
+                ],
+            },
+        ]
+        # The breakpoints of the previous calls are not left in the next ones
+        messages.append({"role": "tool-response", "content": [{"type": "text", "text": "Observation"}]})
+        completion_kwargs = model._prepare_api_completion_kwargs(messages)
+        assert "cache_control" not in completion_kwargs["messages"][2]["content"][1]
+        assert completion_kwargs["messages"][3]["content"][-1]["cache_control"] == cache_control
+
+    def test_prompt_caching_is_disabled_by_default(self):
+        model = LiteLLMModel(model_id="anthropic/claude-3-7-sonnet", client=MagicMock())
+        messages = [{"role": "system", "content": [{"type": "text", "text": "System prompt"}]}]
+        assert "cache_control" not in model._prepare_api_completion_kwargs(messages)["messages"][0]["content"][0]
+
+    @pytest.mark.parametrize(
+        "model_id, flatten_messages_as_text, expected_content",
+        [
+            (
+                "bedrock/anthropic.claude-3-7-sonnet",
+                False,
+                [{"type": "text", "text": "Task", "cache_control": {"type": "ephemeral"}}],
+            ),
+            ("openai/gpt-4o", False, [{"type": "text", "text": "Task"}]),
+            ("anthropic/claude-3-7-sonnet", True, "Task"),
+        ],
+    )
+    def test_prompt_caching_marks_only_supported_block_content(
+        self, model_id, flatten_messages_as_text, expected_content
+    ):
+        model = LiteLLMModel(
+            model_id=model_id,
+            client=MagicMock(),
+            prompt_caching=True,
+            flatten_messages_as_text=flatten_messages_as_text,
+        )
+        messages = [{"role": "user", "content": [{"type": "text", "text": "Task"}]}]
+        assert model._prepare_api_completion_kwargs(messages)["messages"][0]["content"] == expected_content
+
 
 class TestLiteLLMRouterModel:
     @pytest.mark.parametrize(
@@ -324,6 +562,184 @@ class TestOpenAIServerModel:
         )
         assert model.client == MockOpenAI.return_value
 
+    def test_create_async_client(self):
+        with patch("openai.OpenAI"), patch("openai.AsyncOpenAI") as MockAsyncOpenAI:
+            model = OpenAIServerModel(model_id="gpt-4o", api_base="https://api.openai.com/v1", api_key="key")
+            MockAsyncOpenAI.assert_not_called()
+            assert model.async_client == MockAsyncOpenAI.return_value
+        MockAsyncOpenAI.assert_called_once_with(
+            base_url="https://api.openai.com/v1", api_key="key", organization=None, project=None
+        )
+
+    def test_agenerate_and_agenerate_stream_share_token_accounting(self):
+        async_client = MagicMock()
+        async_client.chat.completions.create = AsyncMock(
+            side_effect=[make_chat_completion("Hello"), aiterate(make_chat_completion_chunks(["Hel", "lo"], 12, 2))]
+        )
+        with patch("openai.OpenAI"):
+            model = OpenAIServerModel(model_id="gpt-4o", async_client=async_client)
+        messages = [{"role": "user", "content": "Hi"}]
+
+        message = asyncio.run(model.agenerate(messages, stop_sequences=["stop"]))
+        assert message.content == "Hello"
+        assert async_client.chat.completions.create.call_args.kwargs["model"] == "gpt-4o"
+        assert async_client.chat.completions.create.call_args.kwargs["stop"] == ["stop"]
+        assert model.get_token_counts() == {"input_token_count": 10, "output_token_count": 5}
+
+        stream_deltas = asyncio.run(collect_stream(model.agenerate_stream(messages)))
+        assert [stream_delta.content for stream_delta in stream_deltas] == ["Hel", "lo"]
+        assert async_client.chat.completions.create.call_args.kwargs["stream_options"] == {"include_usage": True}
+        assert model.get_token_counts() == {"input_token_count": 12, "output_token_count": 2}
+        model.client.chat.completions.create.assert_not_called()
+
+    def test_generate_stream_with_tool_calls(self):
+        chunks = make_chat_completion_chunks([None, None, None])
+        for chunk, tool_call in zip(
+            chunks,
+            [
+                MagicMock(index=0, id="call_0", type="function", function=MagicMock(arguments='{"loc')),
+                MagicMock(index=0, id=None, type=None, function=MagicMock(arguments='ation": "Paris"}')),
+                MagicMock(index=1, id="call_1", type="function", function=MagicMock(arguments="{}")),
+            ],
+        ):
+            chunk.choices[0].delta.tool_calls = [tool_call]
+        chunks[0].choices[0].delta.tool_calls[0].function.name = "get_weather"
+        chunks[1].choices[0].delta.tool_calls[0].function.name = None
+        chunks[2].choices[0].delta.tool_calls[0].function.name = "final_answer"
+        with patch("openai.OpenAI"):
+            model = OpenAIServerModel(model_id="gpt-4o")
+        model.client.chat.completions.create.return_value = chunks
+
+        @tool
+        def get_weather(location: str) -> str:
+            """
+            Get the weather.
+
+            Args:
+                location: The location.
+            """
+            return "sunny"
+
+        accumulator = ChatMessageStreamAccumulator()
+        for stream_delta in model.generate_stream(
+            [{"role": "user", "content": "Hi"}], tools_to_call_from=[get_weather]
+        ):
+            accumulator.add(stream_delta)
+        assert model.client.chat.completions.create.call_args.kwargs["tools"][0]["function"]["name"] == "get_weather"
+        message = accumulator.to_message()
+        assert message.content is None
+        assert message.tool_calls == [
+            ChatMessageToolCall(
+                id="call_0",
+                type="function",
+                function=ChatMessageToolCallDefinition(name="get_weather", arguments='{"location": "Paris"}'),
+            ),
+            ChatMessageToolCall(
+                id="call_1",
+                type="function",
+                function=ChatMessageToolCallDefinition(name="final_answer", arguments="{}"),
+            ),
+        ]
+        assert model.get_token_counts() == {"input_token_count": 10, "output_token_count": 5}
+
+    @pytest.mark.parametrize(
+        "contents, expected_contents, stopped",
+        [
+            (["Hello <end", "_code> and more", "never sent"], ["Hello "], True),
+            (["Hello <end_co", "de>"], ["Hello "], True),
+            (["a <en", "d b", " <e"], ["a ", "<end b", " ", "<e"], False),
+        ],
+    )
+    def test_generate_stream_enforces_stop_sequences_client_side(self, contents, expected_contents, stopped):
+        chunks = make_chat_completion_chunks(contents)
+        stream = MagicMock()
+        stream.__iter__.return_value = iter(chunks)
+        with patch("openai.OpenAI"):
+            model = OpenAIServerModel(model_id="o3")
+        model.client.chat.completions.create.return_value = stream
+        stream_deltas = list(model.generate_stream([{"role": "user", "content": "Hi"}], stop_sequences=["<end_code>"]))
+        assert "stop" not in model.client.chat.completions.create.call_args.kwargs
+        assert [stream_delta.content for stream_delta in stream_deltas] == expected_contents
+        stream.close.assert_called_once()
+        if stopped:
+            # Usage is reported at the end of the stream only: the tokens are estimated from the characters of the
+            # prompt, and of the content received up to the stop sequence
+            assert model.last_input_token_count == CharacterTokenCounter().count_tokens(
+                [{"role": "user", "content": [{"type": "text", "text": "Hi"}]}]
+            )
+            assert model.last_output_token_count == CharacterTokenCounter().count_text_tokens("".join(contents[:2]))
+        else:
+            assert model.get_token_counts() == {"input_token_count": 10, "output_token_count": 5}
+
+    def test_generate_enforces_stop_sequences_client_side(self):
+        with patch("openai.OpenAI"):
+            model = OpenAIServerModel(model_id="o4-mini")
+        model.client.chat.completions.create.return_value = make_chat_completion_chunks(
+            ["print(42)\n", "```<end_code>", "\nObservation: 42"]
+        )
+        message = model.generate([{"role": "user", "content": "Hi"}], stop_sequences=["<end_code>", "Observation:"])
+        assert message.content == "print(42)\n```"
+        assert model.client.chat.completions.create.call_args.kwargs["stream"] is True
+        assert model.last_output_token_count == CharacterTokenCounter().count_text_tokens("print(42)\n```<end_code>")
+
+        # Models supporting the stop parameter are not streamed
+        model.model_id = "gpt-4o"
+        model.client.chat.completions.create.return_value = make_chat_completion("print(42)")
+        assert (
+            model.generate([{"role": "user", "content": "Hi"}], stop_sequences=["<end_code>"]).content == "print(42)"
+        )
+        assert "stream" not in model.client.chat.completions.create.call_args.kwargs
+
+    def test_stream_cut_by_stop_sequences_reports_estimated_input_token_count(self):
+        with patch("openai.OpenAI"):
+            model = OpenAIServerModel(model_id="o3", token_counter=CharacterTokenCounter(characters_per_token=2))
+        model.client.chat.completions.create.return_value = make_chat_completion_chunks(["Done<end_code>", " more"])
+        model.generate([{"role": "user", "content": "a" * 40}], stop_sequences=["<end_code>"])
+        # Both are counted by the token counter of the model
+        assert model.get_token_counts() == {"input_token_count": 24, "output_token_count": 7}
+
+    def test_monitor_counts_tokens_of_streams_cut_by_stop_sequences(self):
+        with patch("openai.OpenAI"):
+            model = OpenAIServerModel(model_id="o3")
+        model.client.chat.completions.create.return_value = make_chat_completion_chunks(["Done<end_code>", " more"])
+        model.generate([{"role": "user", "content": "a" * 40}], stop_sequences=["<end_code>"])
+        monitor = Monitor(model, logger=MagicMock())
+        monitor.update_metrics(ActionStep(step_number=1, duration=1.0))
+        assert monitor.total_input_token_count > 0
+        assert monitor.total_output_token_count == CharacterTokenCounter().count_text_tokens("Done<end_code>")
+
+    def test_agenerate_enforces_stop_sequences_client_side(self):
+        async_client = MagicMock()
+        async_client.chat.completions.create = AsyncMock(
+            return_value=aiterate(make_chat_completion_chunks(["Plan", " done<end_plan>", " extra"]))
+        )
+        with patch("openai.OpenAI"):
+            model = OpenAIServerModel(model_id="o3", async_client=async_client)
+        message = asyncio.run(model.agenerate([{"role": "user", "content": "Hi"}], stop_sequences=["<end_plan>"]))
+        assert message.content == "Plan done"
+        assert model.last_output_token_count == CharacterTokenCounter().count_text_tokens("Plan done<end_plan>")
+
+    def test_get_message_token_counts(self):
+        with patch("openai.OpenAI"):
+            model = OpenAIServerModel(model_id="gpt-4o")
+        model.client.chat.completions.create.return_value = make_chat_completion("Hello", prompt_tokens=2000)
+        message = model.generate([{"role": "user", "content": "Hi"}])
+        model.last_input_token_count = model.last_output_token_count = None  # Another call started
+        assert model.get_message_token_counts(message) == (2000, message.raw.usage.completion_tokens)
+
+    def test_cached_input_token_count(self):
+        with patch("openai.OpenAI"):
+            model = OpenAIServerModel(model_id="gpt-4o")
+        response = make_chat_completion("Hello", prompt_tokens=2000)
+        response.usage.prompt_tokens_details.cached_tokens = 1536
+        model.client.chat.completions.create.return_value = response
+        model.generate([{"role": "user", "content": "Hi"}])
+        assert (model.last_input_token_count, model.last_cached_input_token_count) == (2000, 1536)
+
+        response.usage.prompt_tokens_details = None
+        model.generate([{"role": "user", "content": "Hi"}])
+        assert model.last_cached_input_token_count == 0
+
 
 class TestAmazonBedrockServerModel:
     def test_client_for_bedrock(self):
@@ -336,6 +752,367 @@ class TestAmazonBedrockServerModel:
 
         assert model.client == MockBoto3.return_value
 
+    def test_agenerate_with_aiobotocore_session(self):
+        async_bedrock_client = MagicMock()
+        async_bedrock_client.converse = AsyncMock(
+            return_value={
+                "output": {"message": {"role": "assistant", "content": [{"text": "Hello"}]}},
+                "usage": {"inputTokens": 10, "outputTokens": 5},
+            }
+        )
+        session = MagicMock()
+        session.create_client.return_value.__aenter__ = AsyncMock(return_value=async_bedrock_client)
+        session.create_client.return_value.__aexit__ = AsyncMock(return_value=None)
+        with patch("boto3.client"):
+            model = AmazonBedrockServerModel(
+                model_id="us.amazon.nova-pro-v1:0", client_kwargs={"region_name": "us-west-2"}, async_client=session
+            )
+
+        message = asyncio.run(model.agenerate([{"role": "user", "content": [{"type": "text", "text": "Hi"}]}]))
+        assert message.content == "Hello"
+        session.create_client.assert_called_once_with(service_name="bedrock-runtime", region_name="us-west-2")
+        assert async_bedrock_client.converse.call_args.kwargs["modelId"] == "us.amazon.nova-pro-v1:0"
+        assert async_bedrock_client.converse.call_args.kwargs["messages"] == [
+            {"role": "user", "content": [{"text": "Hi"}]}
+        ]
+        assert (model.last_input_token_count, model.last_output_token_count) == (10, 5)
+
+    @pytest.mark.parametrize("share_client", [False, True])
+    def test_async_client_is_reused_and_closed_on_cleanup(self, share_client):
+        async_bedrock_client = MagicMock()
+        async_bedrock_client.converse = AsyncMock(
+            side_effect=lambda **kwargs: {
+                "output": {"message": {"role": "assistant", "content": [{"text": "Hello"}]}},
+                "usage": {"inputTokens": 10, "outputTokens": 5},
+            }
+        )
+        session = MagicMock()
+        client_context = session.create_client.return_value
+        client_context.__aenter__ = AsyncMock(return_value=async_bedrock_client)
+        client_context.__aexit__ = AsyncMock(return_value=None)
+        with patch("boto3.client"):
+            models = [
+                AmazonBedrockServerModel(
+                    model_id="us.amazon.nova-pro-v1:0", async_client=session, share_client=share_client
+                )
+                for _ in range(2)
+            ]
+
+        async def generate():
+            messages = [{"role": "user", "content": [{"type": "text", "text": "Hi"}]}]
+            await asyncio.gather(*[model.agenerate(messages) for model in models for _ in range(2)])
+
+        event_loop = asyncio.new_event_loop()
+        with patch("smolagents.models.client_registry", ClientRegistry()):
+            try:
+                event_loop.run_until_complete(generate())
+                assert async_bedrock_client.converse.await_count == 4
+                # One client per model, or a single one shared by the models
+                assert client_context.__aenter__.await_count == (1 if share_client else 2)
+                for model in models:
+                    model.cleanup()
+                # Shared clients are left open for the other models
+                assert client_context.__aexit__.await_count == (0 if share_client else 2)
+            finally:
+                event_loop.close()
+
+    @pytest.mark.parametrize(
+        "content, flatten_messages_as_text",
+        [([{"type": "text", "text": "Hi"}], True), ("Hi", False)],
+    )
+    def test_text_content_is_sent_as_blocks(self, content, flatten_messages_as_text):
+        client = MagicMock()
+        client.converse.return_value = {
+            "output": {"message": {"role": "assistant", "content": [{"text": "Hello"}]}},
+            "usage": {"inputTokens": 10, "outputTokens": 5},
+        }
+        model = AmazonBedrockServerModel(model_id="us.amazon.nova-pro-v1:0", client=client)
+        model.generate([{"role": "user", "content": content}], flatten_messages_as_text=flatten_messages_as_text)
+        assert client.converse.call_args.kwargs["messages"] == [{"role": "user", "content": [{"text": "Hi"}]}]
+
+    def test_prompt_caching_adds_cache_point_and_counts_cached_tokens(self):
+        client = MagicMock()
+        client.converse.return_value = {
+            "output": {"message": {"role": "assistant", "content": [{"text": "Hello"}]}},
+            "usage": {"inputTokens": 10, "outputTokens": 5, "cacheReadInputTokens": 1500, "cacheWriteInputTokens": 20},
+        }
+        model = AmazonBedrockServerModel(model_id="anthropic.claude-3-7-sonnet", client=client, prompt_caching=True)
+        messages = [
+            {"role": "system", "content": [{"type": "text", "text": "System prompt"}]},
+            {"role": "user", "content": [{"type": "text", "text": "Task"}]},
+        ]
+        model.generate(messages)
+        # Text blocks are not merged, so that the cached prefix of a call is a prefix of the next calls
+        assert client.converse.call_args.kwargs["messages"] == [
+            {
+                "role": "user",
+                "content": [{"text": "System prompt"}, {"text": "Task"}, {"cachePoint": {"type": "default"}}],
+            }
+        ]
+        assert (model.last_input_token_count, model.last_cached_input_token_count) == (1530, 1500)
+
+    @staticmethod
+    def make_converse_stream(texts, usage=None):
+        events = [
+            {"messageStart": {"role": "assistant"}},
+            {"contentBlockStart": {"start": {}, "contentBlockIndex": 0}},
+        ]
+        events += [{"contentBlockDelta": {"delta": {"text": text}, "contentBlockIndex": 0}} for text in texts]
+        events += [{"contentBlockStop": {"contentBlockIndex": 0}}, {"messageStop": {"stopReason": "end_turn"}}]
+        events.append({"metadata": {"usage": usage or {"inputTokens": 10, "outputTokens": 5}, "metrics": {}}})
+        stream = MagicMock()
+        stream.__iter__.return_value = iter(events)
+        return stream
+
+    def test_generate_stream(self):
+        client = MagicMock()
+        stream = self.make_converse_stream(
+            ["Hel", "lo"], usage={"inputTokens": 10, "outputTokens": 5, "cacheReadInputTokens": 100}
+        )
+        client.converse_stream.return_value = {"stream": stream}
+        model = AmazonBedrockServerModel(model_id="us.amazon.nova-pro-v1:0", client=client)
+        stream_deltas = list(model.generate_stream([{"role": "user", "content": [{"type": "text", "text": "Hi"}]}]))
+        assert [stream_delta.content for stream_delta in stream_deltas] == ["Hel", "lo"]
+        assert client.converse_stream.call_args.kwargs["messages"] == [{"role": "user", "content": [{"text": "Hi"}]}]
+        assert model.get_token_counts() == {"input_token_count": 110, "output_token_count": 5}
+        assert model.last_cached_input_token_count == 100
+        stream.close.assert_called_once()
+
+    @pytest.mark.parametrize("stream", [False, True])
+    def test_stop_sequences_are_only_sent_to_converse_stream(self, stream):
+        client = MagicMock()
+        client.converse.return_value = {
+            "output": {"message": {"role": "assistant", "content": [{"text": "print(1)"}]}},
+            "usage": {"inputTokens": 10, "outputTokens": 5},
+        }
+        client.converse_stream.return_value = {"stream": self.make_converse_stream(["print(1)"])}
+        model = AmazonBedrockServerModel(
+            model_id="us.amazon.nova-pro-v1:0", client=client, inferenceConfig={"maxTokens": 100}
+        )
+        messages = [{"role": "user", "content": [{"type": "text", "text": "Hi"}]}]
+        if stream:
+            list(model.generate_stream(messages, stop_sequences=["<end_code>"]))
+            call_kwargs = client.converse_stream.call_args.kwargs
+        else:
+            model.generate(messages, stop_sequences=["<end_code>"])
+            call_kwargs = client.converse.call_args.kwargs
+        expected_inference_config = (
+            {"maxTokens": 100, "stopSequences": ["<end_code>"]} if stream else {"maxTokens": 100}
+        )
+        assert call_kwargs["inferenceConfig"] == expected_inference_config
+        assert model.kwargs["inferenceConfig"] == {"maxTokens": 100}
+
+    def test_generate_stream_tool_calls(self):
+        client = MagicMock()
+        events = [
+            {
+                "contentBlockStart": {
+                    "start": {"toolUse": {"toolUseId": "call_0", "name": "final_answer"}},
+                    "contentBlockIndex": 0,
+                }
+            },
+            {"contentBlockDelta": {"delta": {"toolUse": {"input": '{"answer": '}}, "contentBlockIndex": 0}},
+            {"contentBlockDelta": {"delta": {"toolUse": {"input": '"42"}'}}, "contentBlockIndex": 0}},
+            {"metadata": {"usage": {"inputTokens": 10, "outputTokens": 5}}},
+        ]
+        client.converse_stream.return_value = {"stream": iter(events)}
+        model = AmazonBedrockServerModel(model_id="us.amazon.nova-pro-v1:0", client=client)
+        accumulator = ChatMessageStreamAccumulator()
+        for stream_delta in model.generate_stream([{"role": "user", "content": [{"type": "text", "text": "Hi"}]}]):
+            accumulator.add(stream_delta)
+        tool_call = accumulator.to_message().tool_calls[0]
+        assert (tool_call.id, tool_call.function.name, tool_call.function.arguments) == (
+            "call_0",
+            "final_answer",
+            '{"answer": "42"}',
+        )
+
+    def test_generate_stream_raises_error_events(self):
+        client = MagicMock()
+        client.converse_stream.return_value = {
+            "stream": iter([{"throttlingException": {"message": "Too many requests"}}])
+        }
+        model = AmazonBedrockServerModel(model_id="us.amazon.nova-pro-v1:0", client=client)
+        with pytest.raises(ValueError, match="throttlingException: Too many requests"):
+            list(model.generate_stream([{"role": "user", "content": [{"type": "text", "text": "Hi"}]}]))
+
+    def test_agenerate_stream_with_aiobotocore_session(self):
+        async_bedrock_client = MagicMock()
+        async_bedrock_client.converse_stream = AsyncMock(
+            return_value={
+                "stream": aiterate(
+                    [
+                        {"contentBlockDelta": {"delta": {"text": "Hello"}, "contentBlockIndex": 0}},
+                        {"metadata": {"usage": {"inputTokens": 10, "outputTokens": 5}}},
+                    ]
+                )
+            }
+        )
+        session = MagicMock()
+        session.create_client.return_value.__aenter__ = AsyncMock(return_value=async_bedrock_client)
+        session.create_client.return_value.__aexit__ = AsyncMock(return_value=None)
+        with patch("boto3.client"):
+            model = AmazonBedrockServerModel(model_id="us.amazon.nova-pro-v1:0", async_client=session)
+        stream_deltas = asyncio.run(
+            collect_stream(model.agenerate_stream([{"role": "user", "content": [{"type": "text", "text": "Hi"}]}]))
+        )
+        assert [stream_delta.content for stream_delta in stream_deltas] == ["Hello"]
+        assert model.get_token_counts() == {"input_token_count": 10, "output_token_count": 5}
+
+
+class FakeStreamingModel(Model):
+    def __init__(self, **kwargs):
+        super().__init__(model_id="fake-model", **kwargs)
+        self.calls = 0
+
+    def generate(self, messages, stop_sequences=None, grammar=None, tools_to_call_from=None, **kwargs):
+        self.calls += 1
+        self.last_input_token_count, self.last_output_token_count = 10, self.calls
+        if tools_to_call_from:
+            return ChatMessage(
+                role="assistant",
+                tool_calls=[
+                    ChatMessageToolCall(
+                        id="call_0",
+                        type="function",
+                        function=ChatMessageToolCallDefinition(name="final_answer", arguments={"answer": "42"}),
+                    )
+                ],
+                raw=object(),
+            )
+        return ChatMessage(role="assistant", content=f"Answer {self.calls}", raw=object())
+
+    def generate_stream(self, messages, stop_sequences=None, grammar=None, tools_to_call_from=None, **kwargs):
+        self.calls += 1
+        for content in ["Ans", "wer"]:
+            yield ChatMessageStreamDelta(content=content)
+        self.last_input_token_count, self.last_output_token_count = 10, 2
+
+
+class TestCachedModel:
+    messages = [{"role": "user", "content": [{"type": "text", "text": "Hello!"}]}]
+
+    def test_generate_replays_message_and_token_counts(self, tmp_path):
+        wrapped_model = FakeStreamingModel(temperature=0)
+        model = CachedModel(wrapped_model, cache_path=tmp_path / "cache.sqlite")
+        first = model.generate(self.messages, stop_sequences=["<end_code>"])
+        second = model.generate(self.messages, stop_sequences=["<end_code>"])
+        assert first.content == second.content == "Answer 1"
+        assert second.raw is None
+        assert wrapped_model.calls == 1
+        assert (model.hits, model.misses) == (1, 1)
+        assert model.get_token_counts() == {"input_token_count": 10, "output_token_count": 1}
+
+    def test_tool_calls_are_replayed(self, tmp_path):
+        @tool
+        def get_weather(location: str) -> str:
+            """
+            Get the weather.
+
+            Args:
+                location: The location.
+            """
+            return "sunny"
+
+        model = CachedModel(FakeStreamingModel(), cache_path=tmp_path / "cache.sqlite")
+        model.generate(self.messages, tools_to_call_from=[get_weather])
+        message = model.generate(self.messages, tools_to_call_from=[get_weather])
+        assert model.hits == 1
+        assert message.tool_calls[0].function == ChatMessageToolCallDefinition(
+            name="final_answer", arguments={"answer": "42"}
+        )
+        # Tools are part of the key
+        model.generate(self.messages)
+        assert model.misses == 2
+
+    @pytest.mark.parametrize(
+        "request_kwargs",
+        [
+            {"stop_sequences": ["Observation:"]},
+            {"temperature": 0.5},
+            {"messages": [{"role": "user", "content": [{"type": "text", "text": "Bye!"}]}]},
+        ],
+    )
+    def test_request_changes_miss(self, tmp_path, request_kwargs):
+        model = CachedModel(FakeStreamingModel(), cache_path=tmp_path / "cache.sqlite")
+        model.generate(self.messages)
+        model.generate(**{"messages": self.messages, **request_kwargs})
+        assert (model.hits, model.misses) == (0, 2)
+
+    def test_images_with_same_bytes_but_different_modes_miss(self, tmp_path):
+        model = CachedModel(FakeStreamingModel(), cache_path=tmp_path / "cache.sqlite")
+        # A 2x1 RGB image and a 3x2 grayscale image have the same 6 bytes
+        images = [
+            PIL.Image.frombytes("RGB", (2, 1), bytes(range(6))),
+            PIL.Image.frombytes("L", (3, 2), bytes(range(6))),
+        ]
+        for image in images + [images[0].copy()]:
+            model.generate([{"role": "user", "content": [{"type": "image", "image": image}]}])
+        assert (model.hits, model.misses) == (1, 2)
+
+    def test_unserializable_request_raises(self, tmp_path):
+        model = CachedModel(FakeStreamingModel(), cache_path=tmp_path / "cache.sqlite")
+        with pytest.raises(TypeError, match="Object of type object cannot be serialized in a cache key"):
+            model.generate(self.messages, custom_option=object())
+
+    def test_cache_persists_across_instances(self, tmp_path):
+        CachedModel(FakeStreamingModel(), cache_path=tmp_path / "cache.sqlite").generate(self.messages)
+        wrapped_model = FakeStreamingModel()
+        message = CachedModel(wrapped_model, cache_path=tmp_path / "cache.sqlite").generate(self.messages)
+        assert message.content == "Answer 1"
+        assert wrapped_model.calls == 0
+
+    def test_generate_stream_replays_deltas(self, tmp_path):
+        wrapped_model = FakeStreamingModel()
+        model = CachedModel(wrapped_model, cache_path=tmp_path / "cache.sqlite")
+        first = [stream_delta.content for stream_delta in model.generate_stream(self.messages)]
+        second = [stream_delta.content for stream_delta in model.generate_stream(self.messages)]
+        assert first == second == ["Ans", "wer"]
+        assert wrapped_model.calls == 1
+        assert model.get_token_counts() == {"input_token_count": 10, "output_token_count": 2}
+        # Streamed and non-streamed responses are cached separately
+        model.generate(self.messages)
+        assert wrapped_model.calls == 2
+
+    def test_interrupted_stream_is_not_cached(self, tmp_path):
+        model = CachedModel(FakeStreamingModel(), cache_path=tmp_path / "cache.sqlite")
+        next(model.generate_stream(self.messages))
+        list(model.generate_stream(self.messages))
+        assert (model.hits, model.misses) == (0, 2)
+
+    def test_generate_stream_replays_tool_call_deltas(self, tmp_path):
+        class ToolCallStreamingModel(FakeStreamingModel):
+            def generate_stream(self, messages, stop_sequences=None, grammar=None, tools_to_call_from=None, **kwargs):
+                self.calls += 1
+                yield ChatMessageStreamDelta(
+                    tool_calls=[ChatMessageToolCallStreamDelta(index=0, id="call_0", name="final_answer")]
+                )
+                yield ChatMessageStreamDelta(tool_calls=[ChatMessageToolCallStreamDelta(index=0, arguments="{}")])
+
+        wrapped_model = ToolCallStreamingModel()
+        model = CachedModel(wrapped_model, cache_path=tmp_path / "cache.sqlite")
+        first = list(model.generate_stream(self.messages))
+        second = list(model.generate_stream(self.messages))
+        assert first == second
+        assert wrapped_model.calls == 1
+
+    def test_generate_stream_only_exposed_if_supported(self, tmp_path):
+        class NonStreamingModel(Model):
+            pass
+
+        assert not hasattr(CachedModel(NonStreamingModel(), cache_path=tmp_path / "cache.sqlite"), "generate_stream")
+
+    def test_least_recently_used_responses_are_evicted(self, tmp_path):
+        model = CachedModel(FakeStreamingModel(), cache_path=tmp_path / "cache.sqlite", max_size_bytes=400)
+        messages = [[{"role": "user", "content": f"Question {i}"}] for i in range(3)]
+        model.generate(messages[0])
+        model.generate(messages[1])
+        model.generate(messages[0])  # Hit: messages[1] becomes the least recently used
+        model.generate(messages[2])
+        model.generate(messages[0])
+        model.generate(messages[1])
+        assert (model.hits, model.misses) == (2, 4)
+
 
 class TestAzureOpenAIServerModel:
     def test_client_kwargs_passed_correctly(self):
@@ -370,6 +1147,448 @@ class TestAzureOpenAIServerModel:
         assert model.client == MockAzureOpenAI.return_value
 
 
+class TestClientRegistry:
+    @pytest.fixture(autouse=True)
+    def registry(self):
+        registry = ClientRegistry()
+        with patch("smolagents.models.client_registry", registry):
+            yield registry
+
+    def test_get_client(self, registry):
+        create_client = MagicMock(side_effect=lambda: object())
+        client = registry.get_client(("OpenAI", {"api_key": "key"}), create_client)
+        assert registry.get_client(("OpenAI", {"api_key": "key"}), create_client) is client
+        assert registry.get_client(("OpenAI", {"api_key": "other-key"}), create_client) is not client
+        assert create_client.call_count == 2
+        assert registry.get_metrics() == {"clients": 2, "created": 2, "reused": 1}
+        registry.clear()
+        assert registry.get_metrics() == {"clients": 0, "created": 0, "reused": 0}
+
+    def test_models_share_clients(self, registry):
+        with patch("openai.OpenAI", side_effect=lambda **kwargs: MagicMock()) as MockOpenAI:
+            first = OpenAIServerModel(model_id="gpt-4o", api_key="key", share_client=True)
+            second = OpenAIServerModel(model_id="gpt-4o-mini", api_key="key", share_client=True)
+            other_key = OpenAIServerModel(model_id="gpt-4o", api_key="other-key", share_client=True)
+            not_shared = OpenAIServerModel(model_id="gpt-4o", api_key="key")
+        assert first.client is second.client
+        assert other_key.client is not first.client
+        assert not_shared.client is not first.client
+        assert MockOpenAI.call_count == 3
+        assert registry.get_metrics() == {"clients": 2, "created": 2, "reused": 1}
+
+    @pytest.mark.parametrize("share_client", [True, False])
+    def test_async_clients_are_created_per_event_loop(self, registry, share_client):
+        with patch("openai.OpenAI"), patch("openai.AsyncOpenAI", side_effect=lambda **kwargs: MagicMock()):
+            first = OpenAIServerModel(model_id="gpt-4o", api_key="key", share_client=share_client)
+            second = OpenAIServerModel(model_id="gpt-4o-mini", api_key="key", share_client=share_client)
+
+            async def get_async_clients():
+                return first.async_client, second.async_client, first.async_client
+
+            first_clients = asyncio.run(get_async_clients())
+            # The clients of the first event loop were bound to it, and it is closed
+            second_clients = asyncio.run(get_async_clients())
+        assert first_clients[0] is first_clients[2]
+        assert (first_clients[0] is first_clients[1]) == share_client
+        assert second_clients[0] is not first_clients[0]
+        assert second_clients[1] is not first_clients[1]
+        if share_client:
+            # The clients of the closed event loop are forgotten
+            assert registry.get_metrics()["clients"] == 2
+
+    def test_connection_pool(self):
+        connection_pool = {"max_connections": 8, "max_keepalive_connections": 4, "keepalive_expiry": 30.0}
+        with patch("openai.OpenAI") as MockOpenAI, patch("openai.DefaultHttpxClient") as MockHttpxClient:
+            model = OpenAIServerModel(model_id="gpt-4o", api_key="key", connection_pool=connection_pool)
+        assert model.connection_pool == ConnectionPoolConfig(**connection_pool)
+        limits = MockHttpxClient.call_args.kwargs["limits"]
+        assert (limits.max_connections, limits.max_keepalive_connections, limits.keepalive_expiry) == (8, 4, 30.0)
+        assert MockOpenAI.call_args.kwargs["http_client"] == MockHttpxClient.return_value
+
+    def test_connection_pool_of_bedrock_client(self):
+        from botocore.config import Config
+
+        with patch("boto3.client") as MockBoto3:
+            AmazonBedrockServerModel(
+                model_id="us.amazon.nova-pro-v1:0",
+                client_kwargs={"config": Config(read_timeout=120)},
+                connection_pool=ConnectionPoolConfig(max_connections=32),
+            )
+        config = MockBoto3.call_args.kwargs["config"]
+        assert (config.max_pool_connections, config.read_timeout, config.tcp_keepalive) == (32, 120, True)
+
+    def test_connection_pool_not_supported(self):
+        with pytest.raises(ValueError, match="does not support configuring the connection pool"):
+            InferenceClientModel(model_id="test-model", connection_pool=ConnectionPoolConfig())
+
+
+class RateLimitError(Exception):
+    def __init__(self, headers=None):
+        super().__init__("Error code: 429 - Rate limit exceeded")
+        self.status_code = 429
+        self.response = SimpleNamespace(status_code=429, headers=headers or {})
+
+
+class TestRateLimitedModel:
+    def test_generate_delegates_and_records_usage(self):
+        model = RateLimitedModel(FakeStreamingModel(), rate_limiter=RateLimiter(tokens_per_minute=1000))
+        message = model.generate([{"role": "user", "content": [{"type": "text", "text": "a" * 400}]}])
+        assert message.content == "Answer 1"
+        assert model.get_token_counts() == {"input_token_count": 10, "output_token_count": 1}
+        # The estimate of 100 tokens was corrected to the 11 tokens used
+        assert model.rate_limiter._buckets["tokens"][0] == pytest.approx(989, abs=1)
+        assert model.rate_limiter.get_metrics()["queue_depth"] == 0
+
+    def test_usage_is_that_of_each_call(self):
+        wrapped_model = FakeBackendModel("backend", token_counts=(10, 5))
+        original_generate = wrapped_model.generate
+
+        def generate(messages, **kwargs):
+            message = original_generate(messages, **kwargs)
+            # Another agent sharing the model gets its answer before the usage of this call is recorded
+            wrapped_model.last_input_token_count, wrapped_model.last_output_token_count = 99, 99
+            return message
+
+        wrapped_model.generate = generate
+        model = RateLimitedModel(wrapped_model, rate_limiter=RateLimiter(tokens_per_minute=1000))
+        model.generate([{"role": "user", "content": "Hello"}])
+        assert model.get_token_counts() == {"input_token_count": 10, "output_token_count": 5}
+        assert model.rate_limiter._buckets["tokens"][0] == pytest.approx(985, abs=1)
+
+    def test_estimate_uses_token_counter_of_the_model(self):
+        token_counter = MagicMock(spec=TokenCounter)
+        token_counter.count_tokens.return_value = 50
+        wrapped_model = FakeStreamingModel(token_counter=token_counter, max_tokens=20)
+        model = RateLimitedModel(wrapped_model, rate_limiter=RateLimiter())
+        messages = [{"role": "user", "content": "Hello"}]
+        assert model._estimate_token_count(messages) == 70
+        token_counter.count_tokens.assert_called_once_with(messages, None)
+        # Without a token counter, input tokens are estimated from the number of characters
+        assert RateLimitedModel(FakeStreamingModel(), rate_limiter=RateLimiter())._estimate_token_count(
+            [{"role": "user", "content": "a" * 400}]
+        ) == CharacterTokenCounter().count_tokens([{"role": "user", "content": "a" * 400}])
+
+    def test_rate_limiter_waits_for_buckets_to_refill(self):
+        rate_limiter = RateLimiter(requests_per_minute=2, tokens_per_minute=600)
+        assert rate_limiter.reserve(100) == 0
+        assert rate_limiter.reserve(100) == 0
+        # The third request waits for a request to refill, in 30s
+        assert rate_limiter.reserve(100) == pytest.approx(30, abs=0.1)
+        # The fourth one waits for 200 tokens to refill, in 20s, and a request, in 60s
+        assert rate_limiter.reserve(300) == pytest.approx(60, abs=0.1)
+        assert rate_limiter.get_metrics()["max_queue_depth"] == 4
+
+    def test_rate_limiters_are_shared_per_provider_and_model(self):
+        first = RateLimitedModel(FakeStreamingModel(), requests_per_minute=60)
+        second = RateLimitedModel(FakeStreamingModel(), requests_per_minute=60)
+        other_limits = RateLimitedModel(FakeStreamingModel(), requests_per_minute=30)
+        assert first.rate_limiter is second.rate_limiter
+        assert other_limits.rate_limiter is not first.rate_limiter
+        assert get_rate_limiter(("FakeStreamingModel", None, "fake-model"), 60) is first.rate_limiter
+
+    @pytest.mark.parametrize(
+        "error, expected_delay",
+        [
+            (RateLimitError({"retry-after": "3"}), 3),
+            (RateLimitError({"Retry-After-Ms": "1500"}), 1.5),
+            (RateLimitError(), 0),
+            (ValueError("Not a rate limit"), None),
+        ],
+    )
+    def test_get_retry_after(self, error, expected_delay):
+        assert _get_retry_after(error) == expected_delay
+
+    def test_retries_rate_limited_requests(self):
+        wrapped_model = FakeStreamingModel()
+        wrapped_model.generate = MagicMock(
+            side_effect=[
+                RateLimitError({"retry-after": "5"}),
+                RateLimitError(),
+                ChatMessage(role="assistant", content="ok"),
+            ]
+        )
+        model = RateLimitedModel(wrapped_model, base_delay=1, rate_limiter=RateLimiter())
+        waits = []
+        clock = SimpleNamespace(now=0.0)
+
+        def sleep(seconds):
+            waits.append(seconds)
+            clock.now += seconds
+
+        fake_time = SimpleNamespace(monotonic=lambda: clock.now, sleep=sleep, time=lambda: clock.now)
+        with (
+            patch("smolagents.models.time", fake_time),
+            patch("smolagents.models.random.uniform", side_effect=lambda low, high: high),
+        ):
+            assert model.generate([{"role": "user", "content": "Hello"}]).content == "ok"
+        assert wrapped_model.generate.call_count == 3
+        # The first retry waits for the Retry-After header, the second one for the backoff of 2s
+        assert waits == [0, 5, 2]
+        assert model.rate_limiter.get_metrics()["rate_limited_count"] == 2
+
+    def test_does_not_retry_other_errors_or_too_many_times(self):
+        wrapped_model = FakeStreamingModel()
+        wrapped_model.generate = MagicMock(side_effect=ValueError("Bad request"))
+        model = RateLimitedModel(wrapped_model, rate_limiter=RateLimiter())
+        with pytest.raises(ValueError, match="Bad request"):
+            model.generate([{"role": "user", "content": "Hello"}])
+        wrapped_model.generate = MagicMock(side_effect=RateLimitError())
+        model = RateLimitedModel(wrapped_model, max_retries=2, rate_limiter=RateLimiter())
+        with patch("smolagents.models.time.sleep"), pytest.raises(RateLimitError):
+            model.generate([{"role": "user", "content": "Hello"}])
+        assert wrapped_model.generate.call_count == 3
+
+    def test_failed_attempts_give_back_their_tokens(self):
+        wrapped_model = FakeStreamingModel()
+        wrapped_model.generate = MagicMock(side_effect=[RateLimitError(), ValueError("Bad request")])
+        rate_limiter = RateLimiter(tokens_per_minute=1000)
+        model = RateLimitedModel(wrapped_model, rate_limiter=rate_limiter)
+        with patch("smolagents.models.time.sleep"), pytest.raises(ValueError, match="Bad request"):
+            model.generate([{"role": "user", "content": [{"type": "text", "text": "a" * 400}]}])
+        # Neither the retried attempt nor the failed one keep their reservation of 100 tokens
+        assert rate_limiter._buckets["tokens"][0] == pytest.approx(1000, abs=1)
+
+    def test_generate_stream_retries_before_first_delta(self):
+        wrapped_model = FakeStreamingModel()
+        streams = [iter_raising(RateLimitError()), wrapped_model.generate_stream([])]
+        wrapped_model.generate_stream = MagicMock(side_effect=streams)
+        model = RateLimitedModel(wrapped_model, rate_limiter=RateLimiter())
+        with patch("smolagents.models.time.sleep"):
+            deltas = list(model.generate_stream([{"role": "user", "content": "Hello"}]))
+        assert "".join(delta.content for delta in deltas) == "Answer"
+        assert model.last_output_token_count == 2
+        assert not hasattr(RateLimitedModel(Model(), rate_limiter=RateLimiter()), "generate_stream")
+
+    def test_agenerate_retries_rate_limited_requests(self):
+        wrapped_model = FakeStreamingModel()
+        wrapped_model.agenerate = AsyncMock(
+            side_effect=[RateLimitError(), ChatMessage(role="assistant", content="ok")]
+        )
+        model = RateLimitedModel(wrapped_model, rate_limiter=RateLimiter())
+        with patch("smolagents.models.asyncio.sleep", new_callable=AsyncMock):
+            message = asyncio.run(model.agenerate([{"role": "user", "content": "Hello"}]))
+        assert message.content == "ok"
+        assert wrapped_model.agenerate.call_count == 2
+
+
+def iter_raising(error):
+    raise error
+    yield
+
+
+class FakeBackendModel(Model):
+    def __init__(self, name, error=None, release=None, token_counts=(10, 5)):
+        super().__init__(model_id=name)
+        self.error, self.release, self.token_counts = error, release, token_counts
+        self.calls = 0
+        self.cancelled = False
+
+    def generate(self, messages, **kwargs):
+        self.calls += 1
+        if self.release is not None:
+            self.release.wait(timeout=5)
+        if self.error is not None:
+            raise self.error
+        self.last_input_token_count, self.last_output_token_count = self.token_counts
+        return ChatMessage(role="assistant", content=f"Answer of {self.model_id}", raw={"usage": self.token_counts})
+
+    def get_message_token_counts(self, message):
+        # Like API models, which read the usage of the response of each call
+        return message.raw["usage"] if message.raw else super().get_message_token_counts(message)
+
+    async def agenerate(self, messages, **kwargs):
+        self.calls += 1
+        if self.release is not None:
+            try:
+                await asyncio.sleep(5)
+            except asyncio.CancelledError:
+                self.cancelled = True
+                raise
+        if self.error is not None:
+            raise self.error
+        self.last_input_token_count, self.last_output_token_count = self.token_counts
+        return ChatMessage(role="assistant", content=f"Answer of {self.model_id}", raw={"usage": self.token_counts})
+
+    def generate_stream(self, messages, **kwargs):
+        self.calls += 1
+        if self.error is not None:
+            raise self.error
+        yield ChatMessageStreamDelta(content=f"Answer of {self.model_id}")
+        self.last_input_token_count, self.last_output_token_count = self.token_counts
+
+
+class TestHedgedModel:
+    def test_requires_several_models(self):
+        with pytest.raises(ValueError, match="at least two models"):
+            HedgedModel([FakeBackendModel("primary")])
+
+    def test_generate_uses_primary(self):
+        primary, secondary = FakeBackendModel("primary"), FakeBackendModel("secondary")
+        model = HedgedModel([primary, secondary])
+        assert model.generate([{"role": "user", "content": "Hello"}]).content == "Answer of primary"
+        assert (primary.calls, secondary.calls) == (1, 0)
+        assert model.get_token_counts() == {"input_token_count": 10, "output_token_count": 5}
+        assert len(model.latencies[0]) == 1
+
+    def test_generate_falls_back_on_failure(self):
+        primary = FakeBackendModel("primary", error=ValueError("Server error"))
+        secondary = FakeBackendModel("secondary", token_counts=(20, 7))
+        model = HedgedModel([primary, secondary])
+        assert model.generate([{"role": "user", "content": "Hello"}]).content == "Answer of secondary"
+        assert model.get_token_counts() == {"input_token_count": 20, "output_token_count": 7}
+        assert model.get_metrics()["fallbacks"] == 1
+
+    def test_generate_raises_when_all_models_fail(self):
+        model = HedgedModel(
+            [
+                FakeBackendModel("primary", error=ValueError("First")),
+                FakeBackendModel("secondary", error=ValueError("Second")),
+            ]
+        )
+        with pytest.raises(ValueError, match="Second"):
+            model.generate([{"role": "user", "content": "Hello"}])
+
+    def test_generate_hedges_slow_primary(self):
+        release = threading.Event()
+        primary = FakeBackendModel("primary", release=release, token_counts=(10, 5))
+        secondary = FakeBackendModel("secondary", token_counts=(20, 7))
+        model = HedgedModel([primary, secondary], hedge_delay=0.01)
+        try:
+            assert model.generate([{"role": "user", "content": "Hello"}]).content == "Answer of secondary"
+        finally:
+            release.set()
+        assert model.get_token_counts() == {"input_token_count": 20, "output_token_count": 7}
+        metrics = model.get_metrics()
+        assert (metrics["hedged_requests"], metrics["hedge_wins"]) == (1, 1)
+
+    def test_generate_counts_tokens_of_discarded_answers(self):
+        release = threading.Event()
+        primary = FakeBackendModel("primary", release=release, token_counts=(10, 5))
+        model = HedgedModel([primary, FakeBackendModel("secondary", token_counts=(20, 7))], hedge_delay=0.01)
+        model.generate([{"role": "user", "content": "Hello"}])
+        assert model.get_metrics()["discarded_input_tokens"] == 0
+        release.set()
+        model._executor.shutdown(wait=True)
+        metrics = model.get_metrics()
+        assert (metrics["discarded_input_tokens"], metrics["discarded_output_tokens"]) == (10, 5)
+
+    def test_token_counts_are_those_of_each_call(self):
+        primary = FakeBackendModel("primary")
+        model = HedgedModel([primary, FakeBackendModel("secondary")])
+        original_generate = primary.generate
+
+        def generate(messages, **kwargs):
+            message = original_generate(messages, **kwargs)
+            # Another call to the model ends before the token counts of this one are read
+            primary.last_input_token_count, primary.last_output_token_count = 99, 99
+            return message
+
+        primary.generate = generate
+        model.generate([{"role": "user", "content": "Hello"}])
+        assert model.get_token_counts() == {"input_token_count": 10, "output_token_count": 5}
+
+    def test_max_hedges(self):
+        release = threading.Event()
+        models = [FakeBackendModel(name, release=release) for name in ("first", "second")]
+        models.append(FakeBackendModel("third"))
+        model = HedgedModel(models, hedge_delay=0.01, max_hedges=2)
+        try:
+            assert model.generate([{"role": "user", "content": "Hello"}]).content == "Answer of third"
+        finally:
+            release.set()
+        assert model.get_metrics()["hedged_requests"] == 2
+        assert model._executor._max_workers == 6
+        with pytest.raises(ValueError, match="max_hedges"):
+            HedgedModel(models, max_hedges=0)
+
+    def test_hedge_delay_is_latency_percentile(self):
+        model = HedgedModel([FakeBackendModel("primary"), FakeBackendModel("secondary")], hedge_percentile=90)
+        assert model._get_hedge_delay(0) is None
+        model.latencies[0].extend([i / 10 for i in range(1, 21)])
+        assert model._get_hedge_delay(0) == 1.9
+
+    def test_circuit_breaker(self):
+        primary = FakeBackendModel("primary", error=ValueError("Server error"))
+        model = HedgedModel([primary, FakeBackendModel("secondary")], failure_threshold=2, recovery_timeout=0.05)
+        for _ in range(3):
+            model.generate([{"role": "user", "content": "Hello"}])
+        # The circuit opened after two failures
+        assert primary.calls == 2
+        assert model.get_metrics()["circuit_states"] == ["open", "closed"]
+        time.sleep(0.06)
+        assert model.get_metrics()["circuit_states"] == ["half_open", "closed"]
+        primary.error = None
+        assert model.generate([{"role": "user", "content": "Hello"}]).content == "Answer of primary"
+        assert model.get_metrics()["circuit_states"] == ["closed", "closed"]
+
+    def test_agenerate_hedges_and_cancels_slow_primary(self):
+        primary = FakeBackendModel("primary", release=True)
+        secondary = FakeBackendModel("secondary", token_counts=(20, 7))
+        model = HedgedModel([primary, secondary], hedge_delay=0.01)
+
+        async def generate():
+            message = await model.agenerate([{"role": "user", "content": "Hello"}])
+            await asyncio.sleep(0)
+            return message
+
+        assert asyncio.run(generate()).content == "Answer of secondary"
+        assert primary.cancelled
+        assert model.get_token_counts() == {"input_token_count": 20, "output_token_count": 7}
+
+    def test_generate_releases_trial_of_cancelled_hedge(self):
+        class QueueingExecutor:
+            """Runs the first call after a delay, and leaves the others queued."""
+
+            def __init__(self):
+                self.futures = []
+
+            def submit(self, fn, *args, **kwargs):
+                future = Future()
+                if not self.futures:
+                    threading.Timer(0.1, lambda: future.set_result(fn(*args, **kwargs))).start()
+                self.futures.append(future)
+                return future
+
+        primary, secondary = FakeBackendModel("primary"), FakeBackendModel("secondary")
+        model = HedgedModel([primary, secondary], hedge_delay=0.01)
+        model._executor = QueueingExecutor()
+        model.circuit_breakers[1].opened_at = time.monotonic() - 60
+        assert model.generate([{"role": "user", "content": "Hello"}]).content == "Answer of primary"
+        assert secondary.calls == 0
+        assert model.circuit_breakers[1].allow_request()
+
+    def test_agenerate_releases_trial_of_cancelled_request(self):
+        primary = FakeBackendModel("primary", release=True)
+        model = HedgedModel([primary, FakeBackendModel("secondary")], hedge_delay=0.01)
+        model.circuit_breakers[0].opened_at = time.monotonic() - 60
+
+        async def generate():
+            message = await model.agenerate([{"role": "user", "content": "Hello"}])
+            await asyncio.sleep(0)
+            return message
+
+        assert asyncio.run(generate()).content == "Answer of secondary"
+        assert primary.cancelled
+        assert model.get_metrics()["circuit_states"] == ["half_open", "closed"]
+        assert model.circuit_breakers[0].allow_request()
+
+    def test_generate_stream_falls_back_before_first_delta(self):
+        primary = FakeBackendModel("primary", error=ValueError("Server error"))
+        model = HedgedModel([primary, FakeBackendModel("secondary", token_counts=(20, 7))])
+        deltas = list(model.generate_stream([{"role": "user", "content": "Hello"}]))
+        assert [delta.content for delta in deltas] == ["Answer of secondary"]
+        assert model.get_token_counts() == {"input_token_count": 20, "output_token_count": 7}
+        assert not hasattr(HedgedModel([Model(), Model()]), "generate_stream")
+
+    def test_generate_stream_reads_token_counts_of_the_call(self):
+        secondary = FakeBackendModel("secondary")
+        model = HedgedModel([FakeBackendModel("primary"), secondary])
+        model.models[0].get_message_token_counts = MagicMock(return_value=(30, 9))
+        list(model.generate_stream([{"role": "user", "content": "Hello"}]))
+        assert model.get_token_counts() == {"input_token_count": 30, "output_token_count": 9}
+        assert model.models[0].get_message_token_counts.call_args.args[0].content == "Answer of primary"
+
+
 class TestTransformersModel:
     @pytest.mark.parametrize(
         "patching",
@@ -417,6 +1636,454 @@ class TestTransformersModel:
             assert mocks["transformers.AutoProcessor.from_pretrained"].call_args.kwargs == {"trust_remote_code": True}
 
 
+@pytest.fixture(scope="module")
+def tiny_transformers_model_path(tmp_path_factory):
+    """Tiny random Llama model with a character-level tokenizer, so that tests run offline."""
+    pytest.importorskip("torch")
+    import torch
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers
+    from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+    torch.manual_seed(0)
+    path = tmp_path_factory.mktemp("tiny_model")
+    vocab = {"<unk>": 0, "<s>": 1, "</s>": 2}
+    for i in range(256):
+        vocab.setdefault(chr(i), len(vocab))
+    tokenizer = Tokenizer(models.WordLevel(vocab=vocab, unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Split("", "isolated")
+    tokenizer.decoder = decoders.Fuse()
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer, bos_token="<s>", eos_token="</s>", unk_token="<unk>"
+    )
+    tokenizer.chat_template = (
+        "{% for message in messages %}<s>{{ message['role'] }}\n{{ message['content'] }}</s>\n{% endfor %}"
+        "{% if add_generation_prompt %}<s>assistant\n{% endif %}"
+    )
+    tokenizer.save_pretrained(path)
+    config = LlamaConfig(
+        vocab_size=len(vocab),
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        bos_token_id=1,
+        eos_token_id=2,
+    )
+    LlamaForCausalLM(config).save_pretrained(path)
+    return str(path)
+
+
+class TestTransformersModelPromptCaching:
+    @staticmethod
+    def make_model(path, **kwargs):
+        return TransformersModel(model_id=path, device_map="cpu", max_new_tokens=8, do_sample=False, **kwargs)
+
+    def test_outputs_match_and_prefix_is_reused(self, tiny_transformers_model_path):
+        model = self.make_model(tiny_transformers_model_path)
+        cached_model = self.make_model(tiny_transformers_model_path, prompt_caching=True)
+        messages = [
+            {"role": "system", "content": [{"type": "text", "text": "You are an agent."}]},
+            {"role": "user", "content": [{"type": "text", "text": "Task"}]},
+        ]
+        previous_input_token_count = 0
+        for step in range(3):
+            output = model.generate(messages).content
+            assert cached_model.generate(messages).content == output
+            assert cached_model.last_input_token_count == model.last_input_token_count
+            # At least the previous prompt is reused
+            assert previous_input_token_count <= cached_model.last_cached_input_token_count
+            assert cached_model.last_cached_input_token_count < cached_model.last_input_token_count
+            previous_input_token_count = cached_model.last_input_token_count
+            assert "".join(delta.content for delta in cached_model.generate_stream(messages)) == output
+            assert cached_model.last_cached_input_token_count == cached_model.last_input_token_count - 1
+            messages = messages + [
+                {"role": "assistant", "content": [{"type": "text", "text": output}]},
+                {"role": "user", "content": [{"type": "text", "text": f"Observation {step}"}]},
+            ]
+
+    def test_cache_is_invalidated_when_prefix_diverges(self, tiny_transformers_model_path):
+        model = self.make_model(tiny_transformers_model_path)
+        cached_model = self.make_model(tiny_transformers_model_path, prompt_caching=True)
+        messages = [{"role": "user", "content": [{"type": "text", "text": "First task"}]}]
+        cached_model.generate(messages)
+        messages = [{"role": "user", "content": [{"type": "text", "text": "Other task"}]}]
+        assert cached_model.generate(messages).content == model.generate(messages).content
+        common_prefix_ids = cached_model.tokenizer("<s>user\n", add_special_tokens=False)["input_ids"]
+        assert cached_model.last_cached_input_token_count == len(common_prefix_ids)
+
+    def test_concurrent_calls_do_not_share_the_cache(self, tiny_transformers_model_path):
+        model = self.make_model(tiny_transformers_model_path)
+        cached_model = self.make_model(tiny_transformers_model_path, prompt_caching=True)
+        tasks = [[{"role": "user", "content": [{"type": "text", "text": f"Task {index}"}]}] for index in range(4)]
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            outputs = list(executor.map(lambda messages: cached_model.generate(messages).content, tasks * 2))
+        assert outputs == [model.generate(messages).content for messages in tasks * 2]
+
+
+class TestTransformersModelStopSequences:
+    def test_generation_stops_at_stop_sequence(self, tiny_transformers_model_path):
+        model = TransformersModel(
+            model_id=tiny_transformers_model_path, device_map="cpu", max_new_tokens=12, do_sample=False
+        )
+        messages = [{"role": "user", "content": [{"type": "text", "text": "Task"}]}]
+        output = model.generate(messages).content
+        full_output_token_count = model.last_output_token_count
+        stop_sequence = output[4:6]
+        stop_index = output.index(stop_sequence)
+
+        assert (
+            model.generate(messages, stop_sequences=[stop_sequence, "never generated"]).content == output[:stop_index]
+        )
+        output_token_count = model.last_output_token_count
+        assert output_token_count < full_output_token_count
+        # The same criterion works again once generation stopped
+        assert model.generate(messages, stop_sequences=[stop_sequence]).content == output[:stop_index]
+
+        stream = model.generate_stream(messages, stop_sequences=[stop_sequence])
+        assert "".join(delta.content for delta in stream) == output[: stop_index + 2]
+        assert model.last_output_token_count == output_token_count
+
+    def test_streaming_counts_generated_tokens(self, tiny_transformers_model_path):
+        model = TransformersModel(
+            model_id=tiny_transformers_model_path, device_map="cpu", max_new_tokens=12, do_sample=False
+        )
+        messages = [{"role": "user", "content": [{"type": "text", "text": "Task"}]}]
+        model.generate(messages)
+        output_token_count = model.last_output_token_count
+        list(model.generate_stream(messages))
+        assert model.last_output_token_count == output_token_count
+
+
+class TestTransformersBatchScheduler:
+    @staticmethod
+    def make_messages(i):
+        return [{"role": "user", "content": [{"type": "text", "text": "Task " * (i + 1)}]}]
+
+    def test_concurrent_generations_match_sequential_ones(self, tiny_transformers_model_path):
+        model_kwargs = dict(
+            model_id=tiny_transformers_model_path, device_map="cpu", max_new_tokens=10, do_sample=False
+        )
+        model = TransformersModel(**model_kwargs)
+        batched_model = TransformersModel(**model_kwargs, max_batch_size=3)
+        # Different lengths, and more requests than the batch size, so that requests join a running batch
+        expected_outputs = [model.generate(self.make_messages(i)).content for i in range(7)]
+        with ThreadPoolExecutor(max_workers=7) as executor:
+            outputs = list(executor.map(lambda i: batched_model.generate(self.make_messages(i)).content, range(7)))
+        assert outputs == expected_outputs
+
+        stream = batched_model.generate_stream(self.make_messages(2))
+        assert "".join(delta.content for delta in stream) == expected_outputs[2]
+        assert batched_model.last_output_token_count == 10
+
+        stop_sequence = expected_outputs[3][4:6]
+        expected_output = model.generate(self.make_messages(3), stop_sequences=[stop_sequence]).content
+        assert batched_model.generate(self.make_messages(3), stop_sequences=[stop_sequence]).content == expected_output
+        assert batched_model.last_output_token_count == model.last_output_token_count
+
+    def test_sampling(self, tiny_transformers_model_path):
+        model = TransformersModel(
+            model_id=tiny_transformers_model_path,
+            device_map="cpu",
+            max_new_tokens=5,
+            do_sample=True,
+            temperature=0.7,
+            top_k=20,
+            top_p=0.9,
+            max_batch_size=2,
+        )
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            list(executor.map(lambda i: model.generate(self.make_messages(i)), range(3)))
+        assert model.last_output_token_count <= 5
+
+    def test_unsupported_generation_parameters(self, tiny_transformers_model_path):
+        model = TransformersModel(
+            model_id=tiny_transformers_model_path, device_map="cpu", max_new_tokens=5, max_batch_size=2
+        )
+        with pytest.raises(ValueError, match="not supported with batching: \\['repetition_penalty'\\]"):
+            model.generate(self.make_messages(0), repetition_penalty=1.2)
+        with pytest.raises(ValueError, match="only supported for text models, without prompt caching"):
+            TransformersModel(model_id=tiny_transformers_model_path, prompt_caching=True, max_batch_size=2)
+
+    def test_errors_are_raised_to_all_requests(self, tiny_transformers_model_path):
+        model = TransformersModel(
+            model_id=tiny_transformers_model_path, device_map="cpu", max_new_tokens=5, max_batch_size=2
+        )
+        with patch.object(model.model, "forward", side_effect=RuntimeError("Out of memory")):
+            with pytest.raises(RuntimeError, match="Out of memory"):
+                model.generate(self.make_messages(0))
+            with pytest.raises(RuntimeError, match="Out of memory"):
+                list(model.generate_stream(self.make_messages(0)))
+        # The scheduler recovers
+        assert len(model.generate(self.make_messages(0)).content) > 0
+
+
+class FakeAsyncLLMEngine:
+    """
+    Stands in for the V0 `vllm.AsyncLLMEngine`, with the same signatures: streams the words of the prompt back as
+    cumulative outputs.
+    """
+
+    def __init__(self):
+        self.running_request_ids = set()
+        self.max_running_requests = 0
+        self.aborted_request_ids = []
+        self.shutdown_in_loop = None
+
+    @classmethod
+    def from_engine_args(cls, engine_args, engine_config=None, start_engine_loop=True, usage_context=None):
+        return cls()
+
+    async def generate(
+        self,
+        prompt,
+        sampling_params,
+        request_id,
+        lora_request=None,
+        trace_headers=None,
+        prompt_adapter_request=None,
+        priority=0,
+    ):
+        words = prompt.split()
+        self.running_request_ids.add(request_id)
+        self.max_running_requests = max(self.max_running_requests, len(self.running_request_ids))
+        finished = False
+        try:
+            for i in range(1, len(words) + 1):
+                await asyncio.sleep(0.01)
+                finished = i == len(words)
+                output = SimpleNamespace(text=" ".join(words[:i]), token_ids=list(range(i)))
+                yield SimpleNamespace(prompt_token_ids=list(range(len(prompt))), outputs=[output], finished=finished)
+        finally:
+            self.running_request_ids.discard(request_id)
+            if not finished:
+                self.aborted_request_ids.append(request_id)
+
+    def shutdown_background_loop(self):
+        # Cancels the background task of the engine, which requires its event loop
+        asyncio.get_running_loop()
+        self.shutdown_in_loop = True
+
+
+class FakeAsyncLLM(FakeAsyncLLMEngine):
+    """Stands in for the V1 `vllm.AsyncLLM`, which replaces `shutdown_background_loop` with `shutdown`."""
+
+    shutdown_background_loop = None
+
+    def shutdown(self):
+        self.shutdown_in_loop = True
+
+
+class TestVLLMModel:
+    @pytest.fixture(params=[FakeAsyncLLMEngine, FakeAsyncLLM], ids=["v0", "v1"])
+    def model(self, request):
+        vllm = MagicMock(AsyncLLMEngine=request.param)
+        tokenizer = MagicMock()
+        tokenizer.apply_chat_template.side_effect = lambda messages, **kwargs: " ".join(
+            message["content"] for message in messages
+        )
+        vllm_tokenizer = MagicMock(get_tokenizer=MagicMock(return_value=tokenizer))
+        modules = {
+            "vllm": vllm,
+            "vllm.transformers_utils": MagicMock(tokenizer=vllm_tokenizer),
+            "vllm.transformers_utils.tokenizer": vllm_tokenizer,
+        }
+        with patch.dict(sys.modules, modules), patch("smolagents.models._is_package_available", return_value=True):
+            model = VLLMModel(model_id="test-model")
+            yield model
+            if not model._loop.is_closed():
+                model._loop.call_soon_threadsafe(model._loop.stop)
+
+    @staticmethod
+    def make_messages(text):
+        return [{"role": "user", "content": [{"type": "text", "text": text}]}]
+
+    def test_generate(self, model):
+        message = model.generate(self.make_messages("Hello world from vLLM"))
+        assert message.content == "Hello world from vLLM"
+        assert model.last_input_token_count == len("Hello world from vLLM")
+        assert model.last_output_token_count == 4
+
+    def test_generate_stream(self, model):
+        deltas = list(model.generate_stream(self.make_messages("Hello world from vLLM")))
+        assert [delta.content for delta in deltas] == ["Hello", " world", " from", " vLLM"]
+        assert model.last_output_token_count == 4
+
+    def test_concurrent_requests_are_served_together(self, model):
+        texts = [f"Request {i} " + "word " * 5 for i in range(4)]
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            messages = list(executor.map(lambda text: model.generate(self.make_messages(text)), texts))
+        assert [message.content for message in messages] == [text.strip() for text in texts]
+        assert model.model.max_running_requests > 1
+
+    def test_concurrent_requests_have_their_own_token_counts(self, model):
+        texts = [f"Request {i} " + "word " * i for i in range(4)]
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            messages = list(executor.map(lambda text: model.generate(self.make_messages(text)), texts))
+        assert model.model.max_running_requests > 1
+        for text, message in zip(texts, messages):
+            # The fake engine has a prompt token per character, and an output token per word
+            assert model.get_message_token_counts(message) == (len(text), len(text.split()))
+
+    def test_grammar_is_enforced_by_guided_decoding(self, model):
+        sampling_params = MagicMock()
+        modules = {"vllm.sampling_params": sampling_params}
+        with patch.dict(sys.modules, modules):
+            model.generate(self.make_messages("Hello"), grammar={"type": "regex", "value": "[a-z]+"})
+            with pytest.raises(ValueError, match="only supports grammars of type 'json' or 'regex'"):
+                model.generate(self.make_messages("Hello"), grammar={"type": "ebnf", "value": "root ::= 'a'"})
+        sampling_params.GuidedDecodingParams.assert_called_once_with(regex="[a-z]+")
+        assert (
+            sys.modules["vllm"].SamplingParams.call_args.kwargs["guided_decoding"]
+            == sampling_params.GuidedDecodingParams.return_value
+        )
+
+    def test_closing_the_stream_aborts_the_request(self, model):
+        stream = model.generate_stream(self.make_messages("Hello world from vLLM"))
+        assert next(stream).content == "Hello"
+        stream.close()
+        assert len(model.model.aborted_request_ids) == 1
+        assert model.model.running_request_ids == set()
+
+    def test_agenerate_stream(self, model):
+        async def consume():
+            return [delta.content async for delta in model.agenerate_stream(self.make_messages("Hello world"))]
+
+        assert asyncio.run(consume()) == ["Hello", " world"]
+
+    def test_cleanup_shuts_the_engine_down(self, model):
+        engine = model.model
+        parallel_state = MagicMock()
+        modules = {
+            "torch": MagicMock(),
+            "vllm.distributed": MagicMock(parallel_state=parallel_state),
+            "vllm.distributed.parallel_state": parallel_state,
+        }
+        with patch.dict(sys.modules, modules):
+            model.cleanup()
+        assert engine.shutdown_in_loop
+        assert model.model is None
+        parallel_state.destroy_model_parallel.assert_called_once()
+        parallel_state.destroy_distributed_environment.assert_called_once()
+
+    def test_tools_to_call_from(self, model):
+        @tool
+        def get_weather(location: str) -> str:
+            """
+            Get the weather at a location.
+
+            Args:
+                location: The location.
+            """
+            return "sunny"
+
+        model.generate(self.make_messages("Weather in Paris?"), tools_to_call_from=[get_weather])
+        call_kwargs = model.tokenizer.apply_chat_template.call_args.kwargs
+        assert call_kwargs["add_generation_prompt"] is True
+        assert call_kwargs["tools"][0]["function"]["name"] == "get_weather"
+
+
+class TestChatMessageStreamAccumulator:
+    def test_content_and_tool_calls_are_assembled(self):
+        accumulator = ChatMessageStreamAccumulator()
+        for stream_delta in [
+            ChatMessageStreamDelta(content="Let me "),
+            ChatMessageStreamDelta(content="check."),
+            ChatMessageStreamDelta(
+                tool_calls=[ChatMessageToolCallStreamDelta(index=0, id="call_0", type="function", name="get_")]
+            ),
+            ChatMessageStreamDelta(
+                tool_calls=[ChatMessageToolCallStreamDelta(index=0, name="weather", arguments="{")]
+            ),
+            ChatMessageStreamDelta(tool_calls=[ChatMessageToolCallStreamDelta(index=0, arguments='"location": 1}')]),
+        ]:
+            accumulator.add(stream_delta)
+        message = accumulator.to_message()
+        assert message.role == MessageRole.ASSISTANT
+        assert message.content == "Let me check."
+        assert message.tool_calls == [
+            ChatMessageToolCall(
+                id="call_0",
+                type="function",
+                function=ChatMessageToolCallDefinition(name="get_weather", arguments='{"location": 1}'),
+            )
+        ]
+
+    def test_completed_tool_calls(self):
+        accumulator = ChatMessageStreamAccumulator()
+        accumulator.add(
+            ChatMessageStreamDelta(tool_calls=[ChatMessageToolCallStreamDelta(index=0, name="a", arguments='{"x": ')])
+        )
+        assert accumulator.completed_tool_calls == []
+        accumulator.add(ChatMessageStreamDelta(tool_calls=[ChatMessageToolCallStreamDelta(index=0, arguments="1}")]))
+        assert [tool_call.function.name for tool_call in accumulator.completed_tool_calls] == ["a"]
+        # A tool call is complete once the next one starts, even if its arguments are not a JSON object
+        accumulator.add(
+            ChatMessageStreamDelta(tool_calls=[ChatMessageToolCallStreamDelta(index=1, name="b", arguments="{")])
+        )
+        assert [tool_call.function.name for tool_call in accumulator.completed_tool_calls] == ["a"]
+        accumulator.add(ChatMessageStreamDelta(tool_calls=[ChatMessageToolCallStreamDelta(index=2, name="c")]))
+        assert [tool_call.function.name for tool_call in accumulator.completed_tool_calls] == ["a", "b"]
+
+    def test_whole_tool_calls_are_added_as_they_are(self):
+        tool_call = ChatMessageToolCall(
+            id="call_0", type="function", function=ChatMessageToolCallDefinition(name="a", arguments={"x": 1})
+        )
+        accumulator = ChatMessageStreamAccumulator()
+        accumulator.add(ChatMessageStreamDelta(tool_calls=[tool_call]))
+        assert accumulator.completed_tool_calls == [tool_call]
+        assert accumulator.to_message().tool_calls == [tool_call]
+
+    def test_tool_call_fragments_have_the_shape_of_tool_calls(self):
+        fragment = ChatMessageToolCallStreamDelta(index=0, id="call_0", type="function", name="a", arguments='{"x"')
+        assert (fragment.id, fragment.type) == ("call_0", "function")
+        assert fragment.function == ChatMessageToolCallDefinition(name="a", arguments='{"x"')
+
+    def test_empty_stream(self):
+        message = ChatMessageStreamAccumulator().to_message()
+        assert message.content is None
+        assert message.tool_calls is None
+
+
+class TestStopSequenceMatcher:
+    @pytest.mark.parametrize(
+        "stop_sequences, chunks, expected_match_start",
+        [
+            (["Observation:"], ["Thought: ok", "\nObserv", "ation:", " 1"], 12),
+            (["<end_code>", "Observation:"], ["```<end", "_code>"], 3),
+            # Overlapping stop sequences: the one ending first wins, then the longest one
+            (["abcd", "bc"], ["abcd"], 1),
+            (["abab", "bab"], ["ababab"], 0),
+            (["aab"], ["a", "a", "a", "b"], 1),
+            (["stop"], ["no stop sequence here"], 3),
+            (["stop"], ["nothing here"], None),
+            ([], ["nothing to find"], None),
+            ([""], ["empty stop sequences are ignored"], None),
+        ],
+    )
+    def test_feed(self, stop_sequences, chunks, expected_match_start):
+        matcher = StopSequenceMatcher(stop_sequences)
+        for chunk in chunks:
+            match_start = matcher.feed(chunk)
+        assert match_start == expected_match_start
+        assert matcher.length == sum(len(chunk) for chunk in chunks)
+
+    def test_match_is_kept_until_reset(self):
+        matcher = StopSequenceMatcher(["end"])
+        assert matcher.feed("the end") == 4
+        assert matcher.feed(" of the end") == 4
+        matcher.reset()
+        assert matcher.feed("end") == 0
+
+    def test_partial_match_length(self):
+        matcher = StopSequenceMatcher(["<end_code>", "Observation:"])
+        matcher.feed("print(1) <end")
+        assert matcher.partial_match_length == len("<end")
+        matcher.feed("ed")
+        assert matcher.partial_match_length == 0
+        matcher.feed(" Obs")
+        assert matcher.partial_match_length == len("Obs")
+
+
 def test_get_clean_message_list_basic():
     messages = [
         {"role": "user", "content": [{"type": "text", "text": "Hello!"}]},
@@ -451,8 +2118,8 @@ def test_get_clean_message_list_role_conversions():
             {
                 "role": "user",
                 "content": [
-                    {"type": "image", "image": "encoded_image"},
-                    {"type": "image", "image": "second_encoded_image"},
+                    {"type": "image", "image": "encoded_image", "mime_type": "image/png"},
+                    {"type": "image", "image": "second_encoded_image", "mime_type": "image/png"},
                 ],
             },
         ),
@@ -475,11 +2142,11 @@ def test_get_clean_message_list_image_encoding(convert_images_to_image_urls, exp
             "content": [{"type": "image", "image": b"image_data"}, {"type": "image", "image": b"second_image_data"}],
         }
     ]
-    with patch("smolagents.models.encode_image_base64") as mock_encode:
-        mock_encode.side_effect = ["encoded_image", "second_encoded_image"]
+    with patch("smolagents.models.encode_image") as mock_encode:
+        mock_encode.side_effect = [("encoded_image", "image/png"), ("second_encoded_image", "image/png")]
         result = get_clean_message_list(messages, convert_images_to_image_urls=convert_images_to_image_urls)
-        mock_encode.assert_any_call(b"image_data")
-        mock_encode.assert_any_call(b"second_image_data")
+        mock_encode.assert_any_call(b"image_data", policy=None)
+        mock_encode.assert_any_call(b"second_image_data", policy=None)
         assert len(result) == 1
         assert result[0] == expected_clean_message
 
@@ -495,6 +2162,140 @@ def test_get_clean_message_list_flatten_messages_as_text():
     assert result[0]["content"] == "Hello!\nHow are you?"
 
 
+def test_get_clean_message_list_does_not_modify_messages():
+    image = PIL.Image.new("RGB", (2, 2))
+    messages = [
+        {"role": "user", "content": [{"type": "text", "text": "Hello!"}, {"type": "image", "image": image}]},
+        {"role": "user", "content": [{"type": "text", "text": "How are you?"}]},
+    ]
+    original_messages = [{**message, "content": [dict(el) for el in message["content"]]} for message in messages]
+    result = get_clean_message_list(messages, convert_images_to_image_urls=True)
+    assert messages == original_messages
+    assert messages[0]["content"][1]["image"] is image
+    assert [element["type"] for element in result[0]["content"]] == ["text", "image_url", "text"]
+
+
+def test_get_clean_message_list_without_merging_text_elements():
+    messages = [
+        {"role": "user", "content": [{"type": "text", "text": "Hello!"}]},
+        {"role": "user", "content": [{"type": "text", "text": "How are you?"}]},
+    ]
+    result = get_clean_message_list(messages, merge_text_elements=False)
+    assert result == [
+        {"role": "user", "content": [{"type": "text", "text": "Hello!"}, {"type": "text", "text": "How are you?"}]}
+    ]
+
+
+def test_get_clean_message_list_with_image_encoding_policy():
+    messages = [{"role": "user", "content": [{"type": "image", "image": PIL.Image.new("RGB", (100, 50))}]}]
+    policy = ImageEncodingPolicy(format="JPEG", max_side=20)
+    result = get_clean_message_list(messages, convert_images_to_image_urls=True, image_encoding_policy=policy)
+    url = result[0]["content"][0]["image_url"]["url"]
+    assert url.startswith("data:image/jpeg;base64,")
+    assert PIL.Image.open(BytesIO(base64.b64decode(url.split(",")[1]))).size == (20, 10)
+
+
+def test_get_clean_message_list_keeps_mime_type_of_image_encoding_policy():
+    messages = [{"role": "user", "content": [{"type": "image", "image": PIL.Image.new("RGB", (100, 50))}]}]
+    policy = ImageEncodingPolicy(format="JPEG")
+    element = get_clean_message_list(messages, image_encoding_policy=policy)[0]["content"][0]
+    assert element["mime_type"] == "image/jpeg"
+    assert PIL.Image.open(BytesIO(base64.b64decode(element["image"]))).format == "JPEG"
+
+
+def test_model_image_encoding_policy(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    model = OpenAIServerModel(
+        model_id="gpt-4o", api_key="test", image_encoding_policy={"format": "WEBP", "max_side": 8}
+    )
+    assert model.image_encoding_policy == ImageEncodingPolicy(format="WEBP", max_side=8)
+    messages = [{"role": "user", "content": [{"type": "image", "image": PIL.Image.new("RGB", (16, 16))}]}]
+    completion_kwargs = model._prepare_completion_kwargs(messages, convert_images_to_image_urls=True)
+    assert completion_kwargs["messages"][0]["content"][0]["image_url"]["url"].startswith("data:image/webp;base64,")
+    assert "image_encoding_policy" not in completion_kwargs
+    model_dictionary = model.to_dict()
+    assert model_dictionary["image_encoding_policy"] == {"format": "WEBP", "max_side": 8, "quality": None}
+    assert OpenAIServerModel.from_dict(model_dictionary).image_encoding_policy == model.image_encoding_policy
+
+
+class TestCleanMessageListCache:
+    @staticmethod
+    def make_messages(n_steps, image):
+        messages = [{"role": "system", "content": [{"type": "text", "text": "System prompt"}]}]
+        for i in range(n_steps):
+            messages += [
+                {"role": "assistant", "content": [{"type": "text", "text": f"Step {i}"}]},
+                {"role": "tool-response", "content": [{"type": "text", "text": f"Observation {i}"}]},
+                {"role": "user", "content": [{"type": "image", "image": image}]},
+            ]
+        return messages
+
+    @pytest.mark.parametrize("flatten_messages_as_text", [False, True])
+    def test_cached_result_matches_uncached_result(self, flatten_messages_as_text):
+        cache = CleanMessageListCache()
+        messages = [
+            {"role": "system", "content": [{"type": "text", "text": "System prompt"}]},
+            {"role": "user", "content": [{"type": "text", "text": "Task"}]},
+        ]
+        for i in range(3):
+            result = get_clean_message_list(
+                messages,
+                role_conversions=tool_role_conversions,
+                flatten_messages_as_text=flatten_messages_as_text,
+                cache=cache,
+            )
+            assert result == get_clean_message_list(
+                messages, role_conversions=tool_role_conversions, flatten_messages_as_text=flatten_messages_as_text
+            )
+            # New lists with the same content: the next messages are merged with the last one
+            messages = [{**message} for message in messages] + [
+                {"role": "tool-response", "content": [{"type": "text", "text": f"Observation {i}"}]},
+                {"role": "assistant", "content": [{"type": "text", "text": f"Step {i}"}]},
+            ]
+
+    def test_only_new_messages_are_processed(self):
+        cache = CleanMessageListCache()
+        image = PIL.Image.new("RGB", (2, 2))
+        with patch("smolagents.models.encode_image", return_value=("encoded_image", "image/png")) as mock_encode:
+            for n_steps in range(1, 5):
+                result = get_clean_message_list(
+                    self.make_messages(n_steps, image), convert_images_to_image_urls=True, cache=cache
+                )
+            assert mock_encode.call_count == 4
+        assert len(result) == 1 + 3 * 4
+        assert result[-1]["content"] == [
+            {"type": "image_url", "image_url": {"url": "data:image/png;base64,encoded_image"}}
+        ]
+
+    def test_changed_prefix_is_processed_again(self):
+        cache = CleanMessageListCache()
+        messages = self.make_messages(2, PIL.Image.new("RGB", (2, 2)))
+        get_clean_message_list(messages, cache=cache)
+        messages[1] = {"role": "assistant", "content": [{"type": "text", "text": "Step 0 (edited)"}]}
+        messages[3] = {"role": "user", "content": [{"type": "image", "image": PIL.Image.new("RGB", (2, 2))}]}
+        with patch("smolagents.models.encode_image", return_value=("encoded_image", "image/png")) as mock_encode:
+            result = get_clean_message_list(messages, cache=cache)
+        assert mock_encode.call_count == 2
+        assert result[1]["content"][0]["text"] == "Step 0 (edited)"
+
+    def test_settings_are_part_of_the_key(self):
+        cache = CleanMessageListCache()
+        messages = [{"role": "tool-call", "content": [{"type": "text", "text": "Calling tools"}]}]
+        assert get_clean_message_list(messages, cache=cache)[0]["role"] == "tool-call"
+        result = get_clean_message_list(messages, role_conversions=tool_role_conversions, cache=cache)
+        assert result[0]["role"] == "assistant"
+
+    def test_modifying_the_result_does_not_alter_the_cache(self):
+        cache = CleanMessageListCache()
+        messages = [{"role": "user", "content": [{"type": "text", "text": "Hello!"}]}]
+        result = get_clean_message_list(messages, cache=cache)
+        result[0]["content"].append({"type": "text", "text": "Injected"})
+        result[0]["role"] = "assistant"
+        assert get_clean_message_list(messages, cache=cache) == [
+            {"role": "user", "content": [{"type": "text", "text": "Hello!"}]}
+        ]
+
+
 @pytest.mark.parametrize(
     "model_class, model_kwargs, patching, expected_flatten_messages_as_text",
     [
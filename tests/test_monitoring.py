@@ -14,6 +14,7 @@
 # limitations under the License.
 
 import unittest
+from unittest.mock import patch
 
 import pytest
 
@@ -84,6 +85,19 @@ class MonitoringTester(unittest.TestCase):
         self.assertEqual(agent.monitor.total_input_token_count, 10)
         self.assertEqual(agent.monitor.total_output_token_count, 20)
 
+    def test_code_agent_cached_input_token_metrics(self):
+        model = FakeLLMModel()
+        model.last_cached_input_token_count = 6
+        agent = CodeAgent(tools=[], model=model, max_steps=1)
+        with patch.object(agent.logger, "log") as mock_log:
+            agent.run("Fake task")
+
+        self.assertEqual(agent.monitor.get_total_token_counts(), {"input": 10, "output": 20, "cached_input": 6})
+        self.assertEqual(agent.monitor.step_cached_input_token_counts, [6])
+        self.assertEqual(agent.monitor.step_uncached_input_token_counts, [4])
+        metrics_log = mock_log.call_args_list[-1].args[0].plain
+        self.assertIn("Cached input tokens: 6 (step: 6 cached, 4 uncached)", metrics_log)
+
     def test_code_agent_metrics_max_steps(self):
         class FakeLLMModelMalformedAnswer(Model):
             def __init__(self):
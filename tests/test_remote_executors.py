@@ -1,16 +1,31 @@
+import asyncio
+import base64
 import io
+import json
+import pickle
 from textwrap import dedent
-from unittest.mock import MagicMock, patch
+from unittest.mock import AsyncMock, MagicMock, patch
 
 import docker
 import PIL.Image
 import pytest
+import requests
 from rich.console import Console
 
-from smolagents.default_tools import WikipediaSearchTool
+from smolagents.default_tools import FinalAnswerTool, WikipediaSearchTool
 from smolagents.monitoring import AgentLogger, LogLevel
-from smolagents.remote_executors import DockerExecutor, E2BExecutor, RemotePythonExecutor
-from smolagents.utils import AgentError
+from smolagents.remote_executors import (
+    KERNEL_SETUP_CODE,
+    RESULT_MIMETYPE,
+    DockerExecutor,
+    E2BExecutor,
+    KernelGatewayClient,
+    RemotePythonExecutor,
+    SubprocessExecutor,
+    create_shared_array,
+    dump_with_shared_memory,
+)
+from smolagents.utils import AgentError, AgentExecutionError
 
 from .utils.markers import require_run_all
 
@@ -54,6 +69,211 @@ class TestE2BExecutorMock:
             "timeout": 60,
         }
 
+    def test_e2b_executor_execution_timeout(self):
+        from e2b_code_interpreter import TimeoutException
+
+        with patch("e2b_code_interpreter.Sandbox") as mock_sandbox:
+            mock_sandbox.return_value.run_code.return_value.error = None
+            executor = E2BExecutor(additional_imports=[], logger=MagicMock(), execution_timeout=5)
+        mock_sandbox.return_value.run_code.side_effect = TimeoutException("Execution timed out")
+        with pytest.raises(AgentExecutionError, match="Code execution timed out after 5 seconds"):
+            executor("while True: pass")
+        assert mock_sandbox.return_value.run_code.call_args.kwargs == {"timeout": 5}
+
+
+class FakeKernelWebSocket:
+    """Replays scripted kernel messages in reply to each execute request. A `None` reply never completes."""
+
+    def __init__(self, replies):
+        self.replies = list(replies)
+        self.sent_requests = []
+        self.incoming = asyncio.Queue()
+
+    async def send(self, raw_request):
+        request = json.loads(raw_request)
+        self.sent_requests.append(request)
+        # Messages from other requests should be ignored
+        self.incoming.put_nowait(json.dumps({"parent_header": {"msg_id": "other"}, "msg_type": "stream"}))
+        reply = self.replies.pop(0)
+        if reply is not None:
+            self.reply_to_last_request(reply + [{"msg_type": "status", "content": {"execution_state": "idle"}}])
+
+    def reply_to_last_request(self, messages):
+        parent_header = {"msg_id": self.sent_requests[-1]["header"]["msg_id"]}
+        for message in messages:
+            self.incoming.put_nowait(json.dumps({"parent_header": parent_header, **message}))
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        raw_message = await self.incoming.get()
+        if raw_message is None:
+            raise StopAsyncIteration
+        return raw_message
+
+    async def close(self):
+        self.incoming.put_nowait(None)
+
+
+def make_result_message(value, is_final_answer):
+    return {
+        "msg_type": "display_data",
+        "content": {
+            "data": {RESULT_MIMETYPE: base64.b64encode(pickle.dumps(value)).decode()},
+            "metadata": {RESULT_MIMETYPE: {"is_final_answer": is_final_answer}},
+        },
+    }
+
+
+class TestDockerExecutorMock:
+    @pytest.fixture(autouse=True)
+    def set_gateway_client(self):
+        self.gateway_client = KernelGatewayClient()
+        yield
+        self.gateway_client.loop.call_soon_threadsafe(self.gateway_client.loop.stop)
+
+    def make_executor(self, replies, kernel_id="kernel-id", execution_timeout=None):
+        executor = DockerExecutor.__new__(DockerExecutor)
+        RemotePythonExecutor.__init__(executor, additional_imports=[], logger=MagicMock())
+        executor.gateway_client = self.gateway_client
+        executor.kernel_id = kernel_id
+        executor.execution_timeout = execution_timeout
+        executor._kernel_state_codes = {"setup": KERNEL_SETUP_CODE}
+        websocket = FakeKernelWebSocket(replies)
+        with patch("websockets.connect", AsyncMock(return_value=websocket)):
+            self.gateway_client.run(self.gateway_client.connect("http://gateway", kernel_id))
+        return executor, websocket
+
+    def test_final_answer_from_result_channel(self):
+        executor, websocket = self.make_executor(
+            [
+                [
+                    {"msg_type": "stream", "content": {"text": "some logs\n"}},
+                    make_result_message({"answer": 42}, is_final_answer=True),
+                ]
+            ]
+        )
+        # The final answer call does not have to be on its own line
+        result, logs, is_final_answer = executor("x = 2; final_answer({'answer': 42})")
+        assert result == {"answer": 42}
+        assert logs == "some logs\n"
+        assert is_final_answer is True
+        # The code is not rewritten before being sent to the kernel
+        assert websocket.sent_requests[0]["content"]["code"] == "x = 2; final_answer({'answer': 42})"
+
+    def test_intermediate_result_from_result_channel(self):
+        executor, _ = self.make_executor([[make_result_message([1, 2, 3], is_final_answer=False)]])
+        result, logs, is_final_answer = executor("_smolagents_send_result([1, 2, 3])")
+        assert result == [1, 2, 3]
+        assert is_final_answer is False
+
+    def test_other_display_data_is_ignored(self):
+        executor, _ = self.make_executor(
+            [
+                [
+                    {"msg_type": "execute_result", "content": {"data": {"text/plain": "3"}, "metadata": {}}},
+                    {"msg_type": "stream", "content": {"text": "RESULT_PICKLE:not-a-result"}},
+                ]
+            ]
+        )
+        result, logs, is_final_answer = executor("print('RESULT_PICKLE:not-a-result'); 3")
+        assert result is None
+        assert logs == "RESULT_PICKLE:not-a-result"
+        assert is_final_answer is False
+
+    def test_missing_final_answer_raises(self):
+        executor, _ = self.make_executor([[]])
+        with pytest.raises(AgentError, match="No final answer returned by executor!"):
+            executor.run_code_raise_errors("x = 1", return_final_answer=True)
+
+    def test_error_raises(self):
+        executor, _ = self.make_executor([[{"msg_type": "error", "content": {"traceback": ["NameError: x"]}}]])
+        with pytest.raises(AgentError, match="NameError: x"):
+            executor("x")
+
+    def test_concurrent_executors_share_the_client(self):
+        executors = [
+            self.make_executor([[make_result_message(i, is_final_answer=True)]], kernel_id=f"kernel-{i}")[0]
+            for i in range(10)
+        ]
+
+        async def run_all():
+            return await asyncio.gather(
+                *(executor.acall(f"final_answer({i})") for i, executor in enumerate(executors))
+            )
+
+        outputs = asyncio.run(run_all())
+        assert [output[0] for output in outputs] == list(range(10))
+        assert all(output[2] for output in outputs)
+
+    def test_timeout_interrupts_kernel(self):
+        executor, websocket = self.make_executor(
+            [None, [{"msg_type": "stream", "content": {"text": "still alive"}}]], execution_timeout=0.1
+        )
+
+        def interrupt_kernel(url, timeout):
+            websocket.reply_to_last_request(
+                [
+                    {"msg_type": "error", "content": {"traceback": ["KeyboardInterrupt"]}},
+                    {"msg_type": "status", "content": {"execution_state": "idle"}},
+                ]
+            )
+            return MagicMock()
+
+        with patch("smolagents.remote_executors.requests.post", side_effect=interrupt_kernel) as mock_post:
+            with pytest.raises(AgentExecutionError, match="timed out after 0.1 seconds and was interrupted"):
+                executor("while True: pass")
+        assert mock_post.call_args.args[0] == "http://gateway/api/kernels/kernel-id/interrupt"
+        assert mock_post.call_args.kwargs["timeout"] == self.gateway_client.request_timeout
+        # The kernel can be used again
+        _, logs, _ = executor("print('still alive')")
+        assert logs == "still alive"
+
+    def test_timeout_restarts_wedged_kernel(self):
+        self.gateway_client.interrupt_timeout = 0.1
+        executor, _ = self.make_executor([None], execution_timeout=0.1)
+        executor._kernel_state_codes["tools"] = "tools_code"
+        restarted_websocket = FakeKernelWebSocket([[], [], [{"msg_type": "stream", "content": {"text": "restarted"}}]])
+        with (
+            patch("smolagents.remote_executors.requests.post") as mock_post,
+            patch("websockets.connect", AsyncMock(return_value=restarted_websocket)),
+        ):
+            with pytest.raises(AgentExecutionError, match="The kernel had to be restarted"):
+                executor("while True: pass")
+        assert [call.args[0] for call in mock_post.call_args_list] == [
+            "http://gateway/api/kernels/kernel-id/interrupt",
+            "http://gateway/api/kernels/kernel-id/restart",
+        ]
+        # The kernel state was restored on the new connection
+        assert [request["content"]["code"] for request in restarted_websocket.sent_requests] == [
+            KERNEL_SETUP_CODE,
+            "tools_code",
+        ]
+        _, logs, _ = executor("print('restarted')")
+        assert logs == "restarted"
+
+    def test_timeout_with_unresponsive_gateway_raises_execution_error(self):
+        self.gateway_client.interrupt_timeout = 0.1
+        executor, _ = self.make_executor([None], execution_timeout=0.1)
+        with patch(
+            "smolagents.remote_executors.requests.post", side_effect=requests.exceptions.Timeout("Read timed out")
+        ) as mock_post:
+            with pytest.raises(AgentExecutionError, match="the kernel could not be stopped: .*Read timed out"):
+                executor("while True: pass")
+        assert [call.args[0] for call in mock_post.call_args_list] == [
+            "http://gateway/api/kernels/kernel-id/interrupt",
+            "http://gateway/api/kernels/kernel-id/restart",
+        ]
+        assert all(call.kwargs["timeout"] == self.gateway_client.request_timeout for call in mock_post.call_args_list)
+
+    def test_closed_connection_raises(self):
+        executor, websocket = self.make_executor([])
+        self.gateway_client.run(websocket.close())
+        self.gateway_client.run(asyncio.sleep(0.1))  # Let the client notice the closed connection
+        with pytest.raises(ConnectionError):
+            executor("x = 1")
+
 
 @pytest.fixture
 def docker_executor():
@@ -123,3 +343,130 @@ class TestDockerExecutor:
         client = docker.from_env()
         containers = [c.id for c in client.containers.list(all=True)]
         assert container_id not in containers, "Container should be removed"
+
+
+@pytest.fixture
+def subprocess_executor():
+    executor = SubprocessExecutor(
+        additional_imports=[],
+        logger=AgentLogger(LogLevel.INFO, Console(force_terminal=False, file=io.StringIO())),
+        execution_timeout=1,
+        interrupt_timeout=1,
+        shared_memory_threshold=1024,
+    )
+    yield executor
+    executor.delete()
+
+
+class TestSubprocessExecutor:
+    @pytest.fixture(autouse=True)
+    def set_executor(self, subprocess_executor):
+        self.executor = subprocess_executor
+
+    def test_state_persistence(self):
+        self.executor("a = 2")
+        result, logs, is_final_answer = self.executor("print(a * 3)")
+        assert (result, logs, is_final_answer) == (None, "6\n", False)
+
+    def test_final_answer_from_result_channel(self):
+        self.executor.send_tools({"final_answer": FinalAnswerTool()})
+        result, logs, is_final_answer = self.executor('print("done")\nfinal_answer({"answer": 42})')
+        assert result == {"answer": 42}
+        assert logs == "done\n"
+        assert is_final_answer is True
+
+    def test_missing_final_answer_raises(self):
+        with pytest.raises(AgentError, match="No final answer returned by executor!"):
+            self.executor.run_code_raise_errors("x = 1", return_final_answer=True)
+
+    def test_error_raises_with_logs(self):
+        with pytest.raises(AgentError) as exception_info:
+            self.executor('print("before")\n1 / 0')
+        assert "before" in str(exception_info.value)
+        assert "ZeroDivisionError" in str(exception_info.value)
+
+    def test_send_variables_through_shared_memory(self):
+        np = pytest.importorskip("numpy")
+        array = np.arange(10_000, dtype=np.float64)
+        self.executor.send_variables({"array": array, "small": np.arange(3), "name": "test"})
+        assert len(self.executor._shared_memories) == 1
+        _, logs, _ = self.executor("print(array.sum(), small.sum(), name)")
+        assert logs == f"{array.sum()} 3 test\n"
+
+    def test_send_shared_array_without_copy(self):
+        pytest.importorskip("numpy")
+        array = create_shared_array((10_000,), dtype="int64")
+        array[:] = 1
+        self.executor.send_variables({"array": array})
+        assert self.executor._shared_memories == []
+        # The kernel maps the same memory
+        self.executor("array[0] = 42")
+        assert array[0] == 42
+
+    def test_send_memmap_without_copy(self, tmp_path):
+        np = pytest.importorskip("numpy")
+        array = np.memmap(tmp_path / "array.bin", dtype=np.float64, mode="w+", shape=(10_000,))
+        array[:] = 2.0
+        self.executor.send_variables({"array": array, "view": array[5000:]})
+        assert self.executor._shared_memories == []
+        _, logs, _ = self.executor("print(type(array).__name__, array.sum(), view.sum())")
+        assert logs == "ndarray 20000.0 10000.0\n"
+
+    def test_send_dataframe_through_shared_memory(self):
+        pd = pytest.importorskip("pandas")
+        df = pd.DataFrame({"a": range(10_000), "b": [0.5] * 10_000})
+        self.executor.send_variables({"df": df})
+        assert len(self.executor._shared_memories) == 2
+        _, logs, _ = self.executor("print(df.a.sum(), df.b.sum())")
+        assert logs == f"{df.a.sum()} {df.b.sum()}\n"
+
+    def test_timeout_interrupts_kernel(self):
+        self.executor("x = 1")
+        with pytest.raises(
+            AgentExecutionError, match="timed out after 1 seconds and was interrupted"
+        ) as exception_info:
+            self.executor("import time\ntime.sleep(10)")
+        assert "restarted" not in str(exception_info.value)
+        _, logs, _ = self.executor("print(x)")
+        assert logs == "1\n"
+
+    def test_timeout_restarts_wedged_kernel(self):
+        self.executor.send_variables({"x": 1})
+        pid = self.executor.process.pid
+        with pytest.raises(AgentExecutionError, match="The kernel had to be restarted"):
+            self.executor("import signal, time\nsignal.signal(signal.SIGINT, signal.SIG_IGN)\ntime.sleep(10)")
+        assert self.executor.process.pid != pid
+        # Variables sent to the previous kernel are restored
+        _, logs, _ = self.executor("print(x)")
+        assert logs == "1\n"
+
+    def test_kernel_crash_restarts_kernel(self):
+        with pytest.raises(AgentExecutionError, match="Kernel exited with code 3"):
+            self.executor("import os\nos._exit(3)")
+        _, logs, _ = self.executor("print('alive')")
+        assert logs == "alive\n"
+
+
+class TestDumpWithSharedMemory:
+    def test_buffers_by_size(self):
+        np = pytest.importorskip("numpy")
+        large, small = np.arange(1000, dtype=np.int64), np.arange(10, dtype=np.int64)
+        data, descriptors, shared_memories = dump_with_shared_memory({"large": large, "small": small}, threshold=1000)
+        try:
+            assert [descriptor[0] for descriptor in descriptors] == ["shm"]
+            assert descriptors[0][2:] == (0, large.nbytes)
+            buffers = [shm.buf[: large.nbytes] for shm in shared_memories]
+            loaded = pickle.loads(data, buffers=buffers)
+            assert np.array_equal(loaded["large"], large) and np.array_equal(loaded["small"], small)
+            del buffers, loaded
+        finally:
+            for shm in shared_memories:
+                shm.close()
+                shm.unlink()
+
+    def test_shared_array_views_are_sent_by_location(self):
+        pytest.importorskip("numpy")
+        array = create_shared_array((100, 10))
+        _, descriptors, shared_memories = dump_with_shared_memory({"rows": array[10:20]}, threshold=0)
+        assert shared_memories == []
+        assert descriptors == [("shm", descriptors[0][1], 10 * 10 * 8, 10 * 10 * 8)]
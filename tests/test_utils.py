@@ -12,17 +12,32 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import base64
+import gc
 import inspect
 import os
 import textwrap
 import unittest
+from io import BytesIO
 
+import PIL.Image
 import pytest
 from IPython.core.interactiveshell import InteractiveShell
 
 from smolagents import Tool
 from smolagents.tools import tool
-from smolagents.utils import get_source, instance_to_source, is_valid_name, parse_code_blobs, parse_json_blob
+from smolagents.utils import (
+    ImageEncodingCache,
+    ImageEncodingPolicy,
+    IncrementalCodeParser,
+    encode_image_base64,
+    get_source,
+    instance_to_source,
+    is_valid_name,
+    make_image_url,
+    parse_code_blobs,
+    parse_json_blob,
+)
 
 
 class ValidTool(Tool):
@@ -495,3 +510,117 @@ def test_parse_json_blob_with_invalid_json(raw_json):
 def test_is_valid_name(name, expected):
     """Test the is_valid_name function with various inputs."""
     assert is_valid_name(name) is expected
+
+
+def decode_image(encoded_image):
+    return PIL.Image.open(BytesIO(base64.b64decode(encoded_image)))
+
+
+class TestIncrementalCodeParser:
+    text = textwrap.dedent(
+        '''
+        Thought: Let me compute it.
+        Code:
+        ```py
+        x = search(
+            "query"
+        )
+        if x:
+            y = 1
+        else:
+            y = 2
+        # A comment
+        @decorator
+        def f():
+            return """
+        text
+        """
+        final_answer(y)
+        ```<end_code>
+        '''
+    )
+
+    @pytest.mark.parametrize("chunk_size", [1, 4, 1000])
+    def test_complete_statements(self, chunk_size):
+        parser = IncrementalCodeParser()
+        statements = []
+        for i in range(0, len(self.text), chunk_size):
+            if (code := parser.feed(self.text[i : i + chunk_size])) is not None:
+                statements.append(code)
+        if chunk_size == 1000:
+            # Statements are complete once the next one starts, and the last one is left to the whole text
+            assert statements == []
+        else:
+            assert statements == [
+                'x = search(\n    "query"\n)\n',
+                "if x:\n    y = 1\nelse:\n    y = 2\n# A comment\n",
+                '@decorator\ndef f():\n    return """\ntext\n"""\n',
+            ]
+        assert parse_code_blobs(self.text).startswith(parser.parsed_code)
+
+    def test_no_code_block(self):
+        parser = IncrementalCodeParser()
+        assert parser.feed("Thought: x = 1\ny = 2\n") is None
+        assert parser.parsed_code == ""
+
+
+class TestImageEncoding:
+    def test_default_policy_is_lossless_png(self):
+        image = PIL.Image.new("RGB", (40, 30), color=(10, 20, 30))
+        decoded_image = decode_image(encode_image_base64(image, cache=ImageEncodingCache()))
+        assert decoded_image.format == "PNG"
+        assert decoded_image.size == (40, 30)
+        assert decoded_image.tobytes() == image.tobytes()
+        assert make_image_url("abc") == "data:image/png;base64,abc"
+
+    @pytest.mark.parametrize("image_format, mode", [("JPEG", "RGBA"), ("JPEG", "P"), ("WEBP", "RGBA")])
+    def test_policy_downscales_and_transcodes(self, image_format, mode):
+        policy = ImageEncodingPolicy(format=image_format, max_side=50, quality=70)
+        image = PIL.Image.new(mode, (200, 100))
+        decoded_image = decode_image(encode_image_base64(image, policy=policy, cache=ImageEncodingCache()))
+        assert decoded_image.format == image_format
+        assert decoded_image.size == (50, 25)
+        assert image.size == (200, 100)
+        assert policy.mime_type == f"image/{image_format.lower()}"
+
+    def test_cache_by_content(self):
+        cache = ImageEncodingCache()
+        image = PIL.Image.new("RGB", (10, 10))
+        encoded_image = encode_image_base64(image, cache=cache)
+        assert encode_image_base64(image.copy(), cache=cache) == encoded_image
+        assert (cache.hits, cache.misses) == (1, 1)
+        # Images modified in place are encoded again
+        image.putpixel((0, 0), (255, 0, 0))
+        assert encode_image_base64(image, cache=cache) != encoded_image
+        # Each policy has its own entries
+        encode_image_base64(image, policy=ImageEncodingPolicy(format="JPEG"), cache=cache)
+        assert (cache.hits, cache.misses) == (1, 3)
+
+    def test_cache_by_identity(self):
+        cache = ImageEncodingCache(key="identity")
+        image = PIL.Image.new("RGB", (10, 10))
+        encoded_image = encode_image_base64(image, cache=cache)
+        assert encode_image_base64(image, cache=cache) == encoded_image
+        encode_image_base64(image.copy(), cache=cache)
+        assert (cache.hits, cache.misses) == (1, 2)
+        # Entries of collected images are removed, as their id can be reused
+        del image
+        gc.collect()
+        assert len(cache._entries) == 0
+        assert cache._size_bytes == 0
+
+    def test_cache_evicts_least_recently_used_images(self):
+        images = [PIL.Image.new("RGB", (10, 10), color=(i, 0, 0)) for i in range(3)]
+        entry_size = len(encode_image_base64(images[0], cache=ImageEncodingCache()))
+        cache = ImageEncodingCache(max_size_bytes=2 * entry_size + entry_size // 2)
+        for image in images[:2]:
+            encode_image_base64(image, cache=cache)
+        encode_image_base64(images[0], cache=cache)
+        encode_image_base64(images[2], cache=cache)
+        encode_image_base64(images[0], cache=cache)
+        encode_image_base64(images[1], cache=cache)
+        assert (cache.hits, cache.misses) == (2, 4)
+
+    def test_cache_rejects_unknown_key(self):
+        with pytest.raises(ValueError, match="Unknown image cache key"):
+            ImageEncodingCache(key="pixels")